@@ -1,18 +1,40 @@
 import uvicorn
 from fastapi import FastAPI
 
+from endpoints.health import router as health_router
+from endpoints.metrics import router as metrics_router
 from endpoints.platform import router as platform_router
 from endpoints.vms import router as vm_router
+from settings import settings
+from toolkit.host_lock import get_runtime_dir
+from toolkit.metrics import mark_worker_dead, prepare_multiprocess_metrics
+from workers import start_worker, stop_worker
 
 app = FastAPI(title="Aleph SEV Compute Resource Node")
 
 
+app.include_router(health_router)
+app.include_router(metrics_router)
 app.include_router(platform_router)
 app.include_router(vm_router)
 
 
+@app.on_event("startup")
+async def start_background_tasks() -> None:
+    await start_worker()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks() -> None:
+    await stop_worker()
+    mark_worker_dead()
+
+
 def main() -> None:
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if settings.api_workers > 1:
+        prepare_multiprocess_metrics(get_runtime_dir() / "metrics")
+    # Each worker imports the application
+    uvicorn.run("api:app", host="0.0.0.0", port=8000, workers=settings.api_workers)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,86 @@
+import hashlib
+import hmac
 import secrets
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
 from fastapi import HTTPException, status, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from passlib.context import CryptContext
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
-from models.db import get_db_session
+from models.db import async_session, get_db_session
 from models.users import User
-from typing import Optional
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from passlib.context import CryptContext
+from settings import settings
+from toolkit.metrics import PASSWORD_VERIFY_DURATION
 
 security = HTTPBasic()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
+class CredentialsCache:
+    """
+    Bounded LRU cache of credentials that already passed a bcrypt check.
+
+    Entries are keyed by a keyed BLAKE2b hash of the username and password, using
+    a key generated at startup, so plain passwords are never kept in memory.
+    Each entry remembers the password hash it was verified against: if the `users`
+    row changes, the entry no longer matches and is dropped.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        # cache key -> (username, hashed password, expiration time)
+        self._entries: "OrderedDict[bytes, Tuple[str, str, float]]" = OrderedDict()
+
+    def _cache_key(self, username: str, password: str) -> bytes:
+        message = username.encode() + b"\0" + password.encode()
+        return hashlib.blake2b(message, key=self._key, digest_size=32).digest()
+
+    def get(self, username: str, password: str, hashed_password: str) -> bool:
+        """
+        Returns True if these credentials were verified against `hashed_password`
+        less than `ttl` seconds ago.
+        """
+        key = self._cache_key(username, password)
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+
+        cached_username, cached_hash, expiration_time = entry
+        if (
+            cached_username != username
+            or not hmac.compare_digest(cached_hash, hashed_password)
+            or expiration_time < time.monotonic()
+        ):
+            del self._entries[key]
+            return False
+
+        self._entries.move_to_end(key)
+        return True
+
+    def add(self, username: str, password: str, hashed_password: str) -> None:
+        if self.max_size <= 0:
+            return
+
+        key = self._cache_key(username, password)
+        self._entries[key] = (username, hashed_password, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+credentials_cache = CredentialsCache(
+    max_size=settings.auth_cache_size, ttl=settings.auth_cache_ttl
+)
+
+
 async def get_user(session: Session, username: str) -> Optional[User]:
     users = (
         await session.execute(select(User).where(User.username == username))
@@ -22,15 +89,54 @@ async def get_user(session: Session, username: str) -> Optional[User]:
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    start = time.perf_counter()
+    try:
+        return pwd_context.verify(plain_password, hashed_password)
+    finally:
+        PASSWORD_VERIFY_DURATION.observe(time.perf_counter() - start)
 
 
-async def get_current_user(
-    credentials: HTTPBasicCredentials = Depends(security),
-    session: Session = Depends(get_db_session),
-):
-    user = await get_user(session, credentials.username)
-    if not verify_password(credentials.password, user.hashed_password):
+def dummy_verify_password() -> None:
+    """
+    Spends as much time as a real verification, to not reveal which users exist.
+    """
+    start = time.perf_counter()
+    pwd_context.dummy_verify()
+    PASSWORD_VERIFY_DURATION.observe(time.perf_counter() - start)
+
+
+async def authenticate_user(
+    session: Session, username: str, password: str
+) -> Optional[User]:
+    """
+    Returns the user matching the credentials, or None if the credentials are invalid.
+    Bcrypt checks are expensive and run in the thread pool to keep the event loop
+    available for other requests.
+    """
+    user = await get_user(session, username)
+
+    if user is None:
+        # Spend the same time as for a known user to avoid leaking valid usernames
+        await run_in_threadpool(dummy_verify_password)
+        return None
+
+    if credentials_cache.get(username, password, user.hashed_password):
+        return user
+
+    if not await run_in_threadpool(verify_password, password, user.hashed_password):
+        return None
+
+    credentials_cache.add(username, password, user.hashed_password)
+    return user
+
+
+async def check_credentials(
+    session: Session, credentials: HTTPBasicCredentials
+) -> User:
+    user = await authenticate_user(
+        session, credentials.username, credentials.password
+    )
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -38,3 +144,21 @@ async def get_current_user(
         )
 
     return user
+
+
+async def get_current_user(
+    credentials: HTTPBasicCredentials = Depends(security),
+    session: Session = Depends(get_db_session),
+) -> User:
+    return await check_credentials(session, credentials)
+
+
+async def get_streaming_user(
+    credentials: HTTPBasicCredentials = Depends(security),
+) -> User:
+    """
+    Authenticates the user of a long-lived response, ex: an event stream. Unlike
+    `get_current_user`, the DB connection is not held until the response ends.
+    """
+    async with async_session() as session:
+        return await check_credentials(session, credentials)
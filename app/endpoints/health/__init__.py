@@ -0,0 +1,2 @@
+from .router import router
+from .health_endpoints import *
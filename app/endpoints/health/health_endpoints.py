@@ -0,0 +1,31 @@
+from fastapi import Response, status
+
+from schemas.health_schemas import StartupStatusSchema
+from toolkit.startup import startup_status
+from .router import router
+
+
+@router.get("/live")
+async def get_liveness():
+    """
+    Answers as soon as the API serves requests.
+    """
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get("/ready", response_model=StartupStatusSchema)
+async def get_readiness(response: Response):
+    """
+    Return 200 once the API is ready to manage VMs, 503 while it reconciles the VMs
+    with the Qemu processes running on the host.
+    """
+    if not startup_status.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return StartupStatusSchema(
+        ready=startup_status.ready,
+        vms_to_reconcile=startup_status.vms_to_reconcile,
+        vms_reconciled=startup_status.vms_reconciled,
+        duration=startup_status.duration,
+        error=startup_status.error,
+    )
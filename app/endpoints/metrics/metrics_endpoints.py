@@ -0,0 +1,24 @@
+from fastapi import Depends, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from models.db import get_db_session
+from models.vm import Vm, VmState
+from toolkit.metrics import generate_metrics
+from .router import router
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(session: Session = Depends(get_db_session)):
+    """
+    Expose the metrics of the API in the Prometheus text format, aggregated over
+    the workers.
+    """
+    select_stmt = select(Vm.state, func.count()).group_by(Vm.state)
+    counts = dict((await session.execute(select_stmt)).all())
+    vm_counts = {state.value: counts.get(state, 0) for state in VmState}
+
+    return Response(
+        content=generate_metrics(vm_counts), media_type=CONTENT_TYPE_LATEST
+    )
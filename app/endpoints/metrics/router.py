@@ -0,0 +1,5 @@
+from fastapi import APIRouter
+
+router = APIRouter(
+    tags=["metrics"],
+)
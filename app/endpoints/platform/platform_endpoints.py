@@ -1,55 +1,124 @@
-from pathlib import Path
+import asyncio
+from typing import List, Optional
 
-from fastapi import Depends
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.responses import FileResponse
-from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from models.db import get_db_session
-from models.platform import FirmwareInfo
-from schemas.platform_schemas import FirmwareInfoSchema
-from toolkit.sevtool import SevClient
+from schemas.platform_schemas import (
+    CapacitySchema,
+    DeviceProfileSchema,
+    FirmwareInfoSchema,
+    ImageStoreStatsSchema,
+    NodeStatsSchema,
+)
+from toolkit.capacity import fetch_capacity_usage
+from toolkit.device_profiles import device_profiles
+from toolkit.image_store import image_store
+from toolkit.leader import LeaderCallError, LeaderUnavailableError
+from toolkit.platform_info import (
+    PlatformInfoUnavailableError,
+    certificates_cache,
+    platform_info_cache,
+)
+from toolkit.resource_usage import RESOLUTIONS, get_node_stats
 from .router import router
 
-SEV_DIR = Path.cwd().absolute() / "sev_files"
-
-
-sev_client = SevClient(SEV_DIR)
-
 
 @router.get("/certificates")
-def get_sev_certificates():
+async def get_sev_certificates():
     """
     Download the platform certificates as a ZIP file.
     """
-    if not sev_client.certificates_archive.is_file():
-        sev_client.export_certificates()
-
-    return FileResponse(sev_client.certificates_archive)
+    return FileResponse(await certificates_cache.get_archive())
 
 
 @router.get("/info", response_model=FirmwareInfoSchema)
-async def get_platform_info(session: Session = Depends(get_db_session)):
+async def get_platform_info():
     """
     Return information about the platform such as the firmware version
-    and features supported by the CPU.
+    and features supported by the CPU, and the age of this information in seconds.
+    """
+    try:
+        info = await platform_info_cache.get()
+    except PlatformInfoUnavailableError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    return FirmwareInfoSchema(
+        api_major=info.api_major,
+        api_minor=info.api_minor,
+        build=info.build,
+        cache_age=info.age,
+    )
+
+
+@router.get("/image-store", response_model=ImageStoreStatsSchema)
+def get_image_store_stats():
+    """
+    Return the usage statistics of the VM image store: cache hit rate and disk space
+    saved by deduplication and copy-on-write VM disks.
     """
+    stats = image_store.stats
+    return ImageStoreStatsSchema(
+        images=len(list(image_store.images_dir.glob("*.img"))),
+        size=image_store.size,
+        hits=stats.hits,
+        misses=stats.misses,
+        hit_rate=stats.hit_rate,
+        overlays=stats.overlays,
+        bytes_saved=stats.bytes_saved,
+    )
 
-    db_firmware_info_result = (await session.execute(select(FirmwareInfo))).one_or_none()
 
-    if db_firmware_info_result is None:
-        sev_platform_status = sev_client.get_platform_status()
-        firmware_info = FirmwareInfo(
-            api_major=sev_platform_status.api_major,
-            api_minor=sev_platform_status.api_minor,
-            platform_state=sev_platform_status.platform_state,
-            owner=sev_platform_status.owner,
-            config=sev_platform_status.config,
-            build=sev_platform_status.build,
+@router.get("/capacity", response_model=CapacitySchema)
+async def get_capacity(session: Session = Depends(get_db_session)):
+    """
+    Return the memory (in MB) and cores of the host, and how much is committed to VMs.
+    """
+    usage = await fetch_capacity_usage(session)
+    return CapacitySchema(
+        total_memory=usage.total_memory,
+        total_cores=usage.total_cores,
+        allocatable_memory=usage.allocatable_memory,
+        allocatable_cores=usage.allocatable_cores,
+        committed_memory=usage.committed_memory,
+        committed_cores=usage.committed_cores,
+        available_memory=usage.available_memory,
+        available_cores=usage.available_cores,
+        number_of_vms=usage.number_of_vms,
+    )
+
+
+@router.get("/stats", response_model=NodeStatsSchema)
+async def get_node_resource_usage(
+    resolution: Optional[int] = Query(
+        default=None,
+        title="Period averaged by each sample, in seconds: 300 or 3600. By default, "
+        "returns the last samples",
+    ),
+    since: Optional[float] = Query(
+        default=None, title="Only return the samples taken after this UNIX timestamp"
+    ),
+):
+    """
+    Return the total resources used by the Qemu processes of the VMs over time.
+    """
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"The resolution must be one of {list(RESOLUTIONS)}",
         )
-        session.add(firmware_info)
 
-    else:
-        firmware_info = db_firmware_info_result[0]
+    try:
+        return await get_node_stats(resolution=resolution, since=since)
+    except (LeaderUnavailableError, LeaderCallError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
 
-    return firmware_info
+@router.get("/device-profiles", response_model=List[DeviceProfileSchema])
+def get_device_profiles():
+    """
+    List the device profiles that can be selected when creating or starting a VM.
+    """
+    return list(device_profiles.values())
@@ -1,6 +1,9 @@
 from fastapi import APIRouter
 
+from toolkit.metrics import MetricsRoute
+
 router = APIRouter(
     prefix="/platform",
+    route_class=MetricsRoute,
     tags=["platform"],
 )
@@ -1,2 +1,7 @@
 from .router import router
 from .vm_endpoints import *
+from .upload_endpoints import *
+from .event_endpoints import *
+from .launch_endpoints import *
+from .stop_endpoints import *
+from .console_endpoints import *
@@ -0,0 +1,93 @@
+"""
+Serial console of the VMs, as Server-Sent Events.
+
+`GET /vm/vm/{vm_id}/console` streams the output of the serial console of a VM,
+ex: the boot messages of the firmware and kernel. Each event carries the offset of
+its output, and its ID is the offset to resume from: clients that reconnect send
+the `Last-Event-ID` header to receive the output they missed, as long as it is
+still kept.
+"""
+
+import codecs
+import json
+import logging
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from fastapi import Depends, Header, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+
+from authentication import get_streaming_user
+from models.db import async_session
+from models.users import User
+from toolkit.leader import LeaderUnavailableError
+from toolkit.serial_console import stream_console
+from .router import router
+from .vm_endpoints import fetch_vm_and_check_ownership, get_vm_dir
+
+logger = logging.getLogger(__name__)
+
+
+async def iter_console_stream(
+    vm_id: str, vm_dir: Path, offset: Optional[int], follow: bool
+) -> AsyncIterator[bytes]:
+    # Characters split between chunks are decoded with the next chunk
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # End of the output passed to the decoder
+    end_offset = None
+    try:
+        async for chunk_offset, data in stream_console(vm_id, vm_dir, offset, follow):
+            if not data:
+                # Keeps proxies from closing idle connections
+                yield b": keepalive\n\n"
+                continue
+
+            if chunk_offset != end_offset:
+                # Output deleted before it was read
+                decoder.reset()
+            pending_size = len(decoder.getstate()[0])
+            text_offset = chunk_offset - pending_size
+            text = decoder.decode(data)
+            end_offset = chunk_offset + len(data)
+            # Resuming from the event ID decodes the pending bytes again
+            event_id = end_offset - len(decoder.getstate()[0])
+            message = {"offset": text_offset, "data": text}
+            yield (
+                f"id: {event_id}\nevent: console\ndata: {json.dumps(message)}\n\n"
+            ).encode()
+    except (LeaderUnavailableError, OSError) as e:
+        # The client resumes from its last event when it reconnects
+        logger.warning("Console stream of VM %s interrupted: %s", vm_id, e)
+
+
+@router.get("/vm/{vm_id}/console", response_class=StreamingResponse)
+async def stream_vm_console(
+    vm_id: str,
+    offset: Optional[int] = Query(
+        default=None,
+        title="Offset of the output to start from, from the end if negative. By "
+        "default, starts from the output kept in memory",
+    ),
+    follow: bool = Query(default=True, title="Wait for new output"),
+    last_event_id: Optional[str] = Header(
+        default=None, title="ID of the last event received, to resume the stream"
+    ),
+    user: User = Depends(get_streaming_user),
+):
+    if last_event_id is not None:
+        try:
+            offset = int(last_event_id)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Invalid Last-Event-ID",
+            )
+
+    async with async_session() as session:
+        vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+
+    return StreamingResponse(
+        iter_console_stream(vm.id, get_vm_dir(vm), offset, follow),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
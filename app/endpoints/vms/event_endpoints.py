@@ -0,0 +1,86 @@
+"""
+Stream of the events of the VMs of a user, as Server-Sent Events.
+
+`GET /vm/events` publishes the state transitions of the VMs, the QMP events sent
+by Qemu (ex: SHUTDOWN, RESET) and the progress of the launch jobs. Clients that
+reconnect send the `Last-Event-ID` header to receive the events they missed.
+"""
+
+import logging
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import Depends, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from authentication import get_streaming_user
+from models.db import async_session
+from models.users import User
+from models.vm import Vm
+from settings import settings
+from toolkit.events import EventStreamOverflow, EventSubscription, EventType, event_bus
+from .router import router
+
+logger = logging.getLogger(__name__)
+
+
+async def forward_qmp_event(vm_id: str, message: Dict[str, Any]) -> None:
+    """
+    Publishes a QMP event sent by the Qemu process of a VM to the owner of the VM.
+    """
+    async with async_session() as session:
+        owner = (
+            await session.execute(select(Vm.owner).where(Vm.id == vm_id))
+        ).scalar_one_or_none()
+    if owner is None:
+        return
+
+    event_bus.publish(
+        owner,
+        EventType.QMP,
+        {
+            "vm_id": vm_id,
+            "event": message["event"],
+            "data": message.get("data", {}),
+            "timestamp": message.get("timestamp"),
+        },
+    )
+
+
+async def iter_event_stream(subscription: EventSubscription) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            try:
+                event = await subscription.get(
+                    timeout=settings.event_stream_keepalive_interval
+                )
+            except EventStreamOverflow:
+                # The client resumes from its last event when it reconnects
+                logger.warning(
+                    "Closing the event stream of %s, too many pending events",
+                    subscription.owner,
+                )
+                return
+
+            if event is None:
+                # Keeps proxies from closing idle connections
+                yield b": keepalive\n\n"
+            else:
+                yield event.to_sse()
+    finally:
+        subscription.close()
+
+
+@router.get("/events", response_class=StreamingResponse)
+async def stream_events(
+    last_event_id: Optional[str] = Header(
+        default=None, title="ID of the last event received, to resume the stream"
+    ),
+    user: User = Depends(get_streaming_user),
+):
+    subscription = event_bus.subscribe(user.username, last_event_id=last_event_id)
+    return StreamingResponse(
+        iter_event_stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
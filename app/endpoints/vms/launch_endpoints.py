@@ -0,0 +1,329 @@
+"""
+Launch of a VM in a single request.
+
+`POST /vm/launch` replaces the creation of the VM, the uploads of its image and of
+its guest owner certificates, its start and the polling of its launch. It takes a
+multipart/form-data body with the fields:
+
+* `spec`: the resources, SEV policy and image of the VM, as JSON. Must be first.
+* `guest_owner_certificates`: the ZIP archive of the GODH and session files.
+* `vm_image_tarball`: the tarball of the image, unless `template_vm_id` reuses the
+  image of another VM of the user.
+
+The fields are processed as they arrive: the capacity of the host is checked before
+the image is received and the certificates are validated while the image streams.
+The response returns the launch measure of the VM once Qemu has started.
+"""
+
+import asyncio
+import io
+import logging
+import shutil
+from pathlib import Path
+from typing import Optional, Tuple
+from uuid import uuid4
+from zipfile import BadZipFile
+
+from fastapi import Depends, HTTPException, Request, status
+from pydantic import ValidationError
+
+from authentication import get_streaming_user
+from models.db import async_session
+from models.jobs import Job, JobStatus, fetch_job
+from models.users import User
+from models.vm import Vm, VmImage, VmState, fetch_vm
+from schemas.vm_schemas import VmLaunchBundleResponseSchema, VmLaunchBundleSpecSchema
+from settings import settings
+from toolkit.capacity import InsufficientCapacityError, fetch_capacity_usage
+from toolkit.events import EventStreamOverflow, EventSubscription, EventType, event_bus
+from toolkit.image_ingest import ImageIngestError, extract_tar_member
+from toolkit.image_store import image_store
+from toolkit.multipart_stream import MultipartReader, MultipartStreamError
+from toolkit.qmp_client import QmpConnectionError, QmpError
+from .router import router
+from .vm_endpoints import (
+    fetch_vm_and_check_ownership,
+    get_vm_dir,
+    install_guest_owner_certificates,
+    measure_vm,
+    queue_vm_launch,
+    validate_device_profile,
+    validate_sev_policy,
+)
+
+logger = logging.getLogger(__name__)
+
+LAUNCH_BUNDLE_SPEC_MAX_SIZE = 64 * 1024
+GUEST_OWNER_CERTIFICATES_MAX_SIZE = 1024 * 1024
+# Interval between checks of the launch job, in case its events are not received
+JOB_POLL_INTERVAL = 1.0
+
+
+async def read_launch_bundle_spec(reader: MultipartReader) -> VmLaunchBundleSpecSchema:
+    part = await reader.next_part()
+    if part is None or part.name != "spec":
+        raise MultipartStreamError("The first field of the body must be 'spec'")
+
+    try:
+        return VmLaunchBundleSpecSchema.parse_raw(
+            await reader.read(LAUNCH_BUNDLE_SPEC_MAX_SIZE)
+        )
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors()
+        )
+
+
+async def check_launch_bundle_spec(
+    spec: VmLaunchBundleSpecSchema, user: User
+) -> Optional[VmImage]:
+    """
+    Rejects a launch before its image is received.
+
+    :return: The image of the template VM, if any.
+    """
+    validate_sev_policy(spec.sev_policy)
+    if spec.device_profile is not None:
+        validate_device_profile(spec.device_profile)
+    if (spec.template_vm_id is None) == (spec.image_name is None):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Either 'image_name' or 'template_vm_id' must be set",
+        )
+
+    template_image = None
+    async with async_session() as session:
+        if spec.template_vm_id is not None:
+            template_vm = await fetch_vm_and_check_ownership(
+                session, spec.template_vm_id, user
+            )
+            template_image = template_vm.image
+            if template_image is None or template_image.digest is None:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="The template VM does not have an image in the image store",
+                )
+
+        # Admitted for good once the VM is created, other launches may take the
+        # capacity in the meantime
+        usage = await fetch_capacity_usage(session)
+
+    if reason := usage.check(spec.memory, spec.number_of_cores):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=reason)
+    return template_image
+
+
+async def receive_launch_bundle(
+    reader: MultipartReader, spec: VmLaunchBundleSpecSchema, vm_dir: Path
+) -> Optional[Tuple[Path, str]]:
+    """
+    Installs the guest owner certificates in the directory of the VM and extracts
+    the image in the image store.
+
+    :return: The path and digest of the extracted image, if the body has one.
+    """
+    certificates_task = None
+    image = None
+    try:
+        while (part := await reader.next_part()) is not None:
+            if part.name == "guest_owner_certificates":
+                archive = await reader.read(GUEST_OWNER_CERTIFICATES_MAX_SIZE)
+                # Validated while the image is received
+                certificates_task = asyncio.create_task(
+                    asyncio.to_thread(
+                        install_guest_owner_certificates, io.BytesIO(archive), vm_dir
+                    )
+                )
+            elif part.name == "vm_image_tarball":
+                if spec.image_name is None:
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail="Uploading an image requires 'image_name'",
+                    )
+                # Extract in the store directory so that adding the image to the
+                # store is a rename
+                image_path = image_store.tmp_dir / uuid4().hex
+                extracted_image = await extract_tar_member(
+                    reader.iter_data(), spec.image_name, image_path
+                )
+                image = image_path, extracted_image.digest
+
+        if certificates_task is None:
+            raise MultipartStreamError(
+                "Missing field 'guest_owner_certificates' in multipart body"
+            )
+        if spec.template_vm_id is None and image is None:
+            raise MultipartStreamError("Missing field 'vm_image_tarball' in multipart body")
+
+        try:
+            await certificates_task
+        except (BadZipFile, KeyError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Invalid guest owner certificates archive: {e}",
+            )
+        return image
+
+    except BaseException:
+        if certificates_task is not None:
+            # The extraction cannot be interrupted, wait for it before cleaning up
+            await asyncio.gather(certificates_task, return_exceptions=True)
+        if image is not None:
+            image[0].unlink(missing_ok=True)
+        raise
+
+
+async def wait_for_job_event(
+    subscription: EventSubscription, job_id: str, timeout: float
+) -> None:
+    """
+    Returns when an event of a job is published, or after `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (remaining := deadline - loop.time()) > 0:
+        try:
+            event = await subscription.get(timeout=remaining)
+        except EventStreamOverflow:
+            await asyncio.sleep(remaining)
+            return
+        if event is None or (
+            event.type == EventType.JOB and event.data["job_id"] == job_id
+        ):
+            return
+
+
+async def wait_for_job(
+    subscription: EventSubscription, job_id: str, timeout: float
+) -> Job:
+    """
+    Returns a job once it succeeded or failed, or after `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        async with async_session() as session:
+            job = await fetch_job(session, job_id)
+        remaining = deadline - loop.time()
+        if job.status in (JobStatus.SUCCEEDED, JobStatus.FAILED) or remaining <= 0:
+            return job
+        await wait_for_job_event(
+            subscription, job_id, timeout=min(remaining, JOB_POLL_INTERVAL)
+        )
+
+
+@router.post(
+    "/launch",
+    response_model=VmLaunchBundleResponseSchema,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "spec": {
+                                "type": "string",
+                                "description": "VmLaunchBundleSpecSchema, as JSON",
+                            },
+                            "guest_owner_certificates": {
+                                "type": "string",
+                                "format": "binary",
+                            },
+                            "vm_image_tarball": {"type": "string", "format": "binary"},
+                        },
+                        "required": ["spec", "guest_owner_certificates"],
+                    }
+                },
+            },
+            "required": True,
+        }
+    },
+)
+async def launch_vm_bundle(
+    request: Request,
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Create a VM from its image and guest owner certificates, start it and return its
+    launch measure, in one request. If the launch takes longer than
+    `launch_bundle_timeout`, the measure is not returned: poll the job, then use the
+    measure endpoint.
+    """
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="The body must be multipart/form-data",
+        )
+
+    reader = MultipartReader(content_type, request.stream())
+    vm_dir = None
+    created = False
+    try:
+        try:
+            spec = await read_launch_bundle_spec(reader)
+            template_image = await check_launch_bundle_spec(spec, user)
+
+            vm = Vm(
+                id=uuid4().hex,
+                state=VmState.STOPPED,
+                memory=spec.memory,
+                number_of_cores=spec.number_of_cores,
+                owner=user.username,
+                device_profile=spec.device_profile,
+            )
+            vm_dir = get_vm_dir(vm)
+            extracted_image = await receive_launch_bundle(reader, spec, vm_dir)
+        except (ImageIngestError, MultipartStreamError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+            )
+
+        if extracted_image is not None:
+            image_path, digest = extracted_image
+            digest = await image_store.add_file(image_path, digest=digest)
+            vm.image = VmImage(id=uuid4().hex, filename=spec.image_name, digest=digest)
+        else:
+            # Images are content-addressed, the VMs share the same file
+            vm.image = VmImage(
+                id=uuid4().hex,
+                filename=template_image.filename,
+                digest=template_image.digest,
+            )
+
+        # Receives the events of the job from its creation
+        subscription = event_bus.subscribe(user.username)
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    session.add(vm)
+                    try:
+                        job = await queue_vm_launch(session, vm, spec.sev_policy)
+                    except InsufficientCapacityError as e:
+                        raise HTTPException(
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                        )
+            created = True
+
+            job = await wait_for_job(
+                subscription, job.id, timeout=settings.launch_bundle_timeout
+            )
+        finally:
+            subscription.close()
+
+    finally:
+        if vm_dir is not None and not created:
+            shutil.rmtree(vm_dir, ignore_errors=True)
+
+    async with async_session() as session:
+        vm = await fetch_vm(session, vm.id)
+
+    response = {"vm": vm, "job": job}
+    if job.status == JobStatus.SUCCEEDED and vm.state == VmState.STARTED:
+        try:
+            response.update(await measure_vm(vm))
+        except (QmpError, QmpConnectionError, asyncio.TimeoutError) as e:
+            logger.warning("Could not measure VM %s: %s", vm.id, e)
+    return response
@@ -1,6 +1,11 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
+
+from toolkit.metrics import MetricsRoute
+from toolkit.startup import require_ready
 
 router = APIRouter(
     prefix="/vm",
+    route_class=MetricsRoute,
     tags=["vms"],
+    dependencies=[Depends(require_ready)],
 )
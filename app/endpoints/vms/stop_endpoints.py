@@ -0,0 +1,318 @@
+"""
+Stop and deletion of the VMs.
+
+Stopping a VM asks its guest to shut down with an ACPI power button event, then
+stops Qemu with the `quit` QMP command if the guest is still running after the
+timeout, and kills Qemu as a last resort. The Qemu processes are supervised by the
+leader, other workers relay the stops to it.
+
+Deleting a VM stops it, then deletes its database rows and releases its ports. Its
+directory is moved to the trash and removed in the background, so that the request
+does not wait for the removal of its disk. The leader then removes the images of
+the store that no VM uses anymore.
+"""
+
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+from typing import List, Optional
+
+from fastapi import Depends, HTTPException, Query, Response, status
+from sqlalchemy import delete, select
+
+from authentication import get_streaming_user
+from models.db import async_session
+from models.jobs import Job
+from models.users import User
+from models.vm import ImageUpload, ImageUploadChunk, Vm, VmImage, VmState, fetch_vm
+from schemas.vm_schemas import (
+    VmBulkActionResponseSchema,
+    VmBulkActionResultSchema,
+    VmBulkActionSchema,
+    VmSchema,
+)
+from settings import settings
+from toolkit.leader import (
+    LEADER_CALL_TIMEOUT,
+    LeaderCallError,
+    LeaderUnavailableError,
+    call_leader,
+    leader_election,
+    notify_leader,
+)
+from toolkit.image_store import image_store
+from toolkit.ports import release_ports
+from toolkit.qemu import QemuVmClient
+from toolkit.qmp_client import QmpConnectionError, QmpError
+from toolkit.resource_usage import resource_sampler
+from toolkit.serial_console import serial_consoles
+from toolkit.supervisor import qemu_supervisor
+from toolkit.trash import Trash
+from .router import router
+from .upload_endpoints import get_upload_path
+from .vm_endpoints import DOWNLOAD_DIR, fetch_vm_and_check_ownership, get_vm_dir
+
+logger = logging.getLogger(__name__)
+
+# Time given to Qemu to exit after the quit command, then after SIGKILL
+QEMU_QUIT_TIMEOUT = 5.0
+QEMU_KILL_TIMEOUT = 5.0
+
+vm_dir_trash = Trash(DOWNLOAD_DIR / ".trash")
+# Set when a VM is deleted, to remove its image if no other VM uses it
+unused_images_check = asyncio.Event()
+
+
+async def stop_vm_process(vm_id: str, grace_period: float) -> bool:
+    """
+    Stops the Qemu process of a VM, giving `grace_period` seconds to the guest to
+    shut down. Runs in the leader.
+
+    :return: False if the process could not be stopped.
+    """
+    if not qemu_supervisor.is_supervised(vm_id):
+        return True
+
+    async with async_session() as session:
+        vm = await fetch_vm(session, vm_id)
+    try:
+        vm_client = QemuVmClient(vm)
+    except ValueError:
+        vm_client = None
+
+    if vm_client is not None:
+        # A guest waiting for its launch secret is not started yet
+        if vm.state == VmState.RUNNING and grace_period > 0:
+            try:
+                await vm_client.system_powerdown()
+            except (QmpError, QmpConnectionError, asyncio.TimeoutError) as e:
+                logger.warning("Could not shut down the guest of VM %s: %s", vm_id, e)
+            else:
+                if await qemu_supervisor.wait_for_exit(vm_id, grace_period):
+                    return True
+                logger.info("Guest of VM %s did not shut down, stopping Qemu", vm_id)
+
+        try:
+            await vm_client.quit()
+        except (QmpError, QmpConnectionError, asyncio.TimeoutError) as e:
+            # Qemu can exit before replying
+            logger.debug("Quit command of VM %s failed: %s", vm_id, e)
+        if await qemu_supervisor.wait_for_exit(vm_id, QEMU_QUIT_TIMEOUT):
+            return True
+
+    logger.warning("Killing the Qemu process of VM %s", vm_id)
+    qemu_supervisor.send_signal(vm_id, signal.SIGKILL)
+    return await qemu_supervisor.wait_for_exit(vm_id, QEMU_KILL_TIMEOUT)
+
+
+async def forget_vm(vm_id: str) -> None:
+    """
+    Drops what the leader keeps in memory about a deleted VM.
+    """
+    serial_consoles.remove(vm_id)
+    resource_sampler.remove(vm_id)
+    qemu_supervisor.forget(vm_id)
+    unused_images_check.set()
+
+
+async def remove_unused_images() -> None:
+    """
+    Removes the images of the store that no VM uses. Runs in the leader.
+    """
+    async with async_session() as session:
+        # Images replaced by another image of their VM are not used anymore
+        select_stmt = select(VmImage.digest).join(Vm, Vm.image_id == VmImage.id)
+        used_digests = set((await session.execute(select_stmt)).scalars())
+    freed = await image_store.remove_unused_images(
+        used_digests, grace_period=settings.image_store_gc_grace_period
+    )
+    if freed:
+        logger.info("Removed unused images, %d bytes freed", freed)
+
+
+async def run_image_store_gc(interval: float) -> None:
+    """
+    Removes the unused images every `interval` seconds, and when VMs are deleted.
+    Images left by failed requests, ex: launches rejected for lack of capacity, are
+    removed once their grace period is over.
+    """
+    while True:
+        unused_images_check.clear()
+        try:
+            await remove_unused_images()
+        except Exception:
+            logger.exception("Could not remove the unused images")
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(unused_images_check.wait(), interval)
+
+
+async def stop_user_vm(vm_id: str, user: User, grace_period: float) -> Vm:
+    async with async_session() as session:
+        vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    if vm.state not in (VmState.STARTED, VmState.RUNNING):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Cannot stop a VM in state '{vm.state}'.",
+        )
+
+    try:
+        if leader_election.is_leader:
+            stopped = await stop_vm_process(vm.id, grace_period)
+        else:
+            # The QMP commands sent during the stop have their own timeouts
+            stopped = await call_leader(
+                "stop_vm",
+                timeout=grace_period + LEADER_CALL_TIMEOUT,
+                vm_id=vm.id,
+                grace_period=grace_period,
+            )
+    except (LeaderUnavailableError, LeaderCallError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    if not stopped:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The Qemu process of the VM could not be stopped",
+        )
+
+    async with async_session() as session:
+        return await fetch_vm(session, vm.id)
+
+
+async def delete_user_vm(vm_id: str, user: User, grace_period: float) -> None:
+    async with async_session() as session:
+        vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    if vm.state in (VmState.STARTED, VmState.RUNNING):
+        await stop_user_vm(vm_id, user, grace_period)
+
+    async with async_session() as session:
+        async with session.begin():
+            vm = await fetch_vm_and_check_ownership(session, vm_id, user, lock=True)
+            if vm.state != VmState.STOPPED:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail=f"Cannot delete a VM in state '{vm.state}'.",
+                )
+
+            select_stmt = select(ImageUpload).where(ImageUpload.vm_id == vm.id)
+            uploads = (await session.execute(select_stmt)).scalars().all()
+            if uploads:
+                await session.execute(
+                    delete(ImageUploadChunk).where(
+                        ImageUploadChunk.upload_id.in_([upload.id for upload in uploads])
+                    )
+                )
+                await session.execute(
+                    delete(ImageUpload).where(ImageUpload.vm_id == vm.id)
+                )
+            await session.execute(delete(Job).where(Job.vm_id == vm.id))
+            await release_ports(session, vm.id)
+            image = vm.image
+            await session.delete(vm)
+            if image is not None:
+                # The file in the image store is removed by the leader if no other
+                # VM uses it
+                await session.delete(image)
+
+    vm_dir_trash.discard(get_vm_dir(vm))
+    for upload in uploads:
+        get_upload_path(upload).unlink(missing_ok=True)
+    if leader_election.is_leader:
+        await forget_vm(vm.id)
+    else:
+        notify_leader("forget_vm", vm_id=vm.id)
+
+
+@router.post("/vm/{vm_id}/stop", response_model=VmSchema)
+async def stop_vm(
+    vm_id: str,
+    timeout: Optional[float] = Query(
+        default=None,
+        ge=0,
+        title="Time given to the guest to shut down before Qemu is stopped, in "
+        "seconds. Defaults to `vm_stop_timeout`",
+    ),
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Shut down the guest of a started VM, then stop its Qemu process if the guest is
+    still running after the timeout.
+    """
+    if timeout is None:
+        timeout = settings.vm_stop_timeout
+    return await stop_user_vm(vm_id, user, grace_period=timeout)
+
+
+@router.delete("/vm/{vm_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_vm(
+    vm_id: str,
+    timeout: Optional[float] = Query(
+        default=None,
+        ge=0,
+        title="Time given to the guest to shut down if the VM is started, in "
+        "seconds. Defaults to `vm_stop_timeout`",
+    ),
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Stop a VM if it is started, then delete it with its files. A VM waiting in the
+    launch queue cannot be deleted.
+    """
+    if timeout is None:
+        timeout = settings.vm_stop_timeout
+    await delete_user_vm(vm_id, user, grace_period=timeout)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+async def run_bulk_action(
+    vm_ids: List[str], user: User, grace_period: float, delete_vms: bool
+) -> VmBulkActionResponseSchema:
+    async def run_action(vm_id: str) -> VmBulkActionResultSchema:
+        try:
+            if delete_vms:
+                await delete_user_vm(vm_id, user, grace_period)
+                return VmBulkActionResultSchema(vm_id=vm_id)
+            vm = await stop_user_vm(vm_id, user, grace_period)
+            return VmBulkActionResultSchema(vm_id=vm_id, vm=VmSchema.from_orm(vm))
+        except HTTPException as e:
+            return VmBulkActionResultSchema(vm_id=vm_id, error=str(e.detail))
+
+    # The VMs are stopped in parallel, the slowest guest sets the duration
+    results = await asyncio.gather(
+        *(run_action(vm_id) for vm_id in dict.fromkeys(vm_ids))
+    )
+    return VmBulkActionResponseSchema(results=results)
+
+
+@router.post("/bulk/stop", response_model=VmBulkActionResponseSchema)
+async def bulk_stop_vms(
+    bulk_action: VmBulkActionSchema,
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Stop several VMs in parallel. A VM that cannot be stopped, ex: because it is not
+    started, does not prevent stopping the others and its result reports the error.
+    """
+    grace_period = bulk_action.timeout
+    if grace_period is None:
+        grace_period = settings.vm_stop_timeout
+    return await run_bulk_action(
+        bulk_action.vm_ids, user, grace_period=grace_period, delete_vms=False
+    )
+
+
+@router.post("/bulk/delete", response_model=VmBulkActionResponseSchema)
+async def bulk_delete_vms(
+    bulk_action: VmBulkActionSchema,
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Delete several VMs in parallel, stopping the started ones. A VM that cannot be
+    deleted does not prevent deleting the others and its result reports the error.
+    """
+    grace_period = bulk_action.timeout
+    if grace_period is None:
+        grace_period = settings.vm_stop_timeout
+    return await run_bulk_action(
+        bulk_action.vm_ids, user, grace_period=grace_period, delete_vms=True
+    )
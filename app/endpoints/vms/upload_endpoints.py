@@ -0,0 +1,272 @@
+"""
+Resumable, parallel uploads of VM images.
+
+1. `POST /vm/{vm_id}/image-uploads` creates an upload session for an image of known size.
+2. Chunks are uploaded with `PUT .../chunks/{index}`, in any order and in parallel.
+3. `GET .../{upload_id}` lists the missing chunks, ex: after a connection drop.
+4. `POST .../{upload_id}/commit` adds the image to the image store and attaches it to the VM.
+"""
+
+import asyncio
+from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+
+from fastapi import Depends, Header, HTTPException, Query, Request, Response, status
+from sqlalchemy import select
+from sqlalchemy.orm import Session, selectinload
+
+from authentication import get_current_user, get_streaming_user
+from models.db import async_session, get_db_session
+from models.users import User
+from models.vm import ImageUpload, ImageUploadChunk, Vm, VmImage
+from schemas.vm_schemas import ImageUploadSchema, VmImagePostSchema
+from settings import settings
+from toolkit.chunked_upload import (
+    ChunkSizeError,
+    create_upload_file,
+    hash_upload_file,
+    write_chunk,
+)
+from toolkit.image_store import image_store
+from .router import router
+from .vm_endpoints import fetch_vm_and_check_ownership
+
+
+def get_upload_path(upload: ImageUpload) -> Path:
+    # Assemble the image next to the store to add it with a simple rename
+    return image_store.tmp_dir / f"upload-{upload.id}"
+
+
+async def fetch_upload(session: Session, vm: Vm, upload_id: str) -> ImageUpload:
+    select_stmt = (
+        select(ImageUpload)
+        .where(ImageUpload.id == upload_id, ImageUpload.vm_id == vm.id)
+        .options(selectinload(ImageUpload.chunks))
+    )
+    uploads = (await session.execute(select_stmt)).one_or_none()
+    if uploads is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found"
+        )
+
+    return uploads[0]
+
+
+def make_upload_schema(upload: ImageUpload) -> ImageUploadSchema:
+    received_chunks = {chunk.index for chunk in upload.chunks}
+    return ImageUploadSchema(
+        id=upload.id,
+        vm_id=upload.vm_id,
+        filename=upload.filename,
+        size=upload.size,
+        chunk_size=upload.chunk_size,
+        number_of_chunks=upload.number_of_chunks,
+        missing_chunks=[
+            index
+            for index in range(upload.number_of_chunks)
+            if index not in received_chunks
+        ],
+        creation_datetime=upload.creation_datetime,
+    )
+
+
+@router.post("/vm/{vm_id}/image-uploads", response_model=ImageUploadSchema)
+async def create_image_upload(
+    vm_id: str,
+    image_name: str,
+    size: int = Query(..., title="Size of the image, in bytes", gt=0),
+    chunk_size: int = Query(
+        ...,
+        title="Size of the chunks, in bytes. Only the last chunk can be smaller.",
+        ge=settings.upload_min_chunk_size,
+        le=settings.upload_max_chunk_size,
+    ),
+    sha256: Optional[str] = Query(
+        default=None, title="SHA256 of the image, checked on commit"
+    ),
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Start a chunked upload of a VM image (raw disk image, not a tarball).
+    """
+    vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+
+    upload = ImageUpload(
+        id=uuid4().hex,
+        vm_id=vm.id,
+        filename=image_name,
+        size=size,
+        chunk_size=chunk_size,
+        sha256=sha256.lower() if sha256 else None,
+        chunks=[],
+    )
+    create_upload_file(get_upload_path(upload), size)
+    session.add(upload)
+    await session.flush()
+
+    return make_upload_schema(upload)
+
+
+@router.get("/vm/{vm_id}/image-uploads/{upload_id}", response_model=ImageUploadSchema)
+async def get_image_upload(
+    vm_id: str,
+    upload_id: str,
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Return the state of a chunked upload, including the chunks that remain to upload.
+    """
+    vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    upload = await fetch_upload(session, vm, upload_id)
+    return make_upload_schema(upload)
+
+
+@router.put(
+    "/vm/{vm_id}/image-uploads/{upload_id}/chunks/{index}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/octet-stream": {
+                    "schema": {"type": "string", "format": "binary"}
+                }
+            },
+            "required": True,
+        }
+    },
+)
+async def upload_image_chunk(
+    vm_id: str,
+    upload_id: str,
+    index: int,
+    request: Request,
+    chunk_sha256: str = Header(..., title="SHA256 of the chunk"),
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Upload one chunk of the image as the raw request body. Chunks can be sent in
+    parallel and uploading a chunk again overwrites it.
+    """
+    # No DB connection is held while the chunk streams, so that parallel uploads
+    # do not exhaust the connection pool
+    async with async_session() as session:
+        vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+        upload = await fetch_upload(session, vm, upload_id)
+
+    if not 0 <= index < upload.number_of_chunks:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid chunk index, must be between 0 and {upload.number_of_chunks - 1}",
+        )
+
+    offset = index * upload.chunk_size
+    try:
+        received_sha256 = await write_chunk(
+            path=get_upload_path(upload),
+            offset=offset,
+            size=min(upload.chunk_size, upload.size - offset),
+            stream=request.stream(),
+        )
+    except ChunkSizeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+
+    if received_sha256 != chunk_sha256.lower():
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Chunk checksum mismatch, upload the chunk again",
+        )
+
+    async with async_session() as session:
+        async with session.begin():
+            # The upload was aborted or committed in the meantime
+            await fetch_upload(session, vm, upload_id)
+            await session.merge(
+                ImageUploadChunk(
+                    upload_id=upload.id, index=index, sha256=received_sha256
+                )
+            )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.post(
+    "/vm/{vm_id}/image-uploads/{upload_id}/commit", response_model=VmImagePostSchema
+)
+async def commit_image_upload(
+    vm_id: str,
+    upload_id: str,
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Complete a chunked upload once all the chunks are received and use the image
+    as the disk of the VM.
+    """
+    vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    upload = await fetch_upload(session, vm, upload_id)
+
+    if len(upload.chunks) != upload.number_of_chunks:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"{upload.number_of_chunks - len(upload.chunks)} chunks are missing",
+        )
+
+    upload_path = get_upload_path(upload)
+    digest, chunk_digests = await asyncio.to_thread(
+        hash_upload_file, upload_path, upload.chunk_size
+    )
+    # A chunk sent again after it was received, but not completely, no longer
+    # matches its checksum
+    corrupted_chunks = sorted(
+        chunk.index
+        for chunk in upload.chunks
+        if chunk_digests[chunk.index] != chunk.sha256
+    )
+    if corrupted_chunks:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Chunks do not match their checksum, upload them again: "
+            + ", ".join(str(index) for index in corrupted_chunks),
+        )
+    if upload.sha256 is not None and upload.sha256 != digest:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Image checksum mismatch: expected {upload.sha256}, got {digest}",
+        )
+
+    await image_store.add_file(upload_path, digest=digest)
+    await session.delete(upload)
+
+    vm.image = VmImage(id=uuid4().hex, filename=upload.filename, digest=digest)
+    session.add(vm.image)
+    await session.flush()
+
+    return VmImagePostSchema(
+        vm_id=vm.id,
+        filename=vm.image.filename,
+        upload_datetime=vm.image.upload_datetime,
+    )
+
+
+@router.delete(
+    "/vm/{vm_id}/image-uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT
+)
+async def delete_image_upload(
+    vm_id: str,
+    upload_id: str,
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Abort a chunked upload and delete the data received so far.
+    """
+    vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    upload = await fetch_upload(session, vm, upload_id)
+
+    get_upload_path(upload).unlink(missing_ok=True)
+    await session.delete(upload)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -1,44 +1,115 @@
+import asyncio
 import base64
+import binascii
+import datetime as dt
+import json
+import logging
+import os
 import shutil
-import tarfile
+import signal
+import time
 from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
 from uuid import uuid4
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
 
-import aiofile
-from fastapi import Depends, File, HTTPException, UploadFile, status, Query
-from sqlalchemy.orm import Session
+from fastapi import (
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from sqlalchemy import literal, select, tuple_
+from sqlalchemy.orm import Session, selectinload
 
-from authentication import get_current_user
-from models.db import get_db_session
+from authentication import get_current_user, get_streaming_user
+from models.db import (
+    async_session,
+    call_after_commit,
+    call_after_rollback,
+    get_db_session,
+)
+from models.jobs import Job, JobKind, JobStatus, fetch_job
+from models.ports import PortKind
 from models.users import User
-from models.vm import Vm, VmImage, VmState, fetch_vm
-from schemas.vm_schemas import VmSchema, VmImagePostSchema, VmStartResponseSchema
+from models.vm import ACTIVE_VM_STATES, Vm, VmImage, VmState, fetch_vm, lock_vm
+from schemas.vm_schemas import (
+    JobSchema,
+    VmBulkCreateResponseSchema,
+    VmBulkCreateSchema,
+    VmBulkResultSchema,
+    VmListSchema,
+    VmSchema,
+    VmImagePostSchema,
+    VmStartResponseSchema,
+    VmStatsSchema,
+)
 from settings import settings
-from toolkit.qemu import qemu_create_vm, QemuVmClient
+from toolkit.capacity import (
+    InsufficientCapacityError,
+    capacity_ledger,
+    lock_capacity_ledger,
+)
+from toolkit.device_profiles import DeviceProfile, device_profiles
+from toolkit.image_ingest import ImageIngestError, extract_tar_member
+from toolkit.image_store import VmDisk, image_store
+from toolkit.job_queue import JobQueue
+from toolkit.launch_digest import firmware_digest_index
+from toolkit.leader import (
+    LeaderCallError,
+    LeaderUnavailableError,
+    leader_election,
+    notify_leader,
+)
+from toolkit.multipart_stream import MultipartStreamError, iter_multipart_file
+from toolkit.placement import VmPlacement, parse_cpu_list, placement_engine
+from toolkit.ports import lease_port, release_ports, sync_port_leases
+from toolkit.process_scan import QemuProcess, scan_qemu_processes
+from toolkit.qmp_client import QmpAddress, QmpConnectionError, QmpError, qmp_manager
+from toolkit.resource_usage import RESOLUTIONS, get_vm_stats
+from toolkit.serial_console import serial_consoles
+from toolkit.startup import startup_status
+from toolkit.supervisor import QemuExit, qemu_supervisor
+from toolkit.qemu import (
+    get_qmp_socket_path,
+    pin_vm_threads,
+    qemu_create_vm,
+    wait_for_qmp,
+    QemuVmClient,
+)
 from .router import router
 
+logger = logging.getLogger(__name__)
+
 DOWNLOAD_DIR = Path(__file__).absolute().parent / "downloads"
 GUEST_OWNER_CERTIFICATE_FILES = "vm_godh.b64", "vm_session.b64"
+# Size of the end of the Qemu output reported in the error of failed launch jobs
+QEMU_ERROR_OUTPUT_SIZE = 2000
+# Maximum number of VMs reconciled concurrently at startup
+RECONCILIATION_CONCURRENCY = 64
+MAX_VM_LIST_PAGE_SIZE = 1000
+# Columns of the VMs listed without their image, loaded without the ORM
+VM_LIST_COLUMNS = [
+    getattr(Vm, field) for field in VmSchema.__fields__ if field != "image"
+]
 
 
 def get_vm_dir(vm: Vm) -> Path:
     return DOWNLOAD_DIR / vm.id
 
 
-async def write_uploaded_file(download_dir: Path, file: UploadFile) -> Path:
-    # Ensure that the output directory exists
-    download_dir.mkdir(parents=True, exist_ok=True)
-    file_path = download_dir / file.filename
-
-    async with aiofile.async_open(file_path, "wb") as f:
-        while content := await file.read(1024):
-            await f.write(content)
-
-    return file_path
-
-
-async def fetch_vm_and_check_ownership(session: Session, vm_id: str, user: User) -> Vm:
+async def fetch_vm_and_check_ownership(
+    session: Session, vm_id: str, user: User, lock: bool = False
+) -> Vm:
+    """
+    :param lock: Lock the VM until the end of the transaction, to change its state.
+    """
+    if lock:
+        await lock_vm(session, vm_id)
     vm = await fetch_vm(session, vm_id)
     if vm is None or vm.owner != user.username:
         raise HTTPException(
@@ -62,15 +133,23 @@ async def create_vm(
         gt=0,
         lt=settings.vm_max_number_of_cores,
     ),
+    device_profile: Optional[str] = Query(
+        default=None,
+        title="Device profile of the disk and network of the VM",
+    ),
     session: Session = Depends(get_db_session),
     user: User = Depends(get_current_user),
 ):
+    if device_profile is not None:
+        validate_device_profile(device_profile)
+
     vm = Vm(
         id=uuid4().hex,
         state=VmState.STOPPED,
         memory=memory,
         number_of_cores=number_of_cores,
         owner=user.username,
+        device_profile=device_profile,
     )
     session.add(vm)
     # Let the DB set the creation datetime field
@@ -78,6 +157,70 @@ async def create_vm(
     return vm
 
 
+def encode_vm_list_cursor(creation_datetime: dt.datetime, vm_id: str) -> str:
+    cursor = json.dumps([creation_datetime.isoformat(), vm_id])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_vm_list_cursor(cursor: str) -> Tuple[dt.datetime, str]:
+    try:
+        creation_datetime, vm_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return dt.datetime.fromisoformat(creation_datetime), str(vm_id)
+    except (binascii.Error, TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor"
+        )
+
+
+@router.get("/vm", response_model=VmListSchema)
+async def list_vms(
+    state: Optional[VmState] = Query(default=None, title="Only list VMs in this state"),
+    limit: int = Query(default=100, gt=0, le=MAX_VM_LIST_PAGE_SIZE),
+    cursor: Optional[str] = Query(
+        default=None, title="Cursor of the page, from the previous page"
+    ),
+    include_image: bool = Query(
+        default=False, title="Return the image of each VM, slower"
+    ),
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Lists the VMs of the user, oldest first. Pages are stable: VMs created while
+    paginating appear on the last pages.
+    """
+    if include_image:
+        select_stmt = select(Vm).options(selectinload(Vm.image))
+    else:
+        select_stmt = select(*VM_LIST_COLUMNS)
+
+    select_stmt = select_stmt.where(Vm.owner == user.username)
+    if state is not None:
+        select_stmt = select_stmt.where(Vm.state == state)
+    if cursor is not None:
+        creation_datetime, vm_id = decode_vm_list_cursor(cursor)
+        # Bound with the type of the column to compare values in the same format
+        select_stmt = select_stmt.where(
+            tuple_(Vm.creation_datetime, Vm.id)
+            > tuple_(literal(creation_datetime, Vm.creation_datetime.type), vm_id)
+        )
+    select_stmt = select_stmt.order_by(Vm.creation_datetime, Vm.id).limit(limit + 1)
+
+    result = await session.execute(select_stmt)
+    vms = result.scalars().all() if include_image else result.all()
+
+    next_cursor = None
+    if len(vms) > limit:
+        vms = vms[:limit]
+        next_cursor = encode_vm_list_cursor(vms[-1].creation_datetime, vms[-1].id)
+    page = VmListSchema(
+        vms=[VmSchema.from_orm(vm) for vm in vms], next_cursor=next_cursor
+    )
+    # Already validated, skip the validation and encoding of the response model
+    # which take most of the time of large pages
+    return Response(content=page.json(), media_type="application/json")
+
+
 @router.get("/vm/{vm_id}", response_model=VmSchema)
 async def get_vm(
     vm_id: str,
@@ -88,34 +231,107 @@ async def get_vm(
     return vm
 
 
-@router.post("/vm/{vm_id}/upload-image", response_model=VmImagePostSchema)
-async def upload_vm_image(
+@router.get("/vm/{vm_id}/stats", response_model=VmStatsSchema)
+async def get_vm_resource_usage(
     vm_id: str,
-    image_name: str,
-    vm_image_tarball: UploadFile = File(...),
+    resolution: Optional[int] = Query(
+        default=None,
+        title="Period averaged by each sample, in seconds: 300 or 3600. By default, "
+        "returns the last samples",
+    ),
+    since: Optional[float] = Query(
+        default=None, title="Only return the samples taken after this UNIX timestamp"
+    ),
     session: Session = Depends(get_db_session),
     user: User = Depends(get_current_user),
 ):
+    """
+    Return the resources used by the Qemu process of a VM over time.
+    """
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"The resolution must be one of {list(RESOLUTIONS)}",
+        )
     vm = await fetch_vm_and_check_ownership(session, vm_id, user)
 
-    vm_download_dir = get_vm_dir(vm)
-    vm_download_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        return await get_vm_stats(vm.id, resolution=resolution, since=since)
+    except (LeaderUnavailableError, LeaderCallError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
 
-    tarball_path = await write_uploaded_file(vm_download_dir, vm_image_tarball)
 
-    # TODO: determine when to extract the tarball (maybe at VM init?)
-    with tarfile.open(tarball_path) as tf:
-        tf.extract(image_name, path=vm_download_dir)
+@router.post(
+    "/vm/{vm_id}/upload-image",
+    response_model=VmImagePostSchema,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "vm_image_tarball": {"type": "string", "format": "binary"}
+                        },
+                        "required": ["vm_image_tarball"],
+                    }
+                },
+                "application/x-tar": {"schema": {"type": "string", "format": "binary"}},
+            },
+            "required": True,
+        }
+    },
+)
+async def upload_vm_image(
+    vm_id: str,
+    image_name: str,
+    request: Request,
+    user: User = Depends(get_streaming_user),
+):
+    """
+    Upload a (compressed) tarball containing the VM image. The tarball is streamed:
+    only `image_name` is extracted, directly into the image store.
+    The tarball can be sent as the `vm_image_tarball` field of a multipart form,
+    or as the raw request body.
+    """
+    # No DB connection is held while the tarball streams, it can take minutes
+    async with async_session() as session:
+        await fetch_vm_and_check_ownership(session, vm_id, user)
 
-    vm.image = VmImage(id=uuid4().hex, filename=image_name)
-    session.add(vm.image)
-    await session.flush()
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        tarball_stream = iter_multipart_file(
+            content_type, request.stream(), "vm_image_tarball"
+        )
+    else:
+        tarball_stream = request.stream()
 
-    return VmImagePostSchema(
-        vm_id=vm.id,
-        filename=vm.image.filename,
-        upload_datetime=vm.image.upload_datetime,
-    )
+    # Extract in the store directory so that adding the image to the store is a rename
+    image_path = image_store.tmp_dir / uuid4().hex
+    try:
+        extracted_image = await extract_tar_member(
+            tarball_stream, image_name, image_path
+        )
+    except (ImageIngestError, MultipartStreamError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+
+    digest = await image_store.add_file(image_path, digest=extracted_image.digest)
+
+    # The image is removed from the store if the VM was deleted in the meantime
+    async with async_session() as session:
+        async with session.begin():
+            vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+            vm.image = VmImage(id=uuid4().hex, filename=image_name, digest=digest)
+            session.add(vm.image)
+            await session.flush()
+
+            return VmImagePostSchema(
+                vm_id=vm.id,
+                filename=vm.image.filename,
+                upload_datetime=vm.image.upload_datetime,
+            )
 
 
 @router.post("/vm/{vm_id}/upload-guest-owner-certificates")
@@ -133,22 +349,52 @@ async def upload_guest_owner_certificates(
             detail=f"VM is already started. Current state: '{vm.state}'.",
         )
 
-    vm_download_dir = get_vm_dir(vm)
-    vm_download_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        await asyncio.to_thread(
+            install_guest_owner_certificates,
+            guest_owner_certificates.file,
+            get_vm_dir(vm),
+        )
+    except (BadZipFile, KeyError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid guest owner certificates archive: {e}",
+        )
+
 
-    archive_path = await write_uploaded_file(vm_download_dir, guest_owner_certificates)
+def install_guest_owner_certificates(
+    archive: Union[Path, BinaryIO], vm_dir: Path
+) -> None:
+    """
+    Extracts the guest owner certificates from a ZIP archive into the directory of
+    a VM.
 
-    with ZipFile(archive_path) as zip_file:
-        zip_file.extractall(path=vm_download_dir, members=GUEST_OWNER_CERTIFICATE_FILES)
+    :raises BadZipFile: The archive is not a ZIP file.
+    :raises KeyError: A certificate is missing from the archive.
+    """
+    # Each upload extracts in its own directory and moves the complete files to the
+    # directory of the VM: concurrent uploads and launches, in any worker, never
+    # read a partially written certificate
+    upload_dir = vm_dir / f".upload-{uuid4().hex}"
+    upload_dir.mkdir(parents=True)
 
-    # Convert to base64 for later use with Qemu
-    for filename in GUEST_OWNER_CERTIFICATE_FILES:
-        bin_file = vm_download_dir / filename
-        b64_filename = bin_file.stem + "-b64.txt"
-        b64_file = vm_download_dir / b64_filename
-        with bin_file.open("rb") as bin_fh, b64_file.open("wb") as b64_fh:
-            base64_content = base64.b64encode(bin_fh.read())
-            b64_fh.write(base64_content)
+    try:
+        with ZipFile(archive) as zip_file:
+            zip_file.extractall(path=upload_dir, members=GUEST_OWNER_CERTIFICATE_FILES)
+
+        # Convert to base64 for later use with Qemu
+        for filename in GUEST_OWNER_CERTIFICATE_FILES:
+            bin_file = upload_dir / filename
+            b64_filename = bin_file.stem + "-b64.txt"
+            b64_file = upload_dir / b64_filename
+            with bin_file.open("rb") as bin_fh, b64_file.open("wb") as b64_fh:
+                base64_content = base64.b64encode(bin_fh.read())
+                b64_fh.write(base64_content)
+
+            os.replace(bin_file, vm_dir / filename)
+            os.replace(b64_file, vm_dir / b64_filename)
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
 
 
 def validate_sev_policy(sev_policy_str: str) -> None:
@@ -161,14 +407,393 @@ def validate_sev_policy(sev_policy_str: str) -> None:
         )
 
 
-@router.post("/vm/{vm_id}/start", response_model=VmSchema)
+async def update_job(job_id: str, **values) -> None:
+    async with async_session() as session:
+        async with session.begin():
+            job = await fetch_job(session, job_id)
+            for key, value in values.items():
+                setattr(job, key, value)
+
+
+async def pin_vm(vm: Vm, placement: VmPlacement) -> None:
+    try:
+        emulator_cpus = []
+        if placement.numa_node is not None:
+            emulator_cpus = placement_engine.nodes[placement.numa_node].cpus
+        await pin_vm_threads(vm, placement, emulator_cpus)
+    except Exception:
+        # The VM works without pinning, only slower
+        logger.warning("Could not pin the threads of VM %s", vm.id, exc_info=True)
+    finally:
+        placement_engine.mark_launched(vm.id)
+
+
+def lease_qmp_address(session: Session, vm: Vm) -> QmpAddress:
+    """
+    Serves QMP on a UNIX socket in the directory of the VM when possible, which
+    does not use a TCP port of the host.
+    """
+    socket_path = get_qmp_socket_path(get_vm_dir(vm))
+    if socket_path is not None:
+        return str(socket_path)
+    return "localhost", lease_port(session, vm.id, PortKind.QMP)
+
+
+async def claim_job(job_id: str) -> bool:
+    """
+    Marks a queued job as running. Returns False if the job is not queued anymore,
+    ex: if a previous leader ran it.
+    """
+    async with async_session() as session:
+        async with session.begin():
+            job = await fetch_job(session, job_id)
+            if job is None or job.status != JobStatus.QUEUED:
+                return False
+            job.status = JobStatus.RUNNING
+            job.step = "preparing_disk"
+            job.start_datetime = dt.datetime.utcnow()
+    return True
+
+
+async def launch_vm(job_id: str) -> None:
+    """
+    Creates the Qemu process of a VM. Runs in the launch queue of the leader.
+    """
+    if not await claim_job(job_id):
+        return
+
+    try:
+        async with async_session() as session:
+            job = await fetch_job(session, job_id)
+            vm = await fetch_vm(session, job.vm_id)
+            vm_dir = get_vm_dir(vm)
+            image = vm.image
+
+        # For demo purposes: if the user did not upload an image, use the default image
+        if image is None:
+            default_image = settings.default_image_path
+            digest = await image_store.import_file(default_image)
+            image = VmImage(id=uuid4().hex, filename=default_image.name, digest=digest)
+
+        if image.digest is None:
+            # Image uploaded before the image store was introduced
+            disk = VmDisk(path=vm_dir / image.filename, format="raw")
+        else:
+            disk = await image_store.get_overlay(image.digest, vm_dir)
+
+        # Recorded to compute the expected measurement of the VM
+        firmware_digest = await firmware_digest_index.add_firmware(settings.ovmf_path)
+        await update_job(job_id, step="launching")
+
+        async with async_session() as session:
+            async with session.begin():
+                job = await fetch_job(session, job_id)
+                vm = await fetch_vm(session, job.vm_id)
+                if vm.image is None:
+                    vm.image = image
+                vm.firmware_digest = firmware_digest
+                placement = placement_engine.place(
+                    vm.id, memory=vm.memory, cores=vm.number_of_cores
+                )
+                profile = get_vm_device_profile(vm)
+                ssh_port = None
+                if profile.forwards_ssh_port:
+                    ssh_port = lease_port(session, vm.id, PortKind.SSH)
+                qmp_address = lease_qmp_address(session, vm)
+                await qemu_create_vm(
+                    vm=vm,
+                    working_dir=vm_dir,
+                    ovmf_path=settings.ovmf_path,
+                    disk=disk,
+                    placement=placement,
+                    profile=profile,
+                    ssh_port=ssh_port,
+                    qmp_address=qmp_address,
+                )
+                spawn_time = time.perf_counter()
+                job.step = "waiting_for_qmp"
+
+        # The VM can only be measured once Qemu accepts QMP connections
+        await wait_for_qmp(vm, spawn_time)
+        # Before the secret is injected and the guest resumes, so that it is
+        # read from the first byte
+        await serial_consoles.attach(vm.id, vm_dir)
+        await pin_vm(vm, placement)
+
+        await update_job(
+            job_id,
+            status=JobStatus.SUCCEEDED,
+            step=None,
+            end_datetime=dt.datetime.utcnow(),
+        )
+
+    except Exception as e:
+        logger.exception("Could not launch the VM of job %s", job_id)
+        async with async_session() as session:
+            async with session.begin():
+                job = await fetch_job(session, job_id)
+                vm = await fetch_vm(session, job.vm_id)
+                # Qemu started but is not usable
+                qemu_supervisor.send_signal(vm.id, signal.SIGKILL)
+
+                error = str(e)
+                if qemu_stderr := qemu_supervisor.get_stderr(vm.id):
+                    error += f"\nQemu output: {qemu_stderr[-QEMU_ERROR_OUTPUT_SIZE:]}"
+                job.status = JobStatus.FAILED
+                job.error = error
+                job.end_datetime = dt.datetime.utcnow()
+                vm.state = VmState.STOPPED
+                await release_ports(session, vm.id)
+        capacity_ledger.release(vm.id)
+        placement_engine.release(vm.id)
+
+
+launch_queue = JobQueue("launch", concurrency=settings.launch_queue_concurrency)
+
+
+def submit_launch(job_id: str) -> None:
+    """
+    Queues a launch job in the launch queue of the leader.
+    """
+    if leader_election.is_leader:
+        launch_queue.submit(job_id)
+    else:
+        # Found in the database by the leader if it cannot be notified
+        notify_leader("submit_launch", job_id=job_id)
+
+
+async def poll_queued_jobs() -> None:
+    """
+    Queues the launch jobs that the leader was not notified of, ex: jobs created
+    by a worker while another worker was taking over as leader.
+    """
+    select_stmt = (
+        select(Job.id)
+        .where(Job.status == JobStatus.QUEUED)
+        .order_by(Job.creation_datetime)
+    )
+    while True:
+        try:
+            async with async_session() as session:
+                job_ids = (await session.execute(select_stmt)).scalars().all()
+        except Exception:
+            logger.exception("Could not list the queued jobs")
+        else:
+            for job_id in job_ids:
+                launch_queue.submit(job_id)
+        await asyncio.sleep(settings.launch_queue_poll_interval)
+
+
+async def handle_qemu_exit(qemu_exit: QemuExit) -> None:
+    """
+    Marks the VM as stopped and releases its resources when its Qemu process exits,
+    ex: when the guest shuts down or Qemu crashes.
+    """
+    async with async_session() as session:
+        async with session.begin():
+            vm = await fetch_vm(session, qemu_exit.vm_id)
+            if vm is None or vm.pid != qemu_exit.pid:
+                # The VM was already restarted
+                return
+
+            vm.state = VmState.STOPPED
+            vm.pid = None
+            vm.qmp_port = None
+            vm.qmp_socket_path = None
+            vm.ssh_port = None
+            vm.stop_datetime = qemu_exit.datetime
+            vm.exit_status = qemu_exit.returncode
+            await release_ports(session, vm.id)
+
+    await qmp_manager.close_connection(qemu_exit.vm_id)
+    capacity_ledger.release(qemu_exit.vm_id)
+    placement_engine.release(qemu_exit.vm_id)
+
+
+async def load_host_resources() -> None:
+    """
+    Reserves the resources of the VMs that were started before the API.
+    """
+    async with async_session() as session:
+        async with session.begin():
+            select_stmt = select(Vm).where(Vm.state.in_(ACTIVE_VM_STATES))
+            vms = (await session.execute(select_stmt)).scalars().all()
+            await sync_port_leases(session, vms)
+
+    capacity_ledger.load((vm.id, vm.memory, vm.number_of_cores) for vm in vms)
+    for vm in vms:
+        placement = VmPlacement(
+            numa_node=vm.numa_node,
+            host_cpus=parse_cpu_list(vm.host_cpus or ""),
+            hugepage_size=vm.hugepage_size,
+        )
+        placement_engine.load(vm.id, placement, memory=vm.memory)
+
+
+def find_vm_process(
+    vm: Vm,
+    processes: Dict[int, QemuProcess],
+    processes_by_vm_id: Dict[str, QemuProcess],
+) -> Optional[QemuProcess]:
+    """
+    Finds the Qemu process of a VM, by PID and command line. The PID of a process
+    that exited may have been reused by another Qemu process.
+    """
+    process = processes.get(vm.pid)
+    if process is not None:
+        if process.vm_id == vm.id:
+            return process
+        # Started without a VM name, by an old version of the API
+        if process.vm_id is None and process.qmp_port == vm.qmp_port:
+            return process
+
+    return processes_by_vm_id.get(vm.id)
+
+
+async def reconcile_vm(vm: Vm, process: Optional[QemuProcess]) -> None:
+    if process is None:
+        logger.info("VM %s is not running anymore, marking it as stopped", vm.id)
+        vm.state = VmState.STOPPED
+        vm.pid = None
+        vm.qmp_port = None
+        vm.qmp_socket_path = None
+        vm.ssh_port = None
+        vm.stop_datetime = dt.datetime.utcnow()
+        return
+
+    vm.pid = process.pid
+    vm.qmp_port = process.qmp_port or vm.qmp_port
+    vm.qmp_socket_path = process.qmp_socket_path or vm.qmp_socket_path
+    qemu_supervisor.adopt(vm.id, vm.pid)
+    await serial_consoles.attach(vm.id, get_vm_dir(vm))
+
+    try:
+        qemu_status = await QemuVmClient(vm).query_status()
+    except (QmpError, QmpConnectionError, ValueError) as e:
+        logger.warning("Could not reconnect to the QMP socket of VM %s: %s", vm.id, e)
+        return
+
+    # The secret was injected but the API stopped before recording it
+    if vm.state == VmState.STARTED and qemu_status == "running":
+        vm.state = VmState.RUNNING
+
+
+async def reconcile_vms() -> None:
+    """
+    Re-adopts the Qemu processes of the VMs started by a previous instance of the
+    API, and marks the VMs whose process is gone as stopped.
+    """
+    processes = await asyncio.to_thread(scan_qemu_processes)
+    processes_by_vm_id = {
+        process.vm_id: process
+        for process in processes.values()
+        if process.vm_id is not None
+    }
+
+    async with async_session() as session:
+        async with session.begin():
+            select_stmt = select(Vm).where(
+                Vm.state.in_((VmState.STARTED, VmState.RUNNING))
+            )
+            vms = (await session.execute(select_stmt)).scalars().all()
+            startup_status.vms_to_reconcile = len(vms)
+
+            # Bounds the number of QMP connections opened at once
+            semaphore = asyncio.Semaphore(RECONCILIATION_CONCURRENCY)
+
+            async def reconcile(vm: Vm) -> QemuProcess:
+                process = find_vm_process(vm, processes, processes_by_vm_id)
+                async with semaphore:
+                    await reconcile_vm(vm, process)
+                startup_status.vms_reconciled += 1
+                return process
+
+            adopted_processes = await asyncio.gather(*(reconcile(vm) for vm in vms))
+
+    adopted_pids = {process.pid for process in adopted_processes if process}
+    for process in processes.values():
+        if process.pid not in adopted_pids:
+            logger.warning(
+                "Qemu process %d (VM %s) is not managed by the API",
+                process.pid,
+                process.vm_id,
+            )
+
+    logger.info("Reconciled %d VMs, %d running", len(vms), len(adopted_pids))
+
+
+async def finish_startup() -> None:
+    """
+    Reconciles the VMs with the processes running on the host, then starts
+    processing launches. Runs in the leader, once elected. The VM endpoints are
+    unavailable until this completes.
+    """
+    startup_status.reset()
+    try:
+        await fail_interrupted_jobs()
+        await reconcile_vms()
+        await load_host_resources()
+    except Exception as e:
+        logger.exception("Startup failed")
+        startup_status.error = str(e)
+        raise
+
+    launch_queue.start(launch_vm)
+    startup_status.set_ready()
+    logger.info("API ready after %.1fs", startup_status.duration)
+
+
+async def fail_interrupted_jobs() -> None:
+    """
+    Marks the jobs interrupted by a restart of the API, or of the leader, as
+    failed. Queued jobs did not start yet and are queued again.
+    """
+    async with async_session() as session:
+        async with session.begin():
+            select_stmt = select(Job).where(Job.status == JobStatus.RUNNING)
+            for job in (await session.execute(select_stmt)).scalars():
+                job.status = JobStatus.FAILED
+                job.error = "Interrupted by a restart of the API"
+                job.end_datetime = dt.datetime.utcnow()
+
+                vm = await fetch_vm(session, job.vm_id)
+                if vm.state == VmState.STARTING:
+                    vm.state = VmState.STOPPED
+
+
+def validate_device_profile(device_profile: str) -> None:
+    if device_profile not in device_profiles:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown device profile '{device_profile}'. "
+            f"Available profiles: {', '.join(device_profiles)}",
+        )
+
+
+def get_vm_device_profile(vm: Vm) -> DeviceProfile:
+    return device_profiles[vm.device_profile or settings.vm_default_device_profile]
+
+
+@router.post(
+    "/vm/{vm_id}/start",
+    response_model=JobSchema,
+    status_code=status.HTTP_202_ACCEPTED,
+)
 async def start_vm(
     vm_id: str,
     sev_policy: str = Query(..., title="SEV policy (hexadecimal format)"),
+    device_profile: Optional[str] = Query(
+        default=None,
+        title="Device profile of the disk and network, overrides the profile set at creation",
+    ),
     session: Session = Depends(get_db_session),
     user: User = Depends(get_current_user),
 ):
-    vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    """
+    Queue the launch of the VM. The progress of the launch is reported by
+    the returned job and by the state of the VM.
+    """
+    vm = await fetch_vm_and_check_ownership(session, vm_id, user, lock=True)
 
     if vm.state != VmState.STOPPED:
         raise HTTPException(
@@ -177,23 +802,177 @@ async def start_vm(
         )
 
     validate_sev_policy(sev_policy)
+    if device_profile is not None:
+        validate_device_profile(device_profile)
+        vm.device_profile = device_profile
+
+    try:
+        job = await queue_vm_launch(session, vm, sev_policy)
+    except InsufficientCapacityError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e)
+        )
+    await session.flush()
+
+    return job
+
+
+async def queue_vm_launch(session: Session, vm: Vm, sev_policy: str) -> Job:
+    """
+    Reserves the resources of a stopped VM and creates its launch job. The job is
+    queued once the transaction is committed. The VM must be locked, or created
+    in the transaction.
+
+    :raises InsufficientCapacityError: The host does not have enough resources left.
+    """
+    await lock_capacity_ledger(session)
+    capacity_ledger.reserve(vm.id, memory=vm.memory, cores=vm.number_of_cores)
+    call_after_rollback(session, lambda: capacity_ledger.release(vm.id))
+
     vm.sev_policy = sev_policy
+    vm.state = VmState.STARTING
+
+    job = Job(
+        id=uuid4().hex,
+        kind=JobKind.LAUNCH,
+        vm_id=vm.id,
+        owner=vm.owner,
+        status=JobStatus.QUEUED,
+    )
+    session.add(job)
+
+    # The launch must only start once the job is visible to other sessions
+    call_after_commit(session, lambda: submit_launch(job.id))
 
-    vm_dir = get_vm_dir(vm)
+    return job
 
-    # For demo purposes: if the user did not upload an image, copy the default image
-    if vm.image is None:
-        default_image = settings.default_image_path
-        shutil.copy2(default_image, vm_dir / default_image.name)
-        vm.image = VmImage(id=uuid4().hex, filename=default_image.name)
 
-    qemu_create_vm(
-        vm=vm,
-        working_dir=vm_dir,
-        ovmf_path=settings.ovmf_path,
+def copy_guest_owner_certificates(source_dir: Path, vm_dirs: List[Path]) -> None:
+    for vm_dir in vm_dirs:
+        vm_dir.mkdir(parents=True, exist_ok=True)
+        for filename in GUEST_OWNER_CERTIFICATE_FILES:
+            shutil.copyfile(source_dir / filename, vm_dir / filename)
+
+
+def remove_vm_dirs(vm_dirs: List[Path]) -> None:
+    for vm_dir in vm_dirs:
+        shutil.rmtree(vm_dir, ignore_errors=True)
+
+
+@router.post("/bulk", response_model=VmBulkCreateResponseSchema)
+async def bulk_create_vms(
+    bulk_create: VmBulkCreateSchema,
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Create several identical VMs in one transaction, sharing the image and
+    optionally the guest owner certificates of a template VM, and start them if
+    a SEV policy is given. The launches go through the launch queue like single
+    starts. A VM that cannot be started, ex: by lack of capacity, is still created
+    and its result reports the error.
+    """
+    if bulk_create.device_profile is not None:
+        validate_device_profile(bulk_create.device_profile)
+    if bulk_create.sev_policy is not None:
+        validate_sev_policy(bulk_create.sev_policy)
+        if not bulk_create.share_certificates:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Starting the VMs requires the certificates of a template VM",
+            )
+
+    template_image = None
+    certificates_dir = None
+    if bulk_create.template_vm_id is not None:
+        template_vm = await fetch_vm_and_check_ownership(
+            session, bulk_create.template_vm_id, user
+        )
+        template_image = template_vm.image
+        if template_image is not None and template_image.digest is None:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="The image of the template VM is not in the image store "
+                "and cannot be shared",
+            )
+
+        if bulk_create.share_certificates:
+            certificates_dir = get_vm_dir(template_vm)
+            if not all(
+                (certificates_dir / filename).is_file()
+                for filename in GUEST_OWNER_CERTIFICATE_FILES
+            ):
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="The template VM does not have guest owner certificates",
+                )
+    elif bulk_create.share_certificates:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Sharing certificates requires a template VM",
+        )
+
+    vms = []
+    for _ in range(bulk_create.number_of_vms):
+        vm = Vm(
+            id=uuid4().hex,
+            state=VmState.STOPPED,
+            memory=bulk_create.memory,
+            number_of_cores=bulk_create.number_of_cores,
+            owner=user.username,
+            device_profile=bulk_create.device_profile,
+        )
+        if template_image is not None:
+            # Images are content-addressed, the VMs share the same file
+            vm.image = VmImage(
+                id=uuid4().hex,
+                filename=template_image.filename,
+                digest=template_image.digest,
+            )
+        vms.append(vm)
+    session.add_all(vms)
+    # Let the DB set the creation datetime fields
+    await session.flush()
+
+    if certificates_dir is not None:
+        vm_dirs = [get_vm_dir(vm) for vm in vms]
+        call_after_rollback(session, lambda: remove_vm_dirs(vm_dirs))
+        await asyncio.to_thread(copy_guest_owner_certificates, certificates_dir, vm_dirs)
+
+    results = []
+    for vm in vms:
+        job = error = None
+        if bulk_create.sev_policy is not None:
+            try:
+                job = await queue_vm_launch(session, vm, bulk_create.sev_policy)
+            except InsufficientCapacityError as e:
+                error = str(e)
+        results.append((vm, job, error))
+    await session.flush()
+
+    return VmBulkCreateResponseSchema(
+        results=[
+            VmBulkResultSchema(
+                vm=VmSchema.from_orm(vm),
+                job=JobSchema.from_orm(job) if job is not None else None,
+                error=error,
+            )
+            for vm, job, error in results
+        ]
     )
 
-    return vm
+
+@router.get("/jobs/{job_id}", response_model=JobSchema)
+async def get_job(
+    job_id: str,
+    session: Session = Depends(get_db_session),
+    user: User = Depends(get_current_user),
+):
+    job = await fetch_job(session, job_id)
+    if job is None or job.owner != user.username:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+
+    return job
 
 
 @router.get("/vm/{vm_id}/sev/measure", response_model=VmStartResponseSchema)
@@ -209,11 +988,34 @@ async def get_vm_measure(
             detail=f"VM must be started and waiting for launch. Current state: '{vm.state}'.",
         )
 
-    with QemuVmClient(vm) as vm_client:
-        vm_sev_info = vm_client.query_sev_info()
-        launch_measure = vm_client.query_launch_measure()
+    return await measure_vm(vm)
+
 
-    return {"vm": vm, "sev_info": vm_sev_info, "launch_measure": launch_measure}
+async def measure_vm(vm: Vm) -> Dict[str, Any]:
+    """
+    Returns the SEV information and the launch measure of a started VM, with the
+    measure expected by the guest owner.
+    """
+    vm_client = QemuVmClient(vm)
+    vm_sev_info, launch_measure = await asyncio.gather(
+        vm_client.query_sev_info(), vm_client.query_launch_measure()
+    )
+
+    expected_launch_measure = firmware_digest_index.get_expected_launch_measure(
+        vm.firmware_digest,
+        api_major=vm_sev_info.api_major,
+        api_minor=vm_sev_info.api_minor,
+        build=vm_sev_info.build_id,
+        policy=vm_sev_info.policy,
+        launch_measure=launch_measure,
+    )
+
+    return {
+        "vm": vm,
+        "sev_info": vm_sev_info,
+        "launch_measure": launch_measure,
+        "expected_launch_measure": expected_launch_measure,
+    }
 
 
 @router.post("/vm/{vm_id}/sev/inject-secret", response_model=VmSchema)
@@ -224,7 +1026,7 @@ async def inject_vm_secrets(
     session: Session = Depends(get_db_session),
     user: User = Depends(get_current_user),
 ):
-    vm = await fetch_vm_and_check_ownership(session, vm_id, user)
+    vm = await fetch_vm_and_check_ownership(session, vm_id, user, lock=True)
 
     if vm.state != VmState.STARTED:
         raise HTTPException(
@@ -232,9 +1034,9 @@ async def inject_vm_secrets(
             detail=f"Cannot inject secret in a VM in state '{vm.state}'.",
         )
 
-    with QemuVmClient(vm) as vm_client:
-        vm_client.inject_secret(packet_header, secret)
-        vm_client.continue_execution()
+    vm_client = QemuVmClient(vm)
+    await vm_client.inject_secret(packet_header, secret)
+    await vm_client.continue_execution()
 
     vm.state = VmState.RUNNING
     return vm
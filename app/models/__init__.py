@@ -1,4 +1,6 @@
 from .db import Base
+from .jobs import *
 from .platform import *
+from .ports import *
 from .users import *
 from .vm import *
@@ -1,15 +1,64 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import time
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
-from app.toolkit.db_connection import get_db_url
+from app.toolkit.db_connection import create_db_engine
+from settings import settings
+from toolkit.metrics import DB_QUERY_DURATION_BY_OPERATION
 
 
-engine = create_async_engine(get_db_url(), future=True, echo=True)
+engine = create_db_engine(echo=settings.db_echo)
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
 
 
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_start_time = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def record_query_duration(conn, cursor, statement, parameters, context, executemany):
+    if context.isinsert:
+        operation = "insert"
+    elif context.isupdate:
+        operation = "update"
+    elif context.isdelete:
+        operation = "delete"
+    else:
+        operation = "select"
+    DB_QUERY_DURATION_BY_OPERATION[operation].observe(
+        time.perf_counter() - context.query_start_time
+    )
+
+
 async def get_db_session():
     async with async_session() as session:
         async with session.begin():
             yield session
             await session.commit()
+
+
+def call_after_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """
+    Calls `callback` once the current transaction of the session is committed,
+    ex: to hand over a new DB row to a background task.
+    """
+    event.listen(
+        session.sync_session, "after_commit", lambda _session: callback(), once=True
+    )
+
+
+def call_after_rollback(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """
+    Calls `callback` if the current transaction of the session is rolled back,
+    ex: to undo in-memory changes made along with the transaction.
+    """
+    event.listen(
+        session.sync_session,
+        "after_soft_rollback",
+        lambda _session, _previous_transaction: callback(),
+        once=True,
+    )
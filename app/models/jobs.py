@@ -0,0 +1,50 @@
+from enum import Enum
+from typing import Optional
+
+from sqlalchemy import Column, DateTime, ForeignKey, Index, String, func, select
+from sqlalchemy.orm import Session
+from sqlalchemy_utils.types import ChoiceType
+
+from .db import Base
+
+
+class JobKind(str, Enum):
+    LAUNCH = "launch"
+
+
+class JobStatus(str, Enum):
+    # The job is waiting for a slot in its queue
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class Job(Base):
+    """
+    Background operation on a VM, ex: launching the Qemu process.
+    """
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Queued jobs, polled by the leader
+        Index("ix_jobs_status_creation_datetime", "status", "creation_datetime"),
+    )
+    __mapper_args__ = {"eager_defaults": True}
+
+    id = Column(String, primary_key=True)
+    kind = Column(ChoiceType(JobKind), nullable=False)
+    vm_id = Column(ForeignKey("vms.id"), nullable=False)
+    owner = Column(String, nullable=False)
+    status = Column(ChoiceType(JobStatus), nullable=False)
+    # Current step of the job, for progress reporting
+    step = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    creation_datetime = Column(DateTime, nullable=False, server_default=func.now())
+    start_datetime = Column(DateTime, nullable=True)
+    end_datetime = Column(DateTime, nullable=True)
+
+
+async def fetch_job(session: Session, job_id: str) -> Optional[Job]:
+    jobs = (await session.execute(select(Job).where(Job.id == job_id))).one_or_none()
+    return jobs[0] if jobs is not None else None
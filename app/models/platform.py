@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, DateTime, Integer
 
 from .db import Base
 
@@ -12,3 +12,5 @@ class FirmwareInfo(Base):
     owner = Column(Integer, nullable=False)
     config = Column(Integer, nullable=False)
     build = Column(Integer, nullable=False)
+    # Last time the status of the platform was read with sevctl
+    update_datetime = Column(DateTime, nullable=True)
@@ -0,0 +1,26 @@
+from enum import Enum
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, func
+from sqlalchemy_utils.types import ChoiceType
+
+from .db import Base
+
+
+class PortKind(str, Enum):
+    # Host port forwarded to the SSH port of the guest
+    SSH = "ssh"
+    # QMP socket of Qemu, when QMP is served over TCP
+    QMP = "qmp"
+
+
+class PortLease(Base):
+    """
+    Host port reserved for a VM until it stops.
+    """
+
+    __tablename__ = "port_leases"
+
+    port = Column(Integer, primary_key=True)
+    kind = Column(ChoiceType(PortKind), nullable=False)
+    vm_id = Column(ForeignKey("vms.id"), nullable=False, index=True)
+    creation_datetime = Column(DateTime, nullable=False, server_default=func.now())
@@ -1,7 +1,19 @@
 from enum import Enum
 from typing import Optional
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, func, select
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import relationship, Session, selectinload
 from sqlalchemy_utils.types import ChoiceType
 
@@ -11,14 +23,31 @@ from .db import Base
 class VmState(str, Enum):
     # The VM was created but not yet started
     STOPPED = "stopped"
+    # The VM is waiting in the launch queue or its Qemu process is being created
+    STARTING = "starting"
     # The VM was created in Qemu but still needs to go through the SEV launch process
     STARTED = "started"
     # The VM is running and can be used by the user
     RUNNING = "running"
 
 
+# States in which a VM uses host resources
+ACTIVE_VM_STATES = (VmState.STARTING, VmState.STARTED, VmState.RUNNING)
+
+
 class Vm(Base):
     __tablename__ = "vms"
+    __table_args__ = (
+        # Listing of the VMs of a user, paginated on (creation_datetime, id)
+        Index("ix_vms_owner_creation_datetime", "owner", "creation_datetime", "id"),
+        Index(
+            "ix_vms_owner_state_creation_datetime",
+            "owner",
+            "state",
+            "creation_datetime",
+            "id",
+        ),
+    )
     __mapper_args__ = {"eager_defaults": True}
 
     id = Column(String, primary_key=True)
@@ -30,8 +59,30 @@ class Vm(Base):
     sev_policy = Column(Integer, nullable=True)
     ssh_port = Column(Integer, nullable=True)
     qmp_port = Column(Integer, nullable=True)
+    # Set instead of the QMP port when Qemu serves QMP on a UNIX socket
+    qmp_socket_path = Column(String, nullable=True)
     pid = Column(Integer, nullable=True)
-    creation_datetime = Column(DateTime, nullable=False, server_default=func.now())
+    # Placement on the host: NUMA node, host CPUs of the vCPUs (ex: "4,5") and
+    # size of the hugepages backing the memory
+    numa_node = Column(Integer, nullable=True)
+    host_cpus = Column(String, nullable=True)
+    hugepage_size = Column(String, nullable=True)
+    # Device profile of the disk and network, uses the default profile if not set
+    device_profile = Column(String, nullable=True)
+    # SQLite stores CURRENT_TIMESTAMP without microseconds, compare it with values
+    # in the same format when paginating
+    creation_datetime = Column(
+        DateTime().with_variant(sqlite.DATETIME(truncate_microseconds=True), "sqlite"),
+        nullable=False,
+        server_default=func.now(),
+    )
+    # Start and exit of the last Qemu process of the VM
+    start_datetime = Column(DateTime, nullable=True)
+    stop_datetime = Column(DateTime, nullable=True)
+    # Exit code of the last Qemu process, negative if it was killed by a signal
+    exit_status = Column(Integer, nullable=True)
+    # SHA-256 of the firmware loaded by the last Qemu process
+    firmware_digest = Column(String, nullable=True)
 
     image = relationship("VmImage", back_populates="vm", uselist=False)
 
@@ -42,11 +93,63 @@ class VmImage(Base):
 
     id = Column(String, primary_key=True)
     filename = Column(String, nullable=False)
+    # SHA256 of the image in the image store
+    digest = Column(String, nullable=True)
     upload_datetime = Column(DateTime, nullable=False, server_default=func.now())
 
     vm = relationship(Vm, back_populates="image")
 
 
+class ImageUpload(Base):
+    """
+    Chunked upload session of a VM image.
+    """
+
+    __tablename__ = "image_uploads"
+    __mapper_args__ = {"eager_defaults": True}
+
+    id = Column(String, primary_key=True)
+    vm_id = Column(ForeignKey("vms.id"), nullable=False)
+    filename = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    # Expected SHA256 of the complete image, if provided by the user
+    sha256 = Column(String, nullable=True)
+    creation_datetime = Column(DateTime, nullable=False, server_default=func.now())
+
+    chunks = relationship(
+        "ImageUploadChunk", cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    @property
+    def number_of_chunks(self) -> int:
+        return -(-self.size // self.chunk_size)
+
+
+class ImageUploadChunk(Base):
+    __tablename__ = "image_upload_chunks"
+
+    upload_id = Column(
+        ForeignKey("image_uploads.id", ondelete="CASCADE"), primary_key=True
+    )
+    index = Column(Integer, primary_key=True)
+    sha256 = Column(String, nullable=False)
+
+
+async def lock_vm(session: Session, vm_id: str) -> None:
+    """
+    Locks a VM until the end of the transaction, before reading its state: requests
+    on the same VM, in any worker, change its state one after the other.
+    """
+    # A write is the only lock of SQLite, and locks the row with PostgreSQL
+    await session.execute(
+        update(Vm)
+        .where(Vm.id == vm_id)
+        .values(state=Vm.state)
+        .execution_options(synchronize_session=False)
+    )
+
+
 async def fetch_vm(session: Session, vm_id: str) -> Optional[Vm]:
     select_stmt = select(Vm).where(Vm.id == vm_id).options(selectinload(Vm.image))
     vms = (await session.execute(select_stmt)).one_or_none()
@@ -0,0 +1,12 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class StartupStatusSchema(BaseModel):
+    ready: bool
+    vms_to_reconcile: int
+    vms_reconciled: int
+    # Time spent starting up, in seconds
+    duration: float
+    error: Optional[str]
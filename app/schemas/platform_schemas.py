@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 from pydantic import BaseModel
 
 
@@ -8,3 +10,61 @@ class FirmwareInfoSchema(BaseModel):
     api_major: int
     api_minor: int
     build: int
+    # Time since the information was read from the platform, in seconds
+    cache_age: float
+
+
+class ImageStoreStatsSchema(BaseModel):
+    images: int
+    size: int
+    hits: int
+    misses: int
+    hit_rate: float
+    overlays: int
+    bytes_saved: int
+
+
+class CapacitySchema(BaseModel):
+    total_memory: int
+    total_cores: int
+    allocatable_memory: int
+    allocatable_cores: int
+    committed_memory: int
+    committed_cores: int
+    available_memory: int
+    available_cores: int
+    number_of_vms: int
+
+
+class NodeUsageSampleSchema(BaseModel):
+    timestamp: float
+    # Totals of the Qemu processes of the VMs, see VmUsageSampleSchema
+    cpu: Optional[float]
+    memory: Optional[float]
+    swap: Optional[float]
+    read_rate: Optional[float]
+    write_rate: Optional[float]
+    # Number of VMs sampled
+    vms: Optional[float]
+
+
+class NodeStatsSchema(BaseModel):
+    # Interval between the samples, in seconds
+    resolution: float
+    # CPU time spent by the last sampling pass, in seconds
+    sampling_duration: float
+    samples: List[NodeUsageSampleSchema]
+
+
+class DeviceProfileSchema(BaseModel):
+    class Config:
+        orm_mode = True
+
+    name: str
+    disk_bus: str
+    iothreads: int
+    disk_cache: Optional[str]
+    disk_aio: Optional[str]
+    network_backend: str
+    network_queues: int
+    vhost: bool
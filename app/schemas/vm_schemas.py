@@ -1,7 +1,9 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import datetime as dt
-from typing import Optional
+from typing import List, Optional
+from models.jobs import JobKind, JobStatus
 from models.vm import VmState
+from settings import settings
 
 
 class VmImageSchema(BaseModel):
@@ -18,6 +20,17 @@ class VmImagePostSchema(BaseModel):
     upload_datetime: dt.datetime
 
 
+class ImageUploadSchema(BaseModel):
+    id: str
+    vm_id: str
+    filename: str
+    size: int
+    chunk_size: int
+    number_of_chunks: int
+    missing_chunks: List[int]
+    creation_datetime: dt.datetime
+
+
 class VmSchema(BaseModel):
     class Config:
         orm_mode = True
@@ -30,6 +43,20 @@ class VmSchema(BaseModel):
     creation_datetime: dt.datetime
     image: Optional[VmImageSchema]
     ssh_port: Optional[int]
+    numa_node: Optional[int]
+    host_cpus: Optional[str]
+    hugepage_size: Optional[str]
+    device_profile: Optional[str]
+    start_datetime: Optional[dt.datetime]
+    stop_datetime: Optional[dt.datetime]
+    exit_status: Optional[int]
+    firmware_digest: Optional[str]
+
+
+class VmListSchema(BaseModel):
+    vms: List[VmSchema]
+    # Pass as `cursor` to get the next page, None on the last page
+    next_cursor: Optional[str]
 
 
 class VmSevInfoSchema(BaseModel):
@@ -39,7 +66,137 @@ class VmSevInfoSchema(BaseModel):
     policy: str
 
 
+class ExpectedLaunchMeasureSchema(BaseModel):
+    # Expected launch digest (GCTX.LD), in hexadecimal
+    launch_digest: str
+    # Data authenticated by the launch measure, in base64: the launch measure must be
+    # the HMAC-SHA256 of these bytes with the TIK of the guest owner
+    measured_data: str
+
+
 class VmStartResponseSchema(BaseModel):
     vm: VmSchema
     sev_info: VmSevInfoSchema
     launch_measure: str
+    # Not computed for SEV-ES policies, or if the firmware of the VM is not known
+    expected_launch_measure: Optional[ExpectedLaunchMeasureSchema]
+
+
+class VmUsageSampleSchema(BaseModel):
+    timestamp: float
+    # CPU cores used by the Qemu process
+    cpu: Optional[float]
+    # Resident memory and swap of the Qemu process, in bytes
+    memory: Optional[float]
+    swap: Optional[float]
+    # Disk reads and writes of the Qemu process, in bytes per second
+    read_rate: Optional[float]
+    write_rate: Optional[float]
+    # CPU cores used by each vCPU, None if its thread is not known
+    vcpus: List[Optional[float]]
+
+
+class VmStatsSchema(BaseModel):
+    vm_id: str
+    # Interval between the samples, in seconds
+    resolution: float
+    samples: List[VmUsageSampleSchema]
+
+
+class JobSchema(BaseModel):
+    class Config:
+        orm_mode = True
+
+    id: str
+    kind: JobKind
+    vm_id: str
+    status: JobStatus
+    step: Optional[str]
+    error: Optional[str]
+    creation_datetime: dt.datetime
+    start_datetime: Optional[dt.datetime]
+    end_datetime: Optional[dt.datetime]
+
+
+class VmBulkCreateSchema(BaseModel):
+    number_of_vms: int = Field(..., gt=0, le=settings.vm_bulk_max_number_of_vms)
+    memory: int = Field(
+        settings.vm_default_memory,
+        gt=settings.vm_min_memory,
+        lt=settings.vm_max_memory,
+    )
+    number_of_cores: int = Field(
+        settings.vm_default_number_of_cores,
+        gt=0,
+        lt=settings.vm_max_number_of_cores,
+    )
+    device_profile: Optional[str]
+    # The new VMs use the image of this VM
+    template_vm_id: Optional[str]
+    # The new VMs also use the guest owner certificates of the template VM, which
+    # then share the same launch secrets
+    share_certificates: bool = False
+    # SEV policy (hexadecimal format). If set, the VMs are started.
+    sev_policy: Optional[str]
+
+
+class VmBulkResultSchema(BaseModel):
+    vm: VmSchema
+    # Launch job of the VM, if it was started
+    job: Optional[JobSchema]
+    # Reason why the VM could not be started
+    error: Optional[str]
+
+
+class VmBulkCreateResponseSchema(BaseModel):
+    results: List[VmBulkResultSchema]
+
+
+class VmBulkActionSchema(BaseModel):
+    vm_ids: List[str] = Field(
+        ..., min_items=1, max_items=settings.vm_bulk_max_number_of_vms
+    )
+    # Time given to the guests to shut down before Qemu is stopped, in seconds.
+    # Defaults to `vm_stop_timeout`.
+    timeout: Optional[float] = Field(None, ge=0)
+
+
+class VmBulkActionResultSchema(BaseModel):
+    vm_id: str
+    # State of the VM after the action, not set if it was deleted
+    vm: Optional[VmSchema]
+    # Reason why the action failed on this VM
+    error: Optional[str]
+
+
+class VmBulkActionResponseSchema(BaseModel):
+    results: List[VmBulkActionResultSchema]
+
+
+class VmLaunchBundleSpecSchema(BaseModel):
+    memory: int = Field(
+        settings.vm_default_memory,
+        gt=settings.vm_min_memory,
+        lt=settings.vm_max_memory,
+    )
+    number_of_cores: int = Field(
+        settings.vm_default_number_of_cores,
+        gt=0,
+        lt=settings.vm_max_number_of_cores,
+    )
+    device_profile: Optional[str]
+    # SEV policy (hexadecimal format)
+    sev_policy: str
+    # File extracted from the image tarball
+    image_name: Optional[str]
+    # Use the image of this VM instead of uploading a tarball
+    template_vm_id: Optional[str]
+
+
+class VmLaunchBundleResponseSchema(BaseModel):
+    vm: VmSchema
+    job: JobSchema
+    # Set once the VM is started and waiting for launch
+    sev_info: Optional[VmSevInfoSchema]
+    launch_measure: Optional[str]
+    expected_launch_measure: Optional[ExpectedLaunchMeasureSchema]
@@ -1,5 +1,5 @@
 from pydantic import BaseSettings, FilePath
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 import yaml
 from pathlib import Path
 
@@ -22,15 +22,133 @@ class Settings(BaseSettings):
     # ovmf_path: FilePath
     # default_image_path: FilePath
 
+    # SQLAlchemy URL of the database, with an async driver: "sqlite+aiosqlite:///<path>"
+    # or "postgresql+asyncpg://<user>:<password>@<host>/<database>"
+    database_url: str = "sqlite+aiosqlite:///./confidential_vms.db"
+    # Connections kept open, and opened on top of them under load
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    # PostgreSQL only: time to wait for a connection of the pool, in seconds, and
+    # maximum age of a connection, in seconds
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 1800
+    # SQLite tuning, applied to each connection
+    sqlite_journal_mode: str = "wal"
+    sqlite_synchronous: str = "normal"
+    # Time a writer waits for another one to commit, in seconds
+    sqlite_busy_timeout: float = 30.0
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    # Log every SQL statement, for debugging only
+    db_echo: bool = False
+
+    # Number of worker processes serving the API. One worker is elected to run the
+    # Qemu processes, QMP connections and launch queue of the host.
+    api_workers: int = 1
+    # Lock files and sockets shared by the workers
+    runtime_dir: Path = Path("run")
+    # Interval at which the workers try to take over from a leader that stopped, and
+    # at which the leader looks for launch jobs it was not notified of, in seconds
+    leader_election_interval: float = 1.0
+    launch_queue_poll_interval: float = 5.0
+
     vm_default_memory: int = 4096
     vm_default_number_of_cores: int = 1
     vm_max_memory: int = 16 * 1024
     vm_min_memory: int = 128
     vm_max_number_of_cores: int = 4
+    # Maximum number of VMs created, stopped or deleted by a single bulk request
+    vm_bulk_max_number_of_vms: int = 100
+    # Time given to a guest to shut down when its VM is stopped, before Qemu is
+    # stopped, in seconds
+    vm_stop_timeout: float = 30.0
+
+    # Verified credentials are cached to avoid a bcrypt check on every request
+    auth_cache_size: int = 1024
+    auth_cache_ttl: float = 300.0
 
     ovmf_path: Path
     default_image_path: Path
 
+    # Content-addressed storage of VM images, VM disks are copy-on-write overlays
+    image_store_dir: Path = Path("image_store")
+    # One of "auto", "reflink" or "qcow2"
+    image_store_overlay_mode: str = "auto"
+    # Images that no VM uses are removed every interval and when a VM is deleted,
+    # unless they were stored or reused less than the grace period ago, in seconds
+    image_store_gc_interval: float = 600.0
+    image_store_gc_grace_period: float = 900.0
+
+    # Host capacity. Host memory (in MB) and cores are detected if not set.
+    host_memory: Optional[int] = None
+    host_cores: Optional[int] = None
+    # Resources kept for the host itself
+    host_reserved_memory: int = 2048
+    host_reserved_cores: int = 0
+    # SEV guest memory is pinned: do not overcommit memory unless you know what you do
+    memory_overcommit_ratio: float = 1.0
+    cpu_overcommit_ratio: float = 1.0
+
+    # VM placement: guest memory is backed by hugepages of this size when the NUMA node
+    # has enough free hugepages, set to None to disable hugepages
+    vm_hugepage_size: Optional[str] = "2M"
+    # Pin the vCPUs of each VM to dedicated host CPUs
+    vm_pin_vcpus: bool = True
+    # Host CPUs never used for vCPUs, in the kernel list format (ex: "0-1")
+    host_reserved_cpus: str = ""
+
+    # Device profile used when a VM does not specify one
+    vm_default_device_profile: str = "compat"
+    # Additional device profiles, by name. Each profile overrides the options of
+    # its "base" profile, ex: {"fast-disk": {"base": "balanced", "disk_aio": "io_uring"}}
+    device_profiles: Dict[str, Dict[str, Any]] = {}
+
+    # Host ports forwarded to the SSH port of the guests and used for QMP over TCP,
+    # as "<first>-<last>". Ports in use by other programs are skipped.
+    ssh_port_range: str = "22000-23999"
+    qmp_port_range: str = "24000-25999"
+    # "unix" serves QMP on a socket in the directory of the VM and falls back to TCP
+    # if the path of the socket is too long, "tcp" always uses a port
+    qmp_transport: str = "unix"
+
+    # Events kept for each user so that clients can resume their event stream
+    event_history_size: int = 1000
+    # Events buffered for a slow client before its stream is closed
+    event_subscription_size: int = 1000
+    # Interval between keepalive comments on idle event streams, in seconds
+    event_stream_keepalive_interval: float = 15.0
+
+    # Size of the buffer keeping the last output of each Qemu process on stderr
+    qemu_stderr_buffer_size: int = 64 * 1024
+
+    # Serial console of each VM: the last `console_buffer_size` bytes are kept in
+    # memory, older output in at most `console_max_segments` compressed segments of
+    # `console_segment_size` bytes of output each
+    console_buffer_size: int = 64 * 1024
+    console_segment_size: int = 1024 * 1024
+    console_max_segments: int = 8
+
+    # Resources used by the VMs: sampled every `resource_sample_interval` seconds,
+    # the last `resource_samples_kept` samples are kept with 5-minute and hourly
+    # averages
+    resource_sample_interval: float = 10.0
+    resource_samples_kept: int = 360
+
+    # Maximum number of VMs launched concurrently
+    launch_queue_concurrency: int = 4
+    # Time the launch bundle endpoint waits for the launch of the VM before
+    # answering without its measure, in seconds
+    launch_bundle_timeout: float = 120.0
+
+    # Status of the SEV platform: read with sevctl at most every `platform_info_ttl`
+    # seconds, and refreshed in the background by the leader every
+    # `platform_info_refresh_interval` seconds
+    platform_info_ttl: float = 300.0
+    platform_info_refresh_interval: float = 60.0
+
+    # Chunked image uploads
+    upload_min_chunk_size: int = 1024 * 1024
+    upload_max_chunk_size: int = 256 * 1024 * 1024
+
     class Config:
         env_prefix = "aleph_scrn_"
 
@@ -0,0 +1,211 @@
+"""
+Accounting of the host resources committed to VMs.
+
+With SEV, the memory of a guest is pinned and encrypted: it cannot be swapped or
+shared, and overcommitting the host leads to Qemu failures or the OOM killer.
+Resources are reserved when a VM is queued for launch and released when it stops.
+
+The database is the reference when several workers admit VMs: the ledger of a
+worker is reloaded from the active VMs, under a lock of the host, before each
+admission.
+"""
+
+import os
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.vm import ACTIVE_VM_STATES, Vm
+from settings import settings
+from toolkit.host_lock import HostLock, hold_until_end_of_transaction
+
+
+class InsufficientCapacityError(Exception):
+    pass
+
+
+@dataclass
+class HostResources:
+    # In MB
+    memory: int
+    cores: int
+
+
+@dataclass
+class CapacityUsage:
+    total_memory: int
+    total_cores: int
+    allocatable_memory: int
+    allocatable_cores: int
+    committed_memory: int
+    committed_cores: int
+    number_of_vms: int
+
+    @property
+    def available_memory(self) -> int:
+        return max(self.allocatable_memory - self.committed_memory, 0)
+
+    @property
+    def available_cores(self) -> int:
+        return max(self.allocatable_cores - self.committed_cores, 0)
+
+    def check(self, memory: int, cores: int) -> Optional[str]:
+        """
+        Returns the reason why a VM with these resources cannot be admitted, if any.
+        """
+        if memory > self.available_memory:
+            return (
+                f"Not enough memory on the host: {memory} MB requested, "
+                f"{self.available_memory} MB available"
+            )
+        if cores > self.available_cores:
+            return (
+                f"Not enough cores on the host: {cores} requested, "
+                f"{self.available_cores} available"
+            )
+        return None
+
+
+def read_host_memory(meminfo_path: Path = Path("/proc/meminfo")) -> int:
+    """
+    Returns the total memory of the host, in MB.
+    """
+    with meminfo_path.open() as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) // 1024
+
+    raise ValueError(f"Could not find the total memory in {meminfo_path}")
+
+
+def get_host_resources() -> HostResources:
+    return HostResources(
+        memory=settings.host_memory or read_host_memory(),
+        cores=settings.host_cores or os.cpu_count(),
+    )
+
+
+class CapacityLedger:
+    """
+    Tracks the memory and cores reserved by each VM against the host capacity.
+    """
+
+    def __init__(
+        self,
+        host: HostResources,
+        reserved_memory: int = 0,
+        reserved_cores: int = 0,
+        memory_overcommit_ratio: float = 1.0,
+        cpu_overcommit_ratio: float = 1.0,
+    ):
+        self.host = host
+        self.allocatable_memory = int(
+            (host.memory - reserved_memory) * memory_overcommit_ratio
+        )
+        self.allocatable_cores = int((host.cores - reserved_cores) * cpu_overcommit_ratio)
+
+        # VM ID -> (memory, cores)
+        self._reservations: Dict[str, Tuple[int, int]] = {}
+        self.committed_memory = 0
+        self.committed_cores = 0
+
+    def load(self, reservations: Iterable[Tuple[str, int, int]]) -> None:
+        """
+        Initializes the ledger from the VMs that are already running.
+        """
+        self._reservations.clear()
+        self.committed_memory = 0
+        self.committed_cores = 0
+        for vm_id, memory, cores in reservations:
+            self._add(vm_id, memory, cores)
+
+    def _add(self, vm_id: str, memory: int, cores: int) -> None:
+        self._reservations[vm_id] = (memory, cores)
+        self.committed_memory += memory
+        self.committed_cores += cores
+
+    def check(self, memory: int, cores: int) -> Optional[str]:
+        """
+        Returns the reason why a VM with these resources cannot be admitted, if any.
+        """
+        return self.usage().check(memory, cores)
+
+    def reserve(self, vm_id: str, memory: int, cores: int) -> None:
+        if vm_id in self._reservations:
+            return
+
+        reason = self.check(memory, cores)
+        if reason is not None:
+            raise InsufficientCapacityError(reason)
+        self._add(vm_id, memory, cores)
+
+    def release(self, vm_id: str) -> None:
+        reservation = self._reservations.pop(vm_id, None)
+        if reservation is not None:
+            memory, cores = reservation
+            self.committed_memory -= memory
+            self.committed_cores -= cores
+
+    def usage(self) -> CapacityUsage:
+        return CapacityUsage(
+            total_memory=self.host.memory,
+            total_cores=self.host.cores,
+            allocatable_memory=self.allocatable_memory,
+            allocatable_cores=self.allocatable_cores,
+            committed_memory=self.committed_memory,
+            committed_cores=self.committed_cores,
+            number_of_vms=len(self._reservations),
+        )
+
+
+capacity_ledger = CapacityLedger(
+    host=get_host_resources(),
+    reserved_memory=settings.host_reserved_memory,
+    reserved_cores=settings.host_reserved_cores,
+    memory_overcommit_ratio=settings.memory_overcommit_ratio,
+    cpu_overcommit_ratio=settings.cpu_overcommit_ratio,
+)
+capacity_lock = HostLock("capacity")
+
+
+async def sync_capacity_ledger(session: AsyncSession) -> None:
+    """
+    Reloads the ledger from the active VMs, including the ones admitted by the
+    other workers.
+    """
+    select_stmt = select(Vm.id, Vm.memory, Vm.number_of_cores).where(
+        Vm.state.in_(ACTIVE_VM_STATES)
+    )
+    capacity_ledger.load((await session.execute(select_stmt)).all())
+
+
+async def fetch_capacity_usage(session: AsyncSession) -> CapacityUsage:
+    """
+    Returns the usage of the host by the active VMs, including the ones admitted
+    by the other workers. Does not change the ledger.
+    """
+    select_stmt = select(
+        func.coalesce(func.sum(Vm.memory), 0),
+        func.coalesce(func.sum(Vm.number_of_cores), 0),
+        func.count(),
+    ).where(Vm.state.in_(ACTIVE_VM_STATES))
+    memory, cores, number_of_vms = (await session.execute(select_stmt)).one()
+    return replace(
+        capacity_ledger.usage(),
+        committed_memory=memory,
+        committed_cores=cores,
+        number_of_vms=number_of_vms,
+    )
+
+
+async def lock_capacity_ledger(session: AsyncSession) -> None:
+    """
+    Locks the capacity of the host until the end of the transaction, and reloads
+    the ledger the first time. The VMs admitted in the transaction must be locked
+    before, see `lock_vm`: the lock of the host is always taken last.
+    """
+    if await hold_until_end_of_transaction(session, capacity_lock):
+        await sync_capacity_ledger(session)
@@ -0,0 +1,98 @@
+"""
+File operations of chunked image uploads.
+
+The image is assembled in place: the upload file is created with its final size
+and each chunk is written at its offset as soon as it is received, in any order.
+Committing the upload does not require any copy.
+"""
+
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from typing import AsyncIterator, List, Tuple
+
+from toolkit.image_ingest import INGEST_BUFFER_SIZE, SparseFileWriter
+
+
+class ChunkSizeError(ValueError):
+    pass
+
+
+def create_upload_file(path: Path, size: int) -> None:
+    """
+    Creates a sparse file of the final size of the image.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+async def write_chunk(
+    path: Path, offset: int, size: int, stream: AsyncIterator[bytes]
+) -> str:
+    """
+    Writes a chunk at its position in the upload file.
+
+    :param path: Path of the upload file.
+    :param offset: Position of the chunk in the image.
+    :param size: Expected size of the chunk.
+    :param stream: Content of the chunk.
+    :return: The SHA256 of the chunk.
+    """
+    sha256 = hashlib.sha256()
+    writer = SparseFileWriter(path, truncate=False)
+    position = 0
+
+    def write_batch(data: bytes, batch_offset: int) -> None:
+        sha256.update(data)
+        writer.write_at(batch_offset, data)
+
+    try:
+        # The chunk may have been uploaded before: its blocks of zeros are not
+        # written and must not keep the previous data
+        await asyncio.to_thread(writer.clear, offset, size)
+
+        batch = bytearray()
+        async for data in stream:
+            batch.extend(data)
+            if position + len(batch) > size:
+                raise ChunkSizeError(f"Chunk is larger than the expected {size} bytes")
+            if len(batch) >= INGEST_BUFFER_SIZE:
+                await asyncio.to_thread(write_batch, bytes(batch), offset + position)
+                position += len(batch)
+                batch.clear()
+
+        if batch:
+            await asyncio.to_thread(write_batch, bytes(batch), offset + position)
+            position += len(batch)
+    finally:
+        writer.close()
+
+    if position != size:
+        raise ChunkSizeError(f"Chunk has {position} bytes, expected {size}")
+
+    return sha256.hexdigest()
+
+
+def hash_upload_file(path: Path, chunk_size: int) -> Tuple[str, List[str]]:
+    """
+    Returns the SHA256 of the upload file and of each of its chunks, in a single
+    read of the file.
+    """
+    sha256 = hashlib.sha256()
+    chunk_digests = []
+    with path.open("rb") as f:
+        while True:
+            chunk_sha256 = hashlib.sha256()
+            remaining = chunk_size
+            while remaining and (data := f.read(min(remaining, INGEST_BUFFER_SIZE))):
+                sha256.update(data)
+                chunk_sha256.update(data)
+                remaining -= len(data)
+            if remaining == chunk_size:
+                break
+            chunk_digests.append(chunk_sha256.hexdigest())
+    return sha256.hexdigest(), chunk_digests
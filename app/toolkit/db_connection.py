@@ -1,2 +1,68 @@
+"""
+Configuration of the database engine, shared by the API, the migrations and the tools.
+
+SQLite is tuned for concurrent requests: WAL lets readers run while a transaction
+writes, writers wait for each other up to the busy timeout instead of failing with
+"database is locked", and connections are pooled so that the pragmas are only
+applied once per connection. PostgreSQL is supported through asyncpg.
+"""
+
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from settings import settings
+
+
 def get_db_url() -> str:
-    return "sqlite+aiosqlite:///./confidential_vms.db"
+    return settings.database_url
+
+
+def is_sqlite_file_db(url: str) -> bool:
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size}")
+    cursor.close()
+
+
+def create_db_engine(url: Optional[str] = None, **kwargs) -> AsyncEngine:
+    """
+    Creates the engine of the database, by default the one of the settings.
+    """
+    url = url or get_db_url()
+    backend = make_url(url).get_backend_name()
+
+    if backend == "sqlite":
+        # Sets the busy timeout of the connections
+        kwargs.setdefault("connect_args", {"timeout": settings.sqlite_busy_timeout})
+        if is_sqlite_file_db(url) and "poolclass" not in kwargs:
+            # The default pool of aiosqlite opens a connection, and a thread,
+            # for each session
+            kwargs.update(
+                poolclass=AsyncAdaptedQueuePool,
+                pool_size=settings.db_pool_size,
+                max_overflow=settings.db_max_overflow,
+            )
+    elif backend == "postgresql" and "poolclass" not in kwargs:
+        kwargs.update(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            # Detects the connections closed by the server or a proxy
+            pool_pre_ping=True,
+        )
+
+    engine = create_async_engine(url, future=True, **kwargs)
+    if backend == "sqlite":
+        event.listen(engine.sync_engine, "connect", apply_sqlite_pragmas)
+    return engine
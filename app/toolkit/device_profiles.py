@@ -0,0 +1,175 @@
+"""
+Named device profiles for the disk and network of VMs.
+
+A profile defines how the disk and network devices of a VM are emulated. The
+built-in profiles can be extended or overridden with the `device_profiles` setting.
+"""
+
+from dataclasses import dataclass, replace
+from enum import Enum
+from typing import Dict, List, Optional
+
+from settings import settings
+from toolkit.image_store import VmDisk
+
+
+class DiskBus(str, Enum):
+    # Default Qemu drive, emulated IDE
+    IDE = "ide"
+    VIRTIO_BLK = "virtio-blk"
+    VIRTIO_SCSI = "virtio-scsi"
+
+
+class NetworkBackend(str, Enum):
+    # Slirp user networking, the SSH port of the guest is forwarded on the host
+    USER = "user"
+    # TAP interface attached by the ifup script, ex: to a bridge
+    TAP = "tap"
+
+
+@dataclass(frozen=True)
+class DeviceProfile:
+    name: str
+    disk_bus: DiskBus = DiskBus.IDE
+    # Number of I/O threads serving the disk, 0 to use the main loop
+    iothreads: int = 0
+    # Host page cache mode, "none" bypasses the host page cache (O_DIRECT)
+    disk_cache: Optional[str] = None
+    # "threads", "native" (requires cache=none) or "io_uring"
+    disk_aio: Optional[str] = None
+    network_backend: NetworkBackend = NetworkBackend.USER
+    # Number of queue pairs of the virtio-net device, 0 for one per vCPU.
+    # Only supported with TAP networking.
+    network_queues: int = 1
+    vhost: bool = False
+    tap_script: Optional[str] = None
+    tap_downscript: Optional[str] = None
+
+    @property
+    def forwards_ssh_port(self) -> bool:
+        return self.network_backend == NetworkBackend.USER
+
+
+BUILTIN_DEVICE_PROFILES = {
+    # Devices used before profiles were introduced
+    "compat": DeviceProfile(name="compat"),
+    "balanced": DeviceProfile(
+        name="balanced",
+        disk_bus=DiskBus.VIRTIO_BLK,
+        iothreads=1,
+        disk_cache="none",
+        disk_aio="native",
+    ),
+    "performance": DeviceProfile(
+        name="performance",
+        disk_bus=DiskBus.VIRTIO_BLK,
+        iothreads=1,
+        disk_cache="none",
+        disk_aio="io_uring",
+        network_backend=NetworkBackend.TAP,
+        network_queues=0,
+        vhost=True,
+    ),
+    "performance-scsi": DeviceProfile(
+        name="performance-scsi",
+        disk_bus=DiskBus.VIRTIO_SCSI,
+        iothreads=1,
+        disk_cache="none",
+        disk_aio="io_uring",
+        network_backend=NetworkBackend.TAP,
+        network_queues=0,
+        vhost=True,
+    ),
+}
+
+
+def load_device_profiles() -> Dict[str, DeviceProfile]:
+    profiles = dict(BUILTIN_DEVICE_PROFILES)
+    for name, options in settings.device_profiles.items():
+        base = profiles.get(options.get("base", "compat"), profiles["compat"])
+        options = {key: value for key, value in options.items() if key != "base"}
+        try:
+            profiles[name] = replace(base, name=name, **options)
+        except TypeError as e:
+            raise ValueError(f"Invalid device profile '{name}': {e}") from e
+    return profiles
+
+
+def get_iothread_ids(profile: DeviceProfile) -> List[str]:
+    return [f"iothread{i}" for i in range(profile.iothreads)]
+
+
+def get_iothread_args(profile: DeviceProfile) -> List[str]:
+    args = []
+    for iothread_id in get_iothread_ids(profile):
+        args += ["-object", f"iothread,id={iothread_id}"]
+    return args
+
+
+def get_disk_args(profile: DeviceProfile, disk: VmDisk, number_of_cores: int) -> List[str]:
+    drive_options = f"format={disk.format},file={disk.path}"
+    if profile.disk_cache:
+        drive_options += f",cache={profile.disk_cache}"
+    if profile.disk_aio:
+        drive_options += f",aio={profile.disk_aio}"
+
+    if profile.disk_bus == DiskBus.IDE:
+        return ["-drive", drive_options]
+
+    iothread_ids = get_iothread_ids(profile)
+    iothread_option = f",iothread={iothread_ids[0]}" if iothread_ids else ""
+    args = ["-drive", f"if=none,id=disk0,{drive_options}"]
+    if profile.disk_bus == DiskBus.VIRTIO_BLK:
+        args += [
+            "-device",
+            f"virtio-blk-pci,drive=disk0,num-queues={number_of_cores}{iothread_option}",
+        ]
+    else:
+        args += [
+            "-device",
+            f"virtio-scsi-pci,id=scsi0,num_queues={number_of_cores}{iothread_option}",
+            "-device",
+            "scsi-hd,drive=disk0,bus=scsi0.0",
+        ]
+    return args
+
+
+def get_network_queues(profile: DeviceProfile, number_of_cores: int) -> int:
+    if profile.network_backend != NetworkBackend.TAP:
+        # Slirp only supports a single queue
+        return 1
+    return profile.network_queues or number_of_cores
+
+
+def get_tap_interface_name(vm_id: str) -> str:
+    # Interface names are limited to 15 characters
+    return f"scrn{vm_id[:11]}"
+
+
+def get_network_args(
+    profile: DeviceProfile, vm_id: str, number_of_cores: int, ssh_port: Optional[int]
+) -> List[str]:
+    queues = get_network_queues(profile, number_of_cores)
+
+    if profile.network_backend == NetworkBackend.USER:
+        netdev = f"user,id=net0,hostfwd=tcp::{ssh_port}-:22"
+    else:
+        netdev = f"tap,id=net0,ifname={get_tap_interface_name(vm_id)}"
+        if profile.tap_script:
+            netdev += f",script={profile.tap_script}"
+        if profile.tap_downscript:
+            netdev += f",downscript={profile.tap_downscript}"
+        if profile.vhost:
+            netdev += ",vhost=on"
+        if queues > 1:
+            netdev += f",queues={queues}"
+
+    device = "virtio-net-pci,netdev=net0"
+    if queues > 1:
+        # One vector per queue for RX and TX, plus config and control vectors
+        device += f",mq=on,vectors={2 * queues + 2}"
+
+    return ["-netdev", netdev, "-device", device]
+
+
+device_profiles = load_device_profiles()
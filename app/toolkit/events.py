@@ -0,0 +1,344 @@
+"""
+Publication of the events of each user: VM state transitions, QMP events forwarded
+from Qemu and launch job progress.
+
+Clients follow the events of their VMs on a stream instead of polling the VMs.
+The last events of each user are kept in memory: a client that reconnects with
+the ID of the last event it received gets the events it missed. If they are not
+available anymore, ex: after a restart of the API, it gets a "reset" event and
+must reload the state of its VMs.
+
+When the API runs several workers, the events are numbered by the leader and sent
+to every worker, so that a client can resume its stream on any worker.
+"""
+
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from itertools import chain
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+from uuid import uuid4
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models.jobs import Job
+from models.vm import Vm
+from settings import settings
+
+PENDING_EVENTS_KEY = "pending_events"
+# Events buffered for a worker that follows the events of the leader
+WORKER_STREAM_SIZE = 10000
+
+EventListener = Callable[[str, "Event"], None]
+EventForwarder = Callable[[str, str, Dict[str, Any]], None]
+
+
+class EventType:
+    VM_STATE = "vm_state"
+    QMP = "qmp"
+    JOB = "job"
+    # The client missed events and must reload the state of its VMs
+    RESET = "reset"
+
+
+@dataclass
+class Event:
+    id: str
+    type: str
+    data: Dict[str, Any]
+
+    def to_sse(self) -> bytes:
+        """
+        Formats the event for a Server-Sent Events stream.
+        """
+        return (
+            f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n"
+        ).encode()
+
+
+class EventStreamOverflow(Exception):
+    """
+    The client reads its events slower than they are published.
+    """
+
+
+class EventSubscription:
+    def __init__(
+        self, bus: "EventBus", owner: str, max_size: int, backlog: List[Event]
+    ):
+        self.bus = bus
+        self.owner = owner
+        # The missed events delivered first do not count against the size
+        self.max_size = max_size + len(backlog)
+        self.overflowed = False
+        self._events: Deque[Event] = deque(backlog)
+        self._wakeup = asyncio.Event()
+
+    def push(self, event: Event) -> None:
+        if len(self._events) >= self.max_size:
+            self.overflow()
+        else:
+            self._events.append(event)
+            self._wakeup.set()
+
+    def overflow(self) -> None:
+        self.overflowed = True
+        self._wakeup.set()
+
+    async def get(self, timeout: float) -> Optional[Event]:
+        """
+        Returns the next event, or None if no event is published within `timeout`
+        seconds.
+        """
+        if not self._events and not self.overflowed:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+        if self.overflowed:
+            raise EventStreamOverflow()
+        return self._events.popleft()
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self, history_size: int, subscription_size: int):
+        self.history_size = history_size
+        self.subscription_size = subscription_size
+        # Event IDs are only valid for this instance of the API, or for the current
+        # leader in the other workers
+        self.instance_id = uuid4().hex[:8]
+        self._last_sequence = 0
+        # Set in the workers that are not the leader, to publish through the leader
+        self.forwarder: Optional[EventForwarder] = None
+        # Called with each event published, in the leader
+        self._listeners: List[EventListener] = []
+
+        # Owner -> last events of the owner
+        self._history: Dict[str, Deque[Event]] = defaultdict(
+            lambda: deque(maxlen=self.history_size)
+        )
+        # Owner -> sequence number of the last event dropped from the history
+        self._dropped_sequences: Dict[str, int] = {}
+        self._subscriptions: Dict[str, Set[EventSubscription]] = defaultdict(set)
+
+    def _make_id(self, sequence: int) -> str:
+        return f"{self.instance_id}-{sequence}"
+
+    def _parse_id(self, event_id: str) -> Optional[int]:
+        """
+        Returns the sequence number of an event ID, or None if it comes from
+        another instance of the API.
+        """
+        instance_id, _, sequence = event_id.partition("-")
+        if instance_id != self.instance_id or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def publish(self, owner: str, event_type: str, data: Dict[str, Any]) -> None:
+        if self.forwarder is not None:
+            self.forwarder(owner, event_type, data)
+            return
+
+        event = Event(
+            id=self._make_id(self._last_sequence + 1), type=event_type, data=data
+        )
+        self.deliver(owner, event)
+        for listener in self._listeners:
+            listener(owner, event)
+
+    def deliver(self, owner: str, event: Event) -> None:
+        """
+        Adds an event numbered by this worker or by the leader to the history of
+        its owner, and sends it to the subscriptions of the owner.
+        """
+        instance_id, _, sequence = event.id.partition("-")
+        if instance_id != self.instance_id:
+            # Elected leader, the IDs of its predecessor are not valid anymore
+            self._history.clear()
+            self._dropped_sequences.clear()
+            self.instance_id = instance_id
+        self._last_sequence = int(sequence)
+
+        history = self._history[owner]
+        if len(history) == history.maxlen:
+            self._dropped_sequences[owner] = self._parse_id(history[0].id)
+        history.append(event)
+
+        for subscription in self._subscriptions.get(owner, ()):
+            subscription.push(event)
+
+    def add_listener(self, listener: EventListener) -> None:
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: EventListener) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def invalidate(self) -> None:
+        """
+        Forgets the events and ends the subscriptions, ex: when events may have
+        been missed. Clients get a "reset" event when they reconnect.
+        """
+        self.instance_id = uuid4().hex[:8]
+        self._last_sequence = 0
+        self._history.clear()
+        self._dropped_sequences.clear()
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                subscription.overflow()
+
+    def subscribe(
+        self, owner: str, last_event_id: Optional[str] = None
+    ) -> EventSubscription:
+        """
+        Subscribes to the events of a user. If `last_event_id` is set, the events
+        published after it are delivered first.
+        """
+        backlog = []
+        if last_event_id is not None:
+            backlog = self._replay(owner, last_event_id)
+        subscription = EventSubscription(
+            self, owner, self.subscription_size, backlog=backlog
+        )
+        self._subscriptions[owner].add(subscription)
+        return subscription
+
+    def _replay(self, owner: str, last_event_id: str) -> List[Event]:
+        last_sequence = self._parse_id(last_event_id)
+        if last_sequence is None or last_sequence < self._dropped_sequences.get(
+            owner, 0
+        ):
+            reset = Event(
+                id=self._make_id(self._last_sequence), type=EventType.RESET, data={}
+            )
+            return [reset]
+
+        return [
+            event
+            for event in self._history.get(owner, ())
+            if self._parse_id(event.id) > last_sequence
+        ]
+
+    def unsubscribe(self, subscription: EventSubscription) -> None:
+        subscriptions = self._subscriptions.get(subscription.owner)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.owner]
+
+
+event_bus = EventBus(
+    history_size=settings.event_history_size,
+    subscription_size=settings.event_subscription_size,
+)
+
+
+async def stream_events_to_worker() -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yields the events published in the leader, for another worker. Ends if the
+    worker reads them too slowly, the worker then invalidates its events.
+    """
+    queue: "asyncio.Queue[Optional[Tuple[str, Event]]]" = asyncio.Queue(
+        maxsize=WORKER_STREAM_SIZE
+    )
+
+    def listener(owner: str, event: Event) -> None:
+        try:
+            queue.put_nowait((owner, event))
+        except asyncio.QueueFull:
+            event_bus.remove_listener(listener)
+            queue.get_nowait()
+            queue.put_nowait(None)
+
+    event_bus.add_listener(listener)
+    try:
+        while (item := await queue.get()) is not None:
+            owner, event = item
+            yield {"owner": owner, "id": event.id, "type": event.type, "data": event.data}
+    finally:
+        event_bus.remove_listener(listener)
+
+
+def get_changed_value(obj, attribute: str) -> Optional[Tuple[Any, Any]]:
+    """
+    Returns (new value, old value) if an attribute of a flushed object changed.
+    """
+    history = inspect(obj).attrs[attribute].history
+    if not history.added:
+        return None
+    old_value = history.deleted[0] if history.deleted else None
+    return history.added[0], old_value
+
+
+@event.listens_for(Session, "after_flush")
+def collect_events(session: Session, flush_context) -> None:
+    """
+    Records the events of the VMs and jobs changed by a flush. They are published
+    when the transaction is committed.
+    """
+    pending_events = session.info.setdefault(PENDING_EVENTS_KEY, [])
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, Vm):
+            if (change := get_changed_value(obj, "state")) is not None:
+                state, previous_state = change
+                pending_events.append(
+                    (
+                        obj.owner,
+                        EventType.VM_STATE,
+                        {
+                            "vm_id": obj.id,
+                            "state": state,
+                            "previous_state": previous_state,
+                            "time": time.time(),
+                        },
+                    )
+                )
+
+        elif isinstance(obj, Job):
+            changes = [get_changed_value(obj, "status"), get_changed_value(obj, "step")]
+            if any(change is not None for change in changes):
+                pending_events.append(
+                    (
+                        obj.owner,
+                        EventType.JOB,
+                        {
+                            "job_id": obj.id,
+                            "vm_id": obj.vm_id,
+                            "kind": obj.kind,
+                            "status": obj.status,
+                            "step": obj.step,
+                            "error": obj.error,
+                            "time": time.time(),
+                        },
+                    )
+                )
+
+
+@event.listens_for(Session, "after_commit")
+def publish_events(session: Session) -> None:
+    for owner, event_type, data in session.info.pop(PENDING_EVENTS_KEY, ()):
+        event_bus.publish(owner, event_type, data)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_events(session: Session, previous_transaction) -> None:
+    session.info.pop(PENDING_EVENTS_KEY, None)
@@ -0,0 +1,112 @@
+"""
+Locks shared by the worker processes of the API.
+
+The decisions that depend on the state of the whole host, ex: admitting a VM
+against the capacity of the host, are serialized across the workers with file
+locks in the runtime directory. The kernel releases the lock of a worker that
+dies, so a crash never leaves the host locked.
+"""
+
+import asyncio
+import fcntl
+import os
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.db import call_after_commit, call_after_rollback
+from settings import settings
+
+HELD_LOCKS_KEY = "held_host_locks"
+LOCK_POLL_INTERVAL = 0.002
+MAX_LOCK_POLL_INTERVAL = 0.05
+
+
+def get_runtime_dir() -> Path:
+    runtime_dir = settings.runtime_dir.absolute()
+    # Only the user of the API can take the locks and call the leader
+    runtime_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return runtime_dir
+
+
+class HostLock:
+    """
+    Exclusive lock of the host, shared by the coroutines of a worker and by the
+    workers. Coroutines of the same worker queue on an asyncio lock, so only one
+    of them polls the file lock.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = asyncio.Lock()
+        self._fd: Optional[int] = None
+
+    @property
+    def path(self) -> Path:
+        return get_runtime_dir() / f"{self.name}.lock"
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    async def acquire(self) -> None:
+        await self._lock.acquire()
+        fd = None
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            delay = LOCK_POLL_INTERVAL
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    # Held by another worker, waiting in a thread would tie up the
+                    # thread pool
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_LOCK_POLL_INTERVAL)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            self._lock.release()
+            raise
+        self._fd = fd
+
+    def release(self) -> None:
+        fd, self._fd = self._fd, None
+        # Closing the file releases the lock
+        os.close(fd)
+        self._lock.release()
+
+    async def __aenter__(self) -> "HostLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+
+async def hold_until_end_of_transaction(session: AsyncSession, lock: HostLock) -> bool:
+    """
+    Holds `lock` until the current transaction of the session is committed or
+    rolled back, so that the next holder sees the changes of the transaction.
+
+    :return: False if the transaction already held the lock.
+    """
+    held_locks = session.info.setdefault(HELD_LOCKS_KEY, {})
+    if lock.name in held_locks:
+        return False
+
+    await lock.acquire()
+    hold = object()
+    held_locks[lock.name] = hold
+
+    def release() -> None:
+        # Both callbacks are registered, only the first one releases the lock
+        if held_locks.get(lock.name) is hold:
+            del held_locks[lock.name]
+            lock.release()
+
+    call_after_commit(session, release)
+    call_after_rollback(session, release)
+    return True
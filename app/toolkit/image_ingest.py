@@ -0,0 +1,580 @@
+"""
+Streaming extraction of VM images from (compressed) tarballs.
+
+The tarball is parsed as it is received: only the requested member is written to
+disk, its SHA256 digest is computed on the fly and runs of zeros are left as holes
+in the output file instead of being written.
+"""
+
+import asyncio
+import bz2
+import ctypes
+import hashlib
+import lzma
+import os
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import zstandard
+
+# Size of the batches processed off the event loop
+INGEST_BUFFER_SIZE = 4 * 1024 * 1024
+# Granularity of hole detection in the output file
+SPARSE_BLOCK_SIZE = 64 * 1024
+TAR_BLOCK_SIZE = 512
+# Maximum size of the pieces of decompressed data held in memory
+DECOMPRESSED_PIECE_SIZE = 1024 * 1024
+
+_ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+BZIP2_MAGIC = b"BZh"
+
+# From linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+
+# Regular files, contiguous files and GNU sparse files
+TAR_FILE_TYPES = (b"0", b"\0", b"7", b"S")
+# Links, devices, directories and FIFOs
+TAR_NO_DATA_TYPES = (b"1", b"2", b"3", b"4", b"5", b"6")
+
+
+class ImageIngestError(ValueError):
+    pass
+
+
+@dataclass
+class ExtractedMember:
+    digest: str
+    size: int
+
+
+class _InputExhausted(Exception):
+    pass
+
+
+class _ZstdInput:
+    """
+    Source of a zstd stream reader, filled as the stream is received. Reading it
+    while it is empty interrupts the reader until more input is received.
+    """
+
+    def __init__(self):
+        self.data = memoryview(b"")
+        self.finished = False
+
+    def read(self, size: int) -> bytes:
+        if not self.data:
+            if self.finished:
+                return b""
+            raise _InputExhausted()
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+class StreamDecompressor:
+    """
+    Decompresses a stream incrementally. The compression format (gzip, zstd, xz,
+    bzip2 or none) is detected from the first bytes of the stream.
+
+    The output is passed to `write` in pieces of at most `DECOMPRESSED_PIECE_SIZE`
+    bytes, so that highly compressed input, ex: a disk full of zeros, does not
+    expand in memory.
+    """
+
+    def __init__(self, write: Callable[[bytes], None]):
+        self._write = write
+        self._decompressor = None
+        self._zstd_input: Optional[_ZstdInput] = None
+        self._header = b""
+        self._passthrough = False
+
+    def _detect(self, header: bytes) -> None:
+        if header.startswith(GZIP_MAGIC):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif header.startswith(ZSTD_MAGIC):
+            self._zstd_input = _ZstdInput()
+            self._decompressor = zstandard.ZstdDecompressor().stream_reader(
+                self._zstd_input, read_across_frames=True
+            )
+        elif header.startswith(XZ_MAGIC):
+            self._decompressor = lzma.LZMADecompressor()
+        elif header.startswith(BZIP2_MAGIC):
+            self._decompressor = bz2.BZ2Decompressor()
+        else:
+            self._passthrough = True
+
+    def decompress(self, data: bytes) -> None:
+        if self._passthrough:
+            self._write(data)
+            return
+
+        if self._decompressor is None:
+            self._header += data
+            if len(self._header) < len(XZ_MAGIC):
+                return
+            data, self._header = self._header, b""
+            self._detect(data)
+            if self._passthrough:
+                self._write(data)
+                return
+
+        try:
+            if self._zstd_input is not None:
+                self._zstd_input.data = memoryview(data)
+                self._read_zstd()
+            elif hasattr(self._decompressor, "unconsumed_tail"):
+                # zlib keeps the input it did not decompress yet
+                while data:
+                    self._write(
+                        self._decompressor.decompress(data, DECOMPRESSED_PIECE_SIZE)
+                    )
+                    data = self._decompressor.unconsumed_tail
+            else:
+                # lzma and bz2 buffer the input they did not decompress yet
+                self._write(
+                    self._decompressor.decompress(data, DECOMPRESSED_PIECE_SIZE)
+                )
+                while not self._decompressor.eof and not self._decompressor.needs_input:
+                    self._write(
+                        self._decompressor.decompress(b"", DECOMPRESSED_PIECE_SIZE)
+                    )
+        except (
+            zlib.error,
+            lzma.LZMAError,
+            zstandard.ZstdError,
+            OSError,
+            EOFError,
+        ) as e:
+            raise ImageIngestError(f"Invalid compressed stream: {e}") from e
+
+    def _read_zstd(self) -> None:
+        # read1() only reads the source while it has no output to return, so no
+        # output is lost when the source is exhausted
+        while True:
+            try:
+                data = self._decompressor.read1(DECOMPRESSED_PIECE_SIZE)
+            except _InputExhausted:
+                return
+            if not data:
+                return
+            self._write(data)
+
+    def flush(self) -> None:
+        if self._decompressor is None:
+            # Stream shorter than the magic numbers
+            data, self._header = self._header, b""
+            self._write(data)
+        elif self._zstd_input is not None:
+            self._zstd_input.finished = True
+            try:
+                # Unlike read1(), read() returns the output left once the source
+                # is exhausted
+                while data := self._decompressor.read(DECOMPRESSED_PIECE_SIZE):
+                    self._write(data)
+            except zstandard.ZstdError as e:
+                raise ImageIngestError(f"Invalid compressed stream: {e}") from e
+        elif hasattr(self._decompressor, "flush"):
+            self._write(self._decompressor.flush())
+
+
+class SparseFileWriter:
+    """
+    Writes a file with positioned writes, skipping blocks of zeros to leave holes.
+    """
+
+    def __init__(self, path: Path, truncate: bool = True):
+        self.path = path
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        self._fd = os.open(path, flags, 0o644)
+        self.size = 0
+
+    def write_at(self, offset: int, data: bytes) -> None:
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            block = view[position : position + SPARSE_BLOCK_SIZE]
+            if block != _ZERO_BLOCK[: len(block)]:
+                os.pwrite(self._fd, block, offset + position)
+            position += len(block)
+        self.size = max(self.size, offset + len(view))
+
+    def clear(self, offset: int, size: int) -> None:
+        """
+        Replaces a range of the file with zeros. Must be called before writing over
+        existing data, as blocks of zeros are not written.
+        """
+        mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+        if _libc.fallocate(self._fd, mode, offset, size) == 0:
+            return
+
+        # The filesystem does not support holes
+        position = 0
+        while position < size:
+            length = min(size - position, SPARSE_BLOCK_SIZE)
+            os.pwrite(self._fd, _ZERO_BLOCK[:length], offset + position)
+            position += length
+
+    def close(self, size: Optional[int] = None) -> None:
+        if size is not None:
+            # Extends the file over trailing holes
+            os.ftruncate(self._fd, size)
+        os.close(self._fd)
+
+
+def parse_tar_number(field: bytes) -> int:
+    if field and field[0] & 0x80:
+        # GNU base-256 encoding, used for sizes above 8 GiB
+        return int.from_bytes(field[1:], "big")
+    field = field.rstrip(b"\0 ").strip()
+    return int(field, 8) if field else 0
+
+
+def parse_tar_string(field: bytes) -> str:
+    return field.split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+
+
+def normalize_member_name(name: str) -> str:
+    while name.startswith("./"):
+        name = name[2:]
+    return name.lstrip("/")
+
+
+def parse_pax_headers(data: bytes) -> Dict[str, str]:
+    headers = {}
+    position = 0
+    while position < len(data):
+        space = data.index(b" ", position)
+        length = int(data[position:space])
+        record = data[space + 1 : position + length - 1]
+        key, _, value = record.partition(b"=")
+        headers[key.decode()] = value.decode("utf-8", "surrogateescape")
+        position += length
+    return headers
+
+
+def parse_gnu_sparse_map(block: bytes, start: int, count: int) -> List[Tuple[int, int]]:
+    sparse_map = []
+    for i in range(count):
+        entry = block[start + i * 24 : start + (i + 1) * 24]
+        offset, numbytes = parse_tar_number(entry[:12]), parse_tar_number(entry[12:])
+        if offset == 0 and numbytes == 0:
+            break
+        sparse_map.append((offset, numbytes))
+    return sparse_map
+
+
+class TarMemberExtractor:
+    """
+    Push parser for tar archives that extracts a single member.
+    Supports ustar, GNU (long names, base-256 sizes, sparse members) and pax headers.
+    """
+
+    def __init__(self, member_name: str, output_path: Path):
+        self.member_name = normalize_member_name(member_name)
+        self.output_path = output_path
+
+        self._decompressor = StreamDecompressor(self._parse_decompressed)
+        self._buffer = bytearray()
+        self._sha256 = hashlib.sha256()
+        self._writer: Optional[SparseFileWriter] = None
+        self._result: Optional[ExtractedMember] = None
+        self._end_of_archive = False
+
+        # Metadata that applies to the next member
+        self._long_name: Optional[str] = None
+        self._pax_headers: Dict[str, str] = {}
+
+        # Data of the current member
+        self._remaining = 0
+        self._padding = 0
+        self._on_data: Optional[Callable[[bytes], None]] = None
+        self._on_data_end: Optional[Callable[[], None]] = None
+
+        # Layout of the member being extracted
+        self._sparse_map: List[Tuple[int, int]] = []
+        self._sparse_map_continues = False
+        self._archived_size = 0
+        self._real_size = 0
+        self._segment_index = 0
+        self._segment_offset = 0
+        self._logical_offset = 0
+
+    @property
+    def done(self) -> bool:
+        return self._result is not None or self._end_of_archive
+
+    def feed(self, data: bytes) -> None:
+        if self.done:
+            return
+        self._decompressor.decompress(data)
+
+    def finish(self) -> ExtractedMember:
+        """
+        Signals the end of the stream and returns the extracted member.
+        """
+        if not self.done:
+            self._decompressor.flush()
+
+        if self._result is None:
+            truncated = self._writer is not None
+            self.abort()
+            if truncated:
+                raise ImageIngestError("Truncated tarball")
+            raise ImageIngestError(f"'{self.member_name}' not found in the tarball")
+        return self._result
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            self._writer.close(self._writer.size)
+            self._writer = None
+        self.output_path.unlink(missing_ok=True)
+
+    def _parse_decompressed(self, data: bytes) -> None:
+        # Each piece is parsed before the next one is decompressed, the buffer
+        # only keeps an incomplete header
+        if self.done:
+            return
+        self._buffer.extend(data)
+        self._parse()
+
+    def _next_block(self) -> Optional[bytes]:
+        if len(self._buffer) < TAR_BLOCK_SIZE:
+            return None
+        block = bytes(self._buffer[:TAR_BLOCK_SIZE])
+        del self._buffer[:TAR_BLOCK_SIZE]
+        return block
+
+    def _parse(self) -> None:
+        while not self.done:
+            if self._remaining or self._padding:
+                if not self._consume_data():
+                    return
+                continue
+
+            block = self._next_block()
+            if block is None:
+                return
+            if self._sparse_map_continues:
+                self._read_sparse_extension(block)
+            else:
+                self._read_header(block)
+
+    def _consume_data(self) -> bool:
+        if self._remaining:
+            if not self._buffer:
+                return False
+            size = min(self._remaining, len(self._buffer))
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._remaining -= size
+            if self._on_data is not None:
+                self._on_data(data)
+            if not self._remaining:
+                self._end_data()
+            return True
+
+        size = min(self._padding, len(self._buffer))
+        if not size:
+            return False
+        del self._buffer[:size]
+        self._padding -= size
+        return True
+
+    def _start_data(
+        self,
+        size: int,
+        on_data: Optional[Callable[[bytes], None]] = None,
+        on_data_end: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self._remaining = size
+        self._padding = -size % TAR_BLOCK_SIZE
+        self._on_data = on_data
+        self._on_data_end = on_data_end
+        if size == 0:
+            self._end_data()
+
+    def _end_data(self) -> None:
+        on_data_end, self._on_data_end = self._on_data_end, None
+        self._on_data = None
+        if on_data_end is not None:
+            on_data_end()
+
+    def _read_header(self, block: bytes) -> None:
+        if block == bytes(TAR_BLOCK_SIZE):
+            self._end_of_archive = True
+            return
+
+        checksum = parse_tar_number(block[148:156])
+        if checksum != sum(block[:148]) + 8 * ord(" ") + sum(block[156:]):
+            raise ImageIngestError("Invalid tar header checksum")
+
+        size = parse_tar_number(block[124:136])
+        typeflag = block[156:157]
+
+        if typeflag == b"L":
+            long_name = bytearray()
+
+            def set_long_name():
+                self._long_name = parse_tar_string(bytes(long_name))
+
+            self._start_data(size, long_name.extend, set_long_name)
+            return
+
+        if typeflag == b"x":
+            pax_data = bytearray()
+
+            def set_pax_headers():
+                self._pax_headers = parse_pax_headers(bytes(pax_data))
+
+            self._start_data(size, pax_data.extend, set_pax_headers)
+            return
+
+        name = self._member_name(block)
+        pax_headers, self._pax_headers = self._pax_headers, {}
+        if "size" in pax_headers:
+            size = int(pax_headers["size"])
+
+        if typeflag in TAR_NO_DATA_TYPES:
+            return
+        if typeflag not in TAR_FILE_TYPES:
+            self._start_data(size)
+            return
+
+        sparse_pax_headers = any(key.startswith("GNU.sparse.") for key in pax_headers)
+        if sparse_pax_headers and "GNU.sparse.name" in pax_headers:
+            # The name of the header is a placeholder for PAX sparse members
+            name = pax_headers["GNU.sparse.name"]
+        if normalize_member_name(name) != self.member_name:
+            self._start_data(size)
+            return
+        if sparse_pax_headers:
+            raise ImageIngestError(
+                f"'{self.member_name}' is a PAX sparse member, which is not supported"
+            )
+
+        if typeflag == b"S":
+            # Old GNU sparse format: the data only contains the non-hole segments
+            self._sparse_map = parse_gnu_sparse_map(block, 386, 4)
+            self._sparse_map_continues = bool(block[482])
+            self._real_size = parse_tar_number(block[483:495])
+        else:
+            self._sparse_map = [(0, size)]
+            self._sparse_map_continues = False
+            self._real_size = size
+
+        self._archived_size = size
+        self._writer = SparseFileWriter(self.output_path)
+        if not self._sparse_map_continues:
+            self._start_member_data()
+
+    def _read_sparse_extension(self, block: bytes) -> None:
+        self._sparse_map.extend(parse_gnu_sparse_map(block, 0, 21))
+        self._sparse_map_continues = bool(block[504])
+        if not self._sparse_map_continues:
+            self._start_member_data()
+
+    def _member_name(self, block: bytes) -> str:
+        if self._long_name is not None:
+            name, self._long_name = self._long_name, None
+            return name
+        if "path" in self._pax_headers:
+            return self._pax_headers["path"]
+
+        name = parse_tar_string(block[0:100])
+        if block[257:265] == b"ustar\x0000":
+            prefix = parse_tar_string(block[345:500])
+            if prefix:
+                name = f"{prefix}/{name}"
+        return name
+
+    def _start_member_data(self) -> None:
+        self._segment_index = 0
+        self._segment_offset = 0
+        self._logical_offset = 0
+        self._start_data(
+            self._archived_size, self._write_member_data, self._complete_member
+        )
+
+    def _hash_zeros(self, size: int) -> None:
+        while size > 0:
+            chunk = min(size, SPARSE_BLOCK_SIZE)
+            self._sha256.update(_ZERO_BLOCK[:chunk])
+            size -= chunk
+
+    def _write_member_data(self, data: bytes) -> None:
+        """
+        Writes archived data at its position in the extracted file, following the sparse map.
+        """
+        position = 0
+        while position < len(data):
+            if self._segment_index >= len(self._sparse_map):
+                raise ImageIngestError("Tar member data exceeds its sparse map")
+
+            segment_start, segment_size = self._sparse_map[self._segment_index]
+            size = min(len(data) - position, segment_size - self._segment_offset)
+            chunk = data[position : position + size]
+            file_offset = segment_start + self._segment_offset
+
+            # Holes between segments are part of the content
+            self._hash_zeros(file_offset - self._logical_offset)
+            self._sha256.update(chunk)
+            self._writer.write_at(file_offset, chunk)
+
+            self._logical_offset = file_offset + size
+            self._segment_offset += size
+            position += size
+            if self._segment_offset == segment_size:
+                self._segment_index += 1
+                self._segment_offset = 0
+
+    def _complete_member(self) -> None:
+        self._hash_zeros(self._real_size - self._logical_offset)
+        self._writer.close(self._real_size)
+        self._writer = None
+        self._result = ExtractedMember(
+            digest=self._sha256.hexdigest(), size=self._real_size
+        )
+
+
+async def extract_tar_member(
+    stream: AsyncIterator[bytes], member_name: str, output_path: Path
+) -> ExtractedMember:
+    """
+    Extracts one member of a (compressed) tarball while it is being received.
+
+    Parsing and writing run in a worker thread on batches of `INGEST_BUFFER_SIZE`
+    bytes to keep the event loop responsive.
+
+    :param stream: Content of the tarball.
+    :param member_name: Name of the file to extract.
+    :param output_path: Destination of the extracted file.
+    :return: The digest and size of the extracted file.
+    """
+    extractor = TarMemberExtractor(member_name, output_path)
+    batch = bytearray()
+    try:
+        async for chunk in stream:
+            if extractor.done:
+                # Drain the rest of the request body
+                continue
+            batch.extend(chunk)
+            if len(batch) >= INGEST_BUFFER_SIZE:
+                await asyncio.to_thread(extractor.feed, bytes(batch))
+                batch.clear()
+
+        if batch:
+            await asyncio.to_thread(extractor.feed, bytes(batch))
+        return await asyncio.to_thread(extractor.finish)
+
+    except BaseException:
+        extractor.abort()
+        raise
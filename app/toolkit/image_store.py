@@ -0,0 +1,286 @@
+"""
+Content-addressed store for VM disk images.
+
+Images are stored once, under their SHA256 digest. VMs never write to the stored
+images: each VM boots from its own copy-on-write overlay, either a reflink clone
+of the image (on filesystems that support it, ex: XFS, Btrfs) or a qcow2 file
+using the stored image as its read-only backing file. The overlay holds the data
+written by the guest and is kept across restarts of the VM.
+
+Images that no VM uses anymore are moved to the trash of the store, on the same
+filesystem, and removed in the background.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from settings import settings
+from toolkit.host_lock import HostLock
+from toolkit.trash import Trash
+
+logger = logging.getLogger(__name__)
+
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+# From linux/fs.h
+FICLONE = 0x40049409
+# Digest of the image that the overlay of a VM was created from
+OVERLAY_DIGEST_FILENAME = "disk.digest"
+OVERLAY_FILENAMES = {"raw": "disk.img", "qcow2": "disk.qcow2"}
+
+
+class OverlayMode(str, Enum):
+    # Use a reflink clone if the filesystem supports it, otherwise a qcow2 overlay
+    AUTO = "auto"
+    REFLINK = "reflink"
+    QCOW2 = "qcow2"
+
+
+@dataclass
+class VmDisk:
+    path: Path
+    format: str
+
+
+@dataclass
+class ImageStoreStats:
+    hits: int = 0
+    misses: int = 0
+    overlays: int = 0
+    bytes_saved: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def hash_file(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(HASH_BUFFER_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def reflink(source: Path, destination: Path) -> None:
+    """
+    Clones `source` to `destination` without copying data.
+    Raises OSError if the filesystem does not support reflinks.
+    """
+    with source.open("rb") as src, destination.open("wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            destination.unlink()
+            raise
+
+
+class ImageStore:
+    def __init__(self, root: Path, overlay_mode: OverlayMode = OverlayMode.AUTO):
+        self.root = root
+        self.images_dir = root / "images"
+        self.tmp_dir = root / "tmp"
+        self.overlay_mode = overlay_mode
+        self.trash = Trash(root / "trash")
+        self.stats = ImageStoreStats()
+
+        # (path, size, mtime) -> digest, to avoid hashing external images twice
+        self._external_digests: Dict[Tuple[str, int, int], str] = {}
+        # Shared by the workers, so that an image is never removed while a worker
+        # reuses it
+        self._lock = HostLock("image_store")
+
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def image_path(self, digest: str) -> Path:
+        return self.images_dir / f"{digest}.img"
+
+    def has_image(self, digest: str) -> bool:
+        return self.image_path(digest).is_file()
+
+    @property
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in self.images_dir.glob("*.img"))
+
+    async def _store(self, path: Path, digest: str, move: bool) -> str:
+        image_path = self.image_path(digest)
+        async with self._lock:
+            if image_path.is_file():
+                # Keeps the image from being removed until a VM uses it
+                os.utime(image_path)
+                self.stats.hits += 1
+                self.stats.bytes_saved += path.stat().st_size
+                if move:
+                    path.unlink()
+                return digest
+
+            self.stats.misses += 1
+            if move:
+                # Falls back to a copy if the file is on another filesystem
+                await asyncio.to_thread(shutil.move, path, image_path)
+            else:
+                tmp_path = self.tmp_dir / digest
+                await asyncio.to_thread(shutil.copyfile, path, tmp_path)
+                os.replace(tmp_path, image_path)
+
+        # Stored images are shared between VMs and must never be modified
+        image_path.chmod(0o444)
+        return digest
+
+    async def add_file(self, path: Path, digest: Optional[str] = None) -> str:
+        """
+        Moves a file into the store. If the store already contains an identical image,
+        the file is deleted.
+
+        :param path: Path of the image. Moving is instantaneous if the file is on
+                     the same filesystem as the store.
+        :param digest: SHA256 digest of the image, if already known.
+        :return: The digest of the image.
+        """
+        if digest is None:
+            digest = await asyncio.to_thread(hash_file, path)
+        return await self._store(path, digest, move=True)
+
+    async def import_file(self, path: Path) -> str:
+        """
+        Copies an image that lives outside the store, ex: the default image.
+        The digest is cached as long as the file is not modified.
+        """
+        stat = path.stat()
+        cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._external_digests.get(cache_key)
+        if digest is None:
+            digest = await asyncio.to_thread(hash_file, path)
+            self._external_digests[cache_key] = digest
+
+        return await self._store(path, digest, move=False)
+
+    async def remove_unused_images(
+        self, used_digests: Set[str], grace_period: float
+    ) -> int:
+        """
+        Removes the images that no VM uses. Images stored or reused less than
+        `grace_period` seconds ago are kept, as the VM that uses them may not be
+        saved yet.
+
+        :param used_digests: Digests of the images used by the VMs.
+        :return: The number of bytes freed.
+        """
+        freed = 0
+        async with self._lock:
+            for image_path in self.images_dir.glob("*.img"):
+                if image_path.stem in used_digests:
+                    continue
+                try:
+                    stat = image_path.stat()
+                except FileNotFoundError:
+                    continue
+                if time.time() - stat.st_mtime < grace_period:
+                    continue
+
+                logger.info("Removing unused image %s", image_path.stem)
+                self.trash.discard(image_path)
+                freed += stat.st_size
+        return freed
+
+    async def _create_qcow2_overlay(self, image_path: Path, overlay_path: Path) -> None:
+        process = await asyncio.create_subprocess_exec(
+            "qemu-img",
+            "create",
+            "-q",
+            "-f",
+            "qcow2",
+            "-F",
+            "raw",
+            "-b",
+            str(image_path.absolute()),
+            str(overlay_path),
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"Could not create qcow2 overlay: {stderr.decode()}")
+
+    def find_overlay(self, digest: str, vm_dir: Path) -> Optional[VmDisk]:
+        """
+        Returns the overlay created for a VM by a previous launch, if it is backed by
+        the image `digest`.
+        """
+        try:
+            overlay_digest = (vm_dir / OVERLAY_DIGEST_FILENAME).read_text().strip()
+        except FileNotFoundError:
+            return None
+        if overlay_digest != digest:
+            return None
+
+        for disk_format, filename in OVERLAY_FILENAMES.items():
+            if (vm_dir / filename).is_file():
+                return VmDisk(path=vm_dir / filename, format=disk_format)
+        return None
+
+    async def get_overlay(self, digest: str, vm_dir: Path) -> VmDisk:
+        """
+        Returns the copy-on-write disk of a VM, backed by a stored image. The disk is
+        created on the first launch of the VM, or when the VM got another image.
+        Later launches reuse it, so that the guest keeps its data across restarts.
+
+        :param digest: Digest of the stored image.
+        :param vm_dir: Working directory of the VM, where the overlay is created.
+        :return: The path and format of the VM disk.
+        """
+        disk = self.find_overlay(digest, vm_dir)
+        if disk is not None:
+            return disk
+
+        image_path = self.image_path(digest)
+        if not image_path.is_file():
+            raise FileNotFoundError(f"Image {digest} is not in the image store")
+
+        vm_dir.mkdir(parents=True, exist_ok=True)
+        # The overlay of the previous image of the VM, if any
+        digest_path = vm_dir / OVERLAY_DIGEST_FILENAME
+        digest_path.unlink(missing_ok=True)
+        for filename in OVERLAY_FILENAMES.values():
+            (vm_dir / filename).unlink(missing_ok=True)
+
+        if self.overlay_mode != OverlayMode.QCOW2:
+            raw_path = vm_dir / OVERLAY_FILENAMES["raw"]
+            try:
+                await asyncio.to_thread(reflink, image_path, raw_path)
+                raw_path.chmod(0o644)
+                disk = VmDisk(path=raw_path, format="raw")
+            except OSError as e:
+                if self.overlay_mode == OverlayMode.REFLINK:
+                    raise
+                logger.debug("Reflinks not supported, using a qcow2 overlay: %s", e)
+
+        if disk is None:
+            qcow2_path = vm_dir / OVERLAY_FILENAMES["qcow2"]
+            await self._create_qcow2_overlay(image_path, qcow2_path)
+            disk = VmDisk(path=qcow2_path, format="qcow2")
+
+        # Written last, so that an overlay being created is never reused
+        tmp_digest_path = digest_path.with_suffix(".tmp")
+        tmp_digest_path.write_text(digest)
+        os.replace(tmp_digest_path, digest_path)
+
+        self.stats.overlays += 1
+        self.stats.bytes_saved += image_path.stat().st_size
+        return disk
+
+
+image_store = ImageStore(
+    root=settings.image_store_dir,
+    overlay_mode=OverlayMode(settings.image_store_overlay_mode),
+)
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[str], Awaitable[None]]
+
+
+class JobQueue:
+    """
+    FIFO queue of background jobs, processed by a fixed number of workers.
+    The number of workers bounds the number of jobs running concurrently.
+    A job submitted again while it is queued or running is ignored.
+    """
+
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.running = 0
+
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        # Queued and running jobs
+        self._pending: Set[str] = set()
+        self._handler: Optional[JobHandler] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def start(self, handler: JobHandler) -> None:
+        self._handler = handler
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"{self.name}-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+
+    def submit(self, job_id: str) -> None:
+        if job_id in self._pending:
+            return
+        self._pending.add(job_id)
+        self._queue.put_nowait(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            self.running += 1
+            try:
+                await self._handler(job_id)
+            except Exception:
+                logger.exception("Job %s of queue %s failed", job_id, self.name)
+            finally:
+                self._pending.discard(job_id)
+                self.running -= 1
+                self._queue.task_done()
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
@@ -0,0 +1,156 @@
+"""
+Expected launch measurement of the SEV VMs.
+
+While Qemu launches a VM, the PSP measures the firmware pages passed with
+LAUNCH_UPDATE_DATA into the launch digest GCTX.LD: the SHA-256 of their content, in
+order. LAUNCH_MEASURE then returns the HMAC-SHA256, with the TIK of the guest owner, of
+
+    0x04 || API_MAJOR || API_MINOR || BUILD || POLICY || GCTX.LD || MNONCE
+
+The API computes the expected launch digest and these bytes, so that the guest owner
+only has to compute the HMAC with its TIK to verify the measurement of a VM.
+
+Launch digests are indexed by the SHA-256 of the firmware file and the policy. The
+firmware of each VM is recorded at launch, so VMs launched with a previous build of
+the firmware can still be verified after the firmware is updated. SEV-ES also
+measures the initial state of the vCPUs, no digest is expected for these policies.
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SEV_PAGE_SIZE = 4096
+# Pages hashed per read of the firmware file
+PAGES_PER_READ = 256
+# Policy bit of SEV-ES guests
+SEV_POLICY_ES = 0x04
+# Sizes of the fields of the data returned by LAUNCH_MEASURE
+MEASUREMENT_SIZE = 32
+MNONCE_SIZE = 16
+LAUNCH_MEASURE_CONTEXT = 0x04
+
+
+@dataclass(frozen=True)
+class ExpectedLaunchMeasure:
+    # Expected GCTX.LD, in hexadecimal
+    launch_digest: str
+    # Bytes authenticated by the measurement, in base64
+    measured_data: str
+
+
+def hash_firmware(path: Path) -> str:
+    """
+    Hashes the pages of a firmware file in the order the PSP measures them.
+    """
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while pages := f.read(SEV_PAGE_SIZE * PAGES_PER_READ):
+            sha256.update(pages)
+    return sha256.hexdigest()
+
+
+def get_measured_data(
+    api_major: int,
+    api_minor: int,
+    build: int,
+    policy: int,
+    launch_digest: bytes,
+    mnonce: bytes,
+) -> bytes:
+    return (
+        struct.pack("<BBBBI", LAUNCH_MEASURE_CONTEXT, api_major, api_minor, build, policy)
+        + launch_digest
+        + mnonce
+    )
+
+
+class FirmwareDigestIndex:
+    def __init__(self):
+        # SHA-256 of the firmware files, by path and version of the file
+        self._firmware_digests: Dict[Tuple[Path, int, int, int], str] = {}
+        # Launch digests by SHA-256 of the firmware and policy
+        self._launch_digests: Dict[Tuple[str, int], Optional[bytes]] = {}
+        self._known_firmwares: Set[str] = set()
+
+    async def add_firmware(self, path: Path) -> str:
+        """
+        Returns the SHA-256 of a firmware file, hashed in a thread the first time
+        and when the file changes.
+        """
+        stat = path.stat()
+        key = (path.absolute(), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        firmware_digest = self._firmware_digests.get(key)
+        if firmware_digest is None:
+            firmware_digest = await asyncio.to_thread(hash_firmware, path)
+            self._firmware_digests[key] = firmware_digest
+            self._known_firmwares.add(firmware_digest)
+            logger.info("Firmware %s has digest %s", path, firmware_digest)
+        return firmware_digest
+
+    def get_launch_digest(self, firmware_digest: str, policy: int) -> Optional[bytes]:
+        """
+        Returns the launch digest of VMs launched with a firmware and policy, or None
+        if it cannot be computed.
+        """
+        key = (firmware_digest, policy)
+        if key not in self._launch_digests:
+            if firmware_digest not in self._known_firmwares:
+                # Hashed by a previous run of the API, the file may have changed since
+                return None
+            if policy & SEV_POLICY_ES:
+                launch_digest = None
+            else:
+                # The firmware is the only data measured
+                launch_digest = bytes.fromhex(firmware_digest)
+            self._launch_digests[key] = launch_digest
+        return self._launch_digests[key]
+
+    def get_expected_launch_measure(
+        self,
+        firmware_digest: Optional[str],
+        api_major: int,
+        api_minor: int,
+        build: int,
+        policy: int,
+        launch_measure: str,
+    ) -> Optional[ExpectedLaunchMeasure]:
+        """
+        Returns what the guest owner should verify `launch_measure` against, the
+        measurement returned by Qemu, or None if it cannot be computed.
+        """
+        if firmware_digest is None:
+            return None
+        launch_digest = self.get_launch_digest(firmware_digest, policy)
+        if launch_digest is None:
+            return None
+
+        try:
+            measure = base64.b64decode(launch_measure, validate=True)
+        except ValueError:
+            return None
+        if len(measure) != MEASUREMENT_SIZE + MNONCE_SIZE:
+            return None
+
+        measured_data = get_measured_data(
+            api_major=api_major,
+            api_minor=api_minor,
+            build=build,
+            policy=policy,
+            launch_digest=launch_digest,
+            mnonce=measure[MEASUREMENT_SIZE:],
+        )
+        return ExpectedLaunchMeasure(
+            launch_digest=launch_digest.hex(),
+            measured_data=base64.b64encode(measured_data).decode(),
+        )
+
+
+firmware_digest_index = FirmwareDigestIndex()
@@ -0,0 +1,264 @@
+"""
+Election of the leader among the worker processes of the API, and calls from the
+other workers to the leader.
+
+The leader holds an exclusive lock on a file of the runtime directory. The kernel
+releases it when the leader exits, and the next worker that tries takes over.
+The leader serves the other workers on a UNIX socket of the runtime directory,
+with one JSON message per line: a request {"method": ..., "params": {...}} is
+answered with {"result": ...} or {"error": {"type": ..., "message": ...}}, or with
+a message per line until the connection is closed for streams.
+"""
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from toolkit.host_lock import get_runtime_dir
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK_FILENAME = "leader.lock"
+LEADER_SOCKET_FILENAME = "leader.sock"
+# Maximum size of a message
+LEADER_MESSAGE_LIMIT = 16 * 1024 * 1024
+LEADER_CALL_TIMEOUT = 60.0
+
+Handler = Callable[..., Awaitable[Any]]
+StreamHandler = Callable[..., AsyncIterator[Any]]
+
+
+class LeaderUnavailableError(ConnectionError):
+    """
+    No leader serves the other workers, ex: while a worker takes over.
+    """
+
+
+class LeaderCallError(Exception):
+    """
+    The leader could not handle a call.
+    """
+
+    def __init__(self, error_type: str, message: str):
+        self.error_type = error_type
+        self.message = message
+        super().__init__(f"{error_type}: {message}")
+
+
+def encode_message(message: Any) -> bytes:
+    return json.dumps(message).encode() + b"\n"
+
+
+class LeaderElection:
+    def __init__(self):
+        self.is_leader = False
+        self._fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        fd = os.open(
+            get_runtime_dir() / LEADER_LOCK_FILENAME, os.O_RDWR | os.O_CREAT, 0o600
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        self._fd = fd
+        self.is_leader = True
+        return True
+
+    async def run(
+        self,
+        on_elected: Callable[[], Awaitable[None]],
+        on_follow: Callable[[], Awaitable[None]],
+        on_resign: Callable[[], Awaitable[None]],
+        interval: float,
+    ) -> None:
+        """
+        Tries to become the leader every `interval` seconds, and calls `on_follow`
+        between the attempts. Calls `on_elected` once elected. If `on_elected`
+        fails, calls `on_resign` to stop what it started and releases the lock, so
+        that another worker can take over, then keeps trying.
+        """
+        while True:
+            while not self.try_acquire():
+                try:
+                    await on_follow()
+                except Exception:
+                    logger.exception("Could not follow the leader")
+                await asyncio.sleep(interval)
+
+            logger.info("Worker %d elected as leader", os.getpid())
+            try:
+                await on_elected()
+                return
+            except Exception:
+                logger.exception("Worker %d could not take over as leader", os.getpid())
+
+            try:
+                await on_resign()
+            except Exception:
+                logger.exception("Could not stop leading")
+            self.release()
+            await asyncio.sleep(interval)
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.is_leader = False
+
+
+class LeaderServer:
+    """
+    Serves the calls of the other workers, in the leader.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self._stream_handlers: Dict[str, StreamHandler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+
+    def register(self, method: str, handler: Handler) -> None:
+        """
+        Registers a coroutine called with the parameters of the calls to `method`.
+        """
+        self._handlers[method] = handler
+
+    def register_stream(self, method: str, handler: StreamHandler) -> None:
+        """
+        Registers an async generator called with the parameters of the calls to
+        `method`, each message it yields is sent to the caller.
+        """
+        self._stream_handlers[method] = handler
+
+    async def start(self) -> None:
+        socket_path = get_runtime_dir() / LEADER_SOCKET_FILENAME
+        # Left by a previous leader, only the leader uses this path
+        socket_path.unlink(missing_ok=True)
+        self._server = await asyncio.start_unix_server(
+            self._serve, path=socket_path, limit=LEADER_MESSAGE_LIMIT
+        )
+        os.chmod(socket_path, 0o600)
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            request = json.loads(await reader.readline())
+            method = request["method"]
+            params = request.get("params", {})
+
+            if method in self._stream_handlers:
+                async for message in self._stream_handlers[method](**params):
+                    writer.write(encode_message(message))
+                    await writer.drain()
+                return
+
+            try:
+                reply = {"result": await self._handlers[method](**params)}
+            except Exception as e:
+                reply = {"error": {"type": type(e).__name__, "message": str(e)}}
+            writer.write(encode_message(reply))
+            await writer.drain()
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug("Dropping a connection of a worker: %s", e)
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def close(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+
+async def open_leader_connection(
+    method: str, params: Dict[str, Any]
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    try:
+        reader, writer = await asyncio.open_unix_connection(
+            get_runtime_dir() / LEADER_SOCKET_FILENAME, limit=LEADER_MESSAGE_LIMIT
+        )
+    except OSError as e:
+        raise LeaderUnavailableError(f"Could not reach the leader: {e}") from e
+
+    try:
+        writer.write(encode_message({"method": method, "params": params}))
+        await writer.drain()
+    except OSError as e:
+        writer.close()
+        raise LeaderUnavailableError(f"Could not reach the leader: {e}") from e
+    return reader, writer
+
+
+async def call_leader(
+    method: str, timeout: float = LEADER_CALL_TIMEOUT, **params
+) -> Any:
+    """
+    Calls a method of the leader and returns its result.
+
+    :raises LeaderUnavailableError: No leader answered.
+    :raises LeaderCallError: The method failed in the leader.
+    """
+    reader, writer = await open_leader_connection(method, params)
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout=timeout)
+    except OSError as e:
+        raise LeaderUnavailableError(f"Connection to the leader lost: {e}") from e
+    finally:
+        writer.close()
+    if not line:
+        raise LeaderUnavailableError("The leader closed the connection")
+
+    reply = json.loads(line)
+    if "error" in reply:
+        raise LeaderCallError(reply["error"]["type"], reply["error"]["message"])
+    return reply["result"]
+
+
+async def stream_from_leader(method: str, **params) -> AsyncIterator[Any]:
+    """
+    Yields the messages of a stream of the leader, until the leader closes it.
+    """
+    reader, writer = await open_leader_connection(method, params)
+    try:
+        while line := await reader.readline():
+            yield json.loads(line)
+    finally:
+        writer.close()
+
+
+_notification_tasks: Set[asyncio.Task] = set()
+
+
+def notify_leader(method: str, **params) -> None:
+    """
+    Calls a method of the leader in the background, errors are only logged.
+    """
+
+    async def notify() -> None:
+        try:
+            await call_leader(method, **params)
+        except (LeaderUnavailableError, LeaderCallError, asyncio.TimeoutError) as e:
+            logger.warning("Could not call %s on the leader: %s", method, e)
+
+    task = asyncio.create_task(notify())
+    _notification_tasks.add(task)
+    task.add_done_callback(_notification_tasks.discard)
+
+
+leader_election = LeaderElection()
+leader_server = LeaderServer()
@@ -0,0 +1,163 @@
+"""
+Prometheus metrics of the API.
+
+Metric children (one per label combination) are resolved once and kept, so that
+recording a value on a hot path is only a timer read and a counter update.
+
+With several workers, each worker writes its metrics to files of the runtime
+directory and the metrics of all the workers are aggregated when they are
+scraped, whichever worker answers.
+"""
+
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable, Coroutine, Dict, Iterator
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    Metric,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# Read by prometheus_client when it is imported
+MULTIPROCESS_DIR_VARIABLE = "PROMETHEUS_MULTIPROC_DIR"
+
+# Buckets of operations that usually complete in milliseconds
+FAST_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+# Buckets of operations that take seconds, ex: starting Qemu
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+REQUEST_DURATION = Histogram(
+    "scrn_http_request_duration_seconds",
+    "Time spent handling HTTP requests, by route",
+    ["method", "route"],
+    buckets=FAST_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "scrn_http_requests_in_flight",
+    "HTTP requests being handled, by route",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+DB_QUERY_DURATION = Histogram(
+    "scrn_db_query_duration_seconds",
+    "Time spent executing database queries, by operation",
+    ["operation"],
+    buckets=FAST_BUCKETS,
+)
+PASSWORD_VERIFY_DURATION = Histogram(
+    "scrn_password_verify_duration_seconds",
+    "Time spent verifying bcrypt password hashes",
+    buckets=FAST_BUCKETS,
+)
+QMP_COMMAND_DURATION = Histogram(
+    "scrn_qmp_command_duration_seconds",
+    "Round-trip time of QMP commands, by command",
+    ["command"],
+    buckets=FAST_BUCKETS,
+)
+QEMU_STARTUP_DURATION = Histogram(
+    "scrn_qemu_startup_duration_seconds",
+    "Time between spawning Qemu and its QMP socket being ready",
+    buckets=SLOW_BUCKETS,
+)
+
+DB_QUERY_DURATION_BY_OPERATION = {
+    operation: DB_QUERY_DURATION.labels(operation)
+    for operation in ("select", "insert", "update", "delete")
+}
+
+_qmp_command_durations: Dict[str, Histogram] = {}
+
+
+def get_qmp_command_duration(command: str) -> Histogram:
+    # QMP commands are a small, fixed set: children are never evicted
+    histogram = _qmp_command_durations.get(command)
+    if histogram is None:
+        histogram = QMP_COMMAND_DURATION.labels(command)
+        _qmp_command_durations[command] = histogram
+    return histogram
+
+
+class VmCountCollector:
+    """
+    Number of VMs by state, read from the database when the metrics are scraped.
+    """
+
+    def __init__(self, vm_counts: Dict[str, int]):
+        self.vm_counts = vm_counts
+
+    def collect(self) -> Iterator[Metric]:
+        vms = GaugeMetricFamily("scrn_vms", "Number of VMs, by state", labels=["state"])
+        for state, count in self.vm_counts.items():
+            vms.add_metric([state], count)
+        yield vms
+
+
+def prepare_multiprocess_metrics(directory: Path) -> None:
+    """
+    Makes the worker processes started after this call share their metrics
+    through files of `directory`. Removes the files of the previous run.
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir()
+    os.environ[MULTIPROCESS_DIR_VARIABLE] = str(directory)
+
+
+def mark_worker_dead() -> None:
+    """
+    Removes the in-flight requests of a stopping worker from the metrics.
+    """
+    if MULTIPROCESS_DIR_VARIABLE in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def generate_metrics(vm_counts: Dict[str, int]) -> bytes:
+    """
+    Returns the metrics of the API in the Prometheus text format.
+
+    :param vm_counts: Number of VMs by state.
+    """
+    registry = CollectorRegistry()
+    if MULTIPROCESS_DIR_VARIABLE in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        # The metrics of this worker
+        registry.register(REGISTRY)
+    registry.register(VmCountCollector(vm_counts))
+    return generate_latest(registry)
+
+
+class MetricsRoute(APIRoute):
+    """
+    API route that records the latency and the number of in-flight requests
+    of its endpoint.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[None, None, Response]]:
+        handler = super().get_route_handler()
+        method = ",".join(sorted(self.methods))
+        duration = REQUEST_DURATION.labels(method, self.path)
+        in_flight = REQUESTS_IN_FLIGHT.labels(method, self.path)
+
+        async def metrics_route_handler(request: Request) -> Response:
+            in_flight.inc()
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                duration.observe(time.perf_counter() - start)
+                in_flight.dec()
+
+        return metrics_route_handler
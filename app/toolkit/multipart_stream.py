@@ -0,0 +1,201 @@
+"""
+Streaming parser for multipart/form-data request bodies.
+
+Starlette spools uploaded files to temporary files before the endpoint runs.
+This parser hands over the content of each part as the request body arrives,
+so large uploads can be processed without being staged on disk.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+
+
+class MultipartStreamError(ValueError):
+    pass
+
+
+@dataclass
+class MultipartPart:
+    name: str
+    filename: Optional[str]
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+def parse_content_disposition(headers: Dict[str, str]) -> Tuple[str, Optional[str]]:
+    disposition = headers.get("content-disposition")
+    if disposition is None:
+        raise MultipartStreamError("Missing Content-Disposition header in multipart part")
+
+    _, options = parse_options_header(disposition)
+    name = options.get(b"name")
+    if name is None:
+        raise MultipartStreamError("Missing field name in multipart part")
+
+    filename = options.get(b"filename")
+    return name.decode(), filename.decode() if filename is not None else None
+
+
+async def iter_multipart(
+    content_type: str, stream: AsyncIterator[bytes]
+) -> AsyncIterator[Tuple[MultipartPart, bytes]]:
+    """
+    Iterates over the content of a multipart/form-data body.
+
+    Yields (part, data) tuples in the order of the body. The end of each part
+    is signalled by an empty `data` chunk.
+
+    :param content_type: Value of the Content-Type header of the request.
+    :param stream: The request body.
+    """
+    _, options = parse_options_header(content_type)
+    boundary = options.get(b"boundary")
+    if boundary is None:
+        raise MultipartStreamError("Missing boundary in multipart Content-Type")
+
+    # The parser is push-based: callbacks queue events that are yielded after each write
+    events: List[Tuple[str, Any]] = []
+    header_field = bytearray()
+    header_value = bytearray()
+    headers: Dict[str, str] = {}
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header_value.extend(data[start:end])
+
+    def on_header_end() -> None:
+        headers[header_field.decode().lower()] = header_value.decode()
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished() -> None:
+        # A chunk can contain several parts, keep the headers of each one
+        nonlocal headers
+        events.append(("begin", headers))
+        headers = {}
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        events.append(("data", data[start:end]))
+
+    def on_part_end() -> None:
+        events.append(("end", b""))
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        },
+    )
+
+    part: Optional[MultipartPart] = None
+    async for chunk in stream:
+        if not chunk:
+            continue
+
+        parser.write(chunk)
+        pending, events = events, []
+        data = bytearray()
+        for event, payload in pending:
+            if event == "begin":
+                name, filename = parse_content_disposition(payload)
+                part = MultipartPart(name=name, filename=filename, headers=payload)
+            elif event == "data":
+                data.extend(payload)
+            else:
+                if data:
+                    yield part, bytes(data)
+                    data.clear()
+                yield part, b""
+                part = None
+        if data:
+            yield part, bytes(data)
+
+    parser.finalize()
+
+
+async def iter_multipart_file(
+    content_type: str, stream: AsyncIterator[bytes], field_name: str
+) -> AsyncIterator[bytes]:
+    """
+    Yields the content of one field of a multipart/form-data body, ignoring the others.
+    """
+    found = False
+    async for part, data in iter_multipart(content_type, stream):
+        if part.name != field_name:
+            continue
+        found = True
+        if data:
+            yield data
+
+    if not found:
+        raise MultipartStreamError(f"Missing field '{field_name}' in multipart body")
+
+
+class MultipartReader:
+    """
+    Reads the parts of a multipart/form-data body one after the other, so that each
+    field can be handed over to a different consumer while the body arrives.
+    """
+
+    def __init__(self, content_type: str, stream: AsyncIterator[bytes]):
+        self._events = iter_multipart(content_type, stream).__aiter__()
+        self._first_data = b""
+        self._part_done = True
+
+    async def next_part(self) -> Optional[MultipartPart]:
+        """
+        Returns the next part, skipping what was not read of the current one, or None
+        at the end of the body.
+        """
+        async for _ in self.iter_data():
+            pass
+
+        try:
+            part, data = await self._events.__anext__()
+        except StopAsyncIteration:
+            return None
+        # An empty part only has its end event
+        self._first_data = data
+        self._part_done = not data
+        return part
+
+    async def iter_data(self) -> AsyncIterator[bytes]:
+        """
+        Yields the content of the current part.
+        """
+        if self._first_data:
+            data, self._first_data = self._first_data, b""
+            yield data
+
+        while not self._part_done:
+            try:
+                _, data = await self._events.__anext__()
+            except StopAsyncIteration:
+                raise MultipartStreamError("Truncated multipart body")
+            if data:
+                yield data
+            else:
+                self._part_done = True
+
+    async def read(self, max_size: int) -> bytes:
+        """
+        Returns the content of the current part.
+
+        :raises MultipartStreamError: The part is larger than `max_size`.
+        """
+        content = bytearray()
+        async for data in self.iter_data():
+            content.extend(data)
+            if len(content) > max_size:
+                raise MultipartStreamError(
+                    f"Multipart part larger than {max_size} bytes"
+                )
+        return bytes(content)
@@ -0,0 +1,246 @@
+"""
+NUMA-aware placement of VMs on the host.
+
+Each VM is assigned to a single NUMA node: its memory is bound to the node and its
+vCPUs are pinned to dedicated host CPUs of the same node, which avoids cross-node
+memory traffic. Guest memory is backed by hugepages when the node has enough of them
+to reduce TLB pressure.
+"""
+
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+SYSFS_NODE_DIR = Path("/sys/devices/system/node")
+
+
+@dataclass
+class NumaNode:
+    id: int
+    cpus: List[int]
+    # In MB
+    memory: int
+    hugepages_dir: Optional[Path] = None
+
+
+@dataclass
+class VmPlacement:
+    numa_node: Optional[int]
+    host_cpus: List[int] = field(default_factory=list)
+    # Size of the hugepages backing the guest memory (ex: "2M"), if any
+    hugepage_size: Optional[str] = None
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """
+    Parses a list of CPUs in the kernel format, ex: "0-3,8-11".
+    """
+    cpus = []
+    for cpu_range in cpu_list.strip().split(","):
+        if not cpu_range:
+            continue
+        start, _, end = cpu_range.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus: Iterable[int]) -> str:
+    return ",".join(str(cpu) for cpu in cpus)
+
+
+def parse_size(size: str) -> int:
+    """
+    Converts a size like "2M" or "1G" to kB.
+    """
+    units = {"K": 1, "M": 1024, "G": 1024 * 1024}
+    return int(size[:-1]) * units[size[-1].upper()]
+
+
+def read_node_memory(node_dir: Path) -> int:
+    with (node_dir / "meminfo").open() as f:
+        for line in f:
+            # Format: "Node 0 MemTotal:       65842052 kB"
+            if "MemTotal:" in line:
+                return int(line.split()[-2]) // 1024
+    return 0
+
+
+def read_numa_topology(
+    sysfs_node_dir: Path = SYSFS_NODE_DIR, hugepage_size: Optional[str] = None
+) -> List[NumaNode]:
+    """
+    Reads the NUMA nodes of the host from sysfs. Hosts without NUMA support are
+    reported as a single node.
+    """
+    node_dirs = sorted(
+        sysfs_node_dir.glob("node[0-9]*"), key=lambda path: int(path.name[4:])
+    )
+    if not node_dirs:
+        return [NumaNode(id=0, cpus=sorted(os.sched_getaffinity(0)), memory=0)]
+
+    nodes = []
+    for node_dir in node_dirs:
+        cpus = parse_cpu_list((node_dir / "cpulist").read_text())
+        if not cpus:
+            # Memory-only node
+            continue
+
+        hugepages_dir = None
+        if hugepage_size:
+            hugepages_dir = (
+                node_dir / "hugepages" / f"hugepages-{parse_size(hugepage_size)}kB"
+            )
+        nodes.append(
+            NumaNode(
+                id=int(node_dir.name[4:]),
+                cpus=cpus,
+                memory=read_node_memory(node_dir),
+                hugepages_dir=hugepages_dir,
+            )
+        )
+    return nodes
+
+
+def read_free_hugepages(node: NumaNode) -> int:
+    if node.hugepages_dir is None:
+        return 0
+    try:
+        return int((node.hugepages_dir / "free_hugepages").read_text())
+    except FileNotFoundError:
+        return 0
+
+
+class PlacementEngine:
+    """
+    Chooses a NUMA node and dedicated host CPUs for each VM.
+    """
+
+    def __init__(
+        self,
+        nodes: List[NumaNode],
+        reserved_cpus: Iterable[int] = (),
+        hugepage_size: Optional[str] = None,
+        pin_vcpus: bool = True,
+    ):
+        self.nodes = {node.id: node for node in nodes}
+        self.reserved_cpus = set(reserved_cpus)
+        self.hugepage_size = hugepage_size
+        self.pin_vcpus = pin_vcpus
+
+        # VM ID -> placement
+        self._placements: Dict[str, VmPlacement] = {}
+        # VM ID -> memory reserved on its node, in MB
+        self._memory: Dict[str, int] = {}
+        # VMs placed but whose memory is not allocated by Qemu yet
+        self._launching: Set[str] = set()
+
+    def load(self, vm_id: str, placement: VmPlacement, memory: int) -> None:
+        """
+        Records the placement of a VM started before the API.
+        """
+        self._placements[vm_id] = placement
+        self._memory[vm_id] = memory
+        self._launching.discard(vm_id)
+
+    def _used_cpus(self) -> Set[int]:
+        return {
+            cpu for placement in self._placements.values() for cpu in placement.host_cpus
+        }
+
+    def _node_memory_used(self, node_id: int, hugepages: bool) -> int:
+        return sum(
+            self._memory[vm_id]
+            for vm_id, placement in self._placements.items()
+            if placement.numa_node == node_id
+            and (placement.hugepage_size is not None) == hugepages
+        )
+
+    def _free_hugepage_memory(self, node: NumaNode) -> int:
+        """
+        Memory available as hugepages on the node, in MB.
+        """
+        if self.hugepage_size is None:
+            return 0
+
+        free = read_free_hugepages(node) * parse_size(self.hugepage_size) // 1024
+        # The kernel only counts the pages of a VM once Qemu allocated them
+        return free - sum(
+            self._memory[vm_id]
+            for vm_id in self._launching
+            if self._placements[vm_id].numa_node == node.id
+            and self._placements[vm_id].hugepage_size is not None
+        )
+
+    def place(self, vm_id: str, memory: int, cores: int) -> VmPlacement:
+        """
+        Places a VM on the node with the most free CPUs that can hold its memory.
+        VMs that do not fit on a single node are not bound to any node.
+
+        :param vm_id: ID of the VM.
+        :param memory: Memory of the VM, in MB.
+        :param cores: Number of vCPUs of the VM.
+        """
+        if vm_id in self._placements:
+            return self._placements[vm_id]
+
+        used_cpus = self._used_cpus() | self.reserved_cpus
+        candidates = []
+        for node in self.nodes.values():
+            free_cpus = [cpu for cpu in node.cpus if cpu not in used_cpus]
+            if self.pin_vcpus and len(free_cpus) < cores:
+                continue
+
+            hugepages = self._free_hugepage_memory(node) >= memory
+            if not hugepages and node.memory:
+                free_memory = node.memory - self._node_memory_used(node.id, False)
+                if free_memory < memory:
+                    continue
+            candidates.append((hugepages, len(free_cpus), node, free_cpus))
+
+        if not candidates:
+            logger.info("VM %s does not fit on a single NUMA node", vm_id)
+            placement = VmPlacement(numa_node=None)
+        else:
+            # Prefer hugepages, then the least loaded node
+            hugepages, _, node, free_cpus = max(
+                candidates, key=lambda candidate: (candidate[0], candidate[1])
+            )
+            placement = VmPlacement(
+                numa_node=node.id,
+                host_cpus=free_cpus[:cores] if self.pin_vcpus else [],
+                hugepage_size=self.hugepage_size if hugepages else None,
+            )
+
+        self._placements[vm_id] = placement
+        self._memory[vm_id] = memory
+        self._launching.add(vm_id)
+        return placement
+
+    def mark_launched(self, vm_id: str) -> None:
+        """
+        Signals that the memory of the VM is allocated by Qemu.
+        """
+        self._launching.discard(vm_id)
+
+    def release(self, vm_id: str) -> None:
+        self._placements.pop(vm_id, None)
+        self._memory.pop(vm_id, None)
+        self._launching.discard(vm_id)
+
+
+def pin_thread(thread_id: int, cpus: Iterable[int]) -> None:
+    os.sched_setaffinity(thread_id, set(cpus))
+
+
+placement_engine = PlacementEngine(
+    nodes=read_numa_topology(hugepage_size=settings.vm_hugepage_size),
+    reserved_cpus=parse_cpu_list(settings.host_reserved_cpus),
+    hugepage_size=settings.vm_hugepage_size,
+    pin_vcpus=settings.vm_pin_vcpus,
+)
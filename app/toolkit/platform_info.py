@@ -0,0 +1,259 @@
+"""
+Status of the SEV platform and its certificates, as reported by sevctl.
+
+Running sevctl takes time, so its results are cached. The status is stored in the
+`firmware_info` table, shared by the workers, and in memory for at most
+`platform_info_ttl` seconds. The leader refreshes it in the background every
+`platform_info_refresh_interval` seconds, so requests rarely wait for sevctl.
+Concurrent refreshes are merged: a worker runs a single sevctl process at a time,
+and the workers refresh one after the other, reusing the status read by the
+previous one.
+
+A new firmware build or platform state invalidates what was derived from the
+previous status, ex: the exported certificates are exported again.
+"""
+
+import asyncio
+import datetime as dt
+import logging
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import delete, select
+
+from models.db import async_session
+from models.platform import FirmwareInfo
+from settings import settings
+from toolkit.host_lock import HostLock
+from toolkit.sevtool import SevClient, SevPlatformStatus
+
+logger = logging.getLogger(__name__)
+
+SEV_DIR = Path.cwd().absolute() / "sev_files"
+
+PlatformChangeListener = Callable[["PlatformInfo"], Awaitable[None]]
+
+
+class PlatformInfoUnavailableError(Exception):
+    """
+    The status of the platform could not be read, and none is cached.
+    """
+
+
+@dataclass(frozen=True)
+class PlatformInfo:
+    api_major: int
+    api_minor: int
+    platform_state: int
+    owner: int
+    config: int
+    build: int
+    update_datetime: dt.datetime
+
+    @classmethod
+    def from_firmware_info(cls, firmware_info: FirmwareInfo) -> "PlatformInfo":
+        return cls(
+            api_major=firmware_info.api_major,
+            api_minor=firmware_info.api_minor,
+            platform_state=firmware_info.platform_state,
+            owner=firmware_info.owner,
+            config=firmware_info.config,
+            build=firmware_info.build,
+            update_datetime=firmware_info.update_datetime,
+        )
+
+    @property
+    def age(self) -> float:
+        """
+        Time since the status was read with sevctl, in seconds.
+        """
+        return max((dt.datetime.utcnow() - self.update_datetime).total_seconds(), 0.0)
+
+    def is_same_firmware(self, other: "PlatformInfo") -> bool:
+        return (self.api_major, self.api_minor, self.build, self.platform_state) == (
+            other.api_major,
+            other.api_minor,
+            other.build,
+            other.platform_state,
+        )
+
+
+def firmware_info_from_status(
+    status: SevPlatformStatus, update_datetime: dt.datetime
+) -> FirmwareInfo:
+    return FirmwareInfo(
+        api_major=status.api_major,
+        api_minor=status.api_minor,
+        platform_state=status.platform_state,
+        owner=status.owner,
+        config=status.config,
+        build=status.build,
+        update_datetime=update_datetime,
+    )
+
+
+class PlatformInfoCache:
+    def __init__(self, sev_client: SevClient):
+        self.sev_client = sev_client
+        self._info: Optional[PlatformInfo] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._change_listeners: List[PlatformChangeListener] = []
+        # Shared by the workers, only one of them runs sevctl at a time
+        self._lock = HostLock("platform_info")
+
+    def add_change_listener(self, listener: PlatformChangeListener) -> None:
+        """
+        Registers a coroutine called with the new status when the firmware or the
+        state of the platform changes.
+        """
+        self._change_listeners.append(listener)
+
+    async def get(self) -> PlatformInfo:
+        """
+        Returns the status of the platform, refreshed if it is older than
+        `platform_info_ttl`. A stale status is returned if it cannot be refreshed.
+
+        :raises PlatformInfoUnavailableError: No status could be read.
+        """
+        if self._info is not None and self._info.age < settings.platform_info_ttl:
+            return self._info
+
+        try:
+            return await self.refresh(max_age=settings.platform_info_ttl)
+        except PlatformInfoUnavailableError:
+            if self._info is None:
+                raise
+            logger.warning("Using the platform status read %.0fs ago", self._info.age)
+            return self._info
+
+    def refresh(self, max_age: Optional[float] = None) -> Awaitable[PlatformInfo]:
+        """
+        Reads the status of the platform with sevctl, unless another worker read it
+        less than `max_age` seconds ago. Concurrent calls share the same refresh.
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh(max_age))
+            self._refresh_task.add_done_callback(self._on_refresh_done)
+        # Cancelling a caller must not cancel the refresh awaited by the others
+        return asyncio.shield(self._refresh_task)
+
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        self._refresh_task = None
+        if not task.cancelled():
+            # Retrieved even if all the callers were cancelled
+            task.exception()
+
+    async def _refresh(self, max_age: Optional[float]) -> PlatformInfo:
+        async with self._lock:
+            async with async_session() as session:
+                firmware_info = (
+                    await session.execute(select(FirmwareInfo))
+                ).scalar_one_or_none()
+            previous_info = None
+            if firmware_info is not None and firmware_info.update_datetime:
+                previous_info = PlatformInfo.from_firmware_info(firmware_info)
+                # Refreshed by another worker
+                if max_age is not None and previous_info.age < max_age:
+                    return self._update(previous_info)
+
+            try:
+                status = await asyncio.to_thread(self.sev_client.get_platform_status)
+            except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+                raise PlatformInfoUnavailableError(
+                    f"Could not read the status of the platform: {e}"
+                ) from e
+
+            firmware_info = firmware_info_from_status(
+                status, update_datetime=dt.datetime.utcnow()
+            )
+            info = PlatformInfo.from_firmware_info(firmware_info)
+            async with async_session() as session:
+                # The primary key is the API version, which can change
+                await session.execute(delete(FirmwareInfo))
+                session.add(firmware_info)
+                await session.commit()
+
+            if previous_info is not None and not info.is_same_firmware(previous_info):
+                logger.info(
+                    "SEV platform changed: API %d.%d build %d state %d, was API %d.%d "
+                    "build %d state %d",
+                    info.api_major,
+                    info.api_minor,
+                    info.build,
+                    info.platform_state,
+                    previous_info.api_major,
+                    previous_info.api_minor,
+                    previous_info.build,
+                    previous_info.platform_state,
+                )
+                for listener in self._change_listeners:
+                    try:
+                        await listener(info)
+                    except Exception:
+                        logger.exception("Could not handle the change of the platform")
+
+            return self._update(info)
+
+    def _update(self, info: PlatformInfo) -> PlatformInfo:
+        self._info = info
+        return info
+
+
+class CertificatesCache:
+    """
+    Certificates of the platform, exported with sevctl on first use.
+    """
+
+    def __init__(self, sev_client: SevClient):
+        self.sev_client = sev_client
+        # Shared by the workers, only one of them exports the certificates
+        self._lock = HostLock("sev_certificates")
+
+    async def get_archive(self) -> Path:
+        archive = self.sev_client.certificates_archive
+        if not archive.is_file():
+            async with self._lock:
+                # Exported by another request while waiting for the lock
+                if not archive.is_file():
+                    await asyncio.to_thread(self.sev_client.export_certificates)
+        return archive
+
+    async def export(self) -> None:
+        """
+        Exports the certificates again. The previous archive is served until the new
+        one replaces it.
+        """
+        async with self._lock:
+            await asyncio.to_thread(self.sev_client.export_certificates)
+
+
+sev_client = SevClient(SEV_DIR)
+platform_info_cache = PlatformInfoCache(sev_client)
+certificates_cache = CertificatesCache(sev_client)
+
+
+async def export_certificates_of_new_platform(info: PlatformInfo) -> None:
+    # The certificate chain of the platform changes with its firmware and state
+    await certificates_cache.export()
+
+
+platform_info_cache.add_change_listener(export_certificates_of_new_platform)
+
+
+async def run_platform_refresh_loop(interval: float) -> None:
+    """
+    Refreshes the status of the platform every `interval` seconds and exports its
+    certificates if they are missing, in the leader.
+    """
+    while True:
+        try:
+            await platform_info_cache.refresh(max_age=interval / 2)
+        except PlatformInfoUnavailableError as e:
+            logger.warning("%s", e)
+        try:
+            await certificates_cache.get_archive()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("Could not export the certificates of the platform: %s", e)
+        await asyncio.sleep(interval)
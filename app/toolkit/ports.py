@@ -0,0 +1,164 @@
+"""
+Allocation of the host ports of the VMs.
+
+Each VM leases its ports from configured ranges until its Qemu process exits.
+Leases are stored in the database, tied to the VM, and mirrored in memory by a
+free list per kind of port: allocating a port takes constant time and two VMs
+started concurrently never get the same port.
+"""
+
+from collections import deque
+from typing import Deque, Dict, Iterable, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.db import call_after_commit, call_after_rollback
+from models.ports import PortKind, PortLease
+from models.vm import Vm
+from settings import settings
+from toolkit.network import is_port_available
+
+
+class PortExhaustedError(Exception):
+    pass
+
+
+def parse_port_range(port_range: str) -> range:
+    """
+    Parses a range of ports, ex: "22000-23999".
+    """
+    first, _, last = port_range.partition("-")
+    ports = range(int(first), int(last or first) + 1)
+    if not ports or ports.start < 1 or ports.stop > 65536:
+        raise ValueError(f"Invalid port range: {port_range}")
+    return ports
+
+
+class PortAllocator:
+    """
+    Hands out the free ports of each range, least recently released first, so that
+    a port is not reused right after a VM stops.
+    """
+
+    def __init__(self, ranges: Dict[PortKind, range]):
+        for kind, ports in ranges.items():
+            for other_kind, other_ports in ranges.items():
+                overlap = ports.start < other_ports.stop and other_ports.start < ports.stop
+                if kind != other_kind and overlap:
+                    raise ValueError(
+                        f"The {kind.value} and {other_kind.value} port ranges overlap"
+                    )
+        self.ranges = ranges
+
+        self._free: Dict[PortKind, Deque[int]] = {
+            kind: deque(ports) for kind, ports in ranges.items()
+        }
+        # VM ID -> leased port -> kind
+        self._leases: Dict[str, Dict[int, PortKind]] = {}
+
+    def load(self, leases: Iterable[Tuple[str, PortKind, int]]) -> None:
+        """
+        Initializes the allocator from the leases of the VMs that are already running.
+        """
+        self._leases.clear()
+        for vm_id, kind, port in leases:
+            self._leases.setdefault(vm_id, {})[port] = kind
+
+        leased_ports = {port for ports in self._leases.values() for port in ports}
+        self._free = {
+            kind: deque(port for port in ports if port not in leased_ports)
+            for kind, ports in self.ranges.items()
+        }
+
+    def reserve(self, vm_id: str, kind: PortKind) -> int:
+        free_ports = self._free[kind]
+        for _ in range(len(free_ports)):
+            port = free_ports.popleft()
+            if is_port_available(port):
+                self._leases.setdefault(vm_id, {})[port] = kind
+                return port
+            # Used by another program, retried once the other ports are taken
+            free_ports.append(port)
+
+        ports = self.ranges[kind]
+        raise PortExhaustedError(
+            f"No {kind.value} port available in {ports.start}-{ports.stop - 1}"
+        )
+
+    def release_port(self, vm_id: str, port: int) -> None:
+        ports = self._leases.get(vm_id)
+        if ports is None or port not in ports:
+            return
+
+        kind = ports.pop(port)
+        if not ports:
+            del self._leases[vm_id]
+        if port in self.ranges[kind]:
+            self._free[kind].append(port)
+
+    def release(self, vm_id: str) -> None:
+        for port in list(self._leases.get(vm_id, ())):
+            self.release_port(vm_id, port)
+
+    def available(self, kind: PortKind) -> int:
+        return len(self._free[kind])
+
+
+port_allocator = PortAllocator(
+    {
+        PortKind.SSH: parse_port_range(settings.ssh_port_range),
+        PortKind.QMP: parse_port_range(settings.qmp_port_range),
+    }
+)
+
+
+def lease_port(session: AsyncSession, vm_id: str, kind: PortKind) -> int:
+    """
+    Leases a port to a VM. The lease is recorded with the current transaction and
+    the port is returned to the allocator if the transaction is rolled back.
+    """
+    port = port_allocator.reserve(vm_id, kind)
+    session.add(PortLease(port=port, kind=kind, vm_id=vm_id))
+    call_after_rollback(session, lambda: port_allocator.release_port(vm_id, port))
+    return port
+
+
+async def release_ports(session: AsyncSession, vm_id: str) -> None:
+    """
+    Ends the leases of a VM. The ports can be leased again once the current
+    transaction is committed.
+    """
+    await session.execute(delete(PortLease).where(PortLease.vm_id == vm_id))
+    call_after_commit(session, lambda: port_allocator.release(vm_id))
+
+
+async def sync_port_leases(session: AsyncSession, vms: Iterable[Vm]) -> None:
+    """
+    Makes the leases match the ports of the running VMs and loads them in the
+    allocator, ex: after a restart of the API that missed the exit of some VMs.
+    """
+    expected_leases: Dict[int, Tuple[str, PortKind]] = {}
+    for vm in vms:
+        if vm.ssh_port is not None:
+            expected_leases[vm.ssh_port] = (vm.id, PortKind.SSH)
+        if vm.qmp_port is not None:
+            expected_leases[vm.qmp_port] = (vm.id, PortKind.QMP)
+
+    leases = (await session.execute(select(PortLease))).scalars().all()
+    missing_leases = dict(expected_leases)
+    for lease in leases:
+        if missing_leases.get(lease.port) == (lease.vm_id, lease.kind):
+            del missing_leases[lease.port]
+        else:
+            await session.delete(lease)
+    # Frees the ports of the deleted leases before they are leased again
+    await session.flush()
+
+    session.add_all(
+        PortLease(port=port, kind=kind, vm_id=vm_id)
+        for port, (vm_id, kind) in missing_leases.items()
+    )
+    port_allocator.load(
+        (vm_id, kind, port) for port, (vm_id, kind) in expected_leases.items()
+    )
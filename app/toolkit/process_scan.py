@@ -0,0 +1,100 @@
+"""
+Discovery of the Qemu processes running on the host, used to re-adopt the VMs
+after a restart of the API.
+"""
+
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROC_DIR = Path("/proc")
+QEMU_EXECUTABLE_PREFIX = "qemu-system-"
+
+
+@dataclass
+class QemuProcess:
+    pid: int
+    argv: List[str]
+
+    def get_option(self, name: str) -> Optional[str]:
+        """
+        Returns the value of a command-line option, ex: "-qmp".
+        """
+        for index, arg in enumerate(self.argv[:-1]):
+            if arg == name:
+                return self.argv[index + 1]
+        return None
+
+    @property
+    def vm_id(self) -> Optional[str]:
+        # Set with "-name guest=<VM ID>"
+        name = self.get_option("-name")
+        if name is None:
+            return None
+        for option in name.split(","):
+            key, _, value = option.partition("=")
+            if key == "guest":
+                return value
+        return None
+
+    @property
+    def qmp_port(self) -> Optional[int]:
+        # Format: "tcp:localhost:<port>,server=on,wait=off"
+        qmp = self.get_option("-qmp")
+        if qmp is None or not qmp.startswith("tcp:"):
+            return None
+        try:
+            return int(qmp.split(",")[0].rsplit(":", 1)[1])
+        except ValueError:
+            return None
+
+    @property
+    def qmp_socket_path(self) -> Optional[str]:
+        # Format: "unix:<path>,server=on,wait=off"
+        qmp = self.get_option("-qmp")
+        if qmp is None or not qmp.startswith("unix:"):
+            return None
+        return qmp.split(",")[0][len("unix:") :]
+
+
+def read_cmdline(proc_dir: Path, pid: int) -> Optional[List[str]]:
+    try:
+        cmdline = (proc_dir / str(pid) / "cmdline").read_bytes()
+    except OSError:
+        # The process exited or belongs to another user
+        return None
+    return [arg.decode(errors="replace") for arg in cmdline.split(b"\0")[:-1]]
+
+
+def is_qemu_command(argv: List[str]) -> bool:
+    # The executable can be a script run by an interpreter, ex: the fake Qemu of
+    # the benchmarks
+    return any(Path(arg).name.startswith(QEMU_EXECUTABLE_PREFIX) for arg in argv[:2])
+
+
+def read_qemu_process(pid: int, proc_dir: Path = PROC_DIR) -> Optional[QemuProcess]:
+    """
+    Returns the Qemu process with this PID, or None if the PID belongs to another
+    program or does not exist.
+    """
+    argv = read_cmdline(proc_dir, pid)
+    if argv is None or not is_qemu_command(argv):
+        return None
+    return QemuProcess(pid=pid, argv=argv)
+
+
+def scan_qemu_processes(proc_dir: Path = PROC_DIR) -> Dict[int, QemuProcess]:
+    """
+    Lists the Qemu processes running on the host, by PID.
+    """
+    processes = {}
+    for path in proc_dir.iterdir():
+        if not path.name.isdigit():
+            continue
+        process = read_qemu_process(int(path.name), proc_dir)
+        if process is not None:
+            processes[process.pid] = process
+    return processes
@@ -1,12 +1,40 @@
-import subprocess
+import asyncio
+import datetime as dt
+import functools
+import time
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Optional, Union
 
-import qmp
 from cpuid.features import secure_encryption_info
 
 from models.vm import Vm, VmState
-from toolkit.network import find_available_port
+from settings import settings
+from toolkit.device_profiles import (
+    DeviceProfile,
+    get_disk_args,
+    get_iothread_args,
+    get_network_args,
+)
+from toolkit.image_store import VmDisk
+from toolkit.metrics import QEMU_STARTUP_DURATION
+from toolkit.placement import VmPlacement, format_cpu_list, pin_thread
+from toolkit.qmp_client import (
+    QmpAddress,
+    QmpConnection,
+    QmpConnectionError,
+    RelayedQmpConnection,
+    is_process_alive,
+    qmp_manager,
+)
+from toolkit.serial_console import CONSOLE_SOCKET_FILENAME
+from toolkit.supervisor import qemu_supervisor
+
+QEMU_STARTUP_TIMEOUT = 60.0
+QMP_READY_POLL_INTERVAL = 0.05
+QMP_SOCKET_FILENAME = "qmp.sock"
+# Size of sun_path without the terminating null byte
+MAX_UNIX_SOCKET_PATH_LENGTH = 107
 
 
 @dataclass
@@ -20,30 +48,48 @@ class VmSevInfo:
     handle: int
 
 
-class QemuVmClient:
-    def __init__(self, vm: Vm):
-        self.vm = vm
+def get_qmp_socket_path(working_dir: Path) -> Optional[Path]:
+    """
+    Returns the path of the QMP socket of a VM, or None if QMP must use TCP.
+    """
+    if settings.qmp_transport != "unix":
+        return None
+
+    socket_path = Path(working_dir).absolute() / QMP_SOCKET_FILENAME
+    if len(bytes(socket_path)) > MAX_UNIX_SOCKET_PATH_LENGTH:
+        return None
+    return socket_path
 
-        if vm.qmp_port is None:
-            raise ValueError(
-                "VM does not have a QMP port specified. Is the VM started?"
-            )
 
-        qmp_client = qmp.QEMUMonitorProtocol(address=("localhost", vm.qmp_port))
-        qmp_client.connect()
-        self.qmp_client = qmp_client
+def format_qmp_address(address: QmpAddress) -> str:
+    if isinstance(address, str):
+        return f"unix:{address},server=on,wait=off"
+    host, port = address
+    return f"tcp:{host}:{port},server=on,wait=off"
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+def get_qmp_connection(vm: Vm) -> Union[QmpConnection, RelayedQmpConnection]:
+    if vm.qmp_socket_path is not None:
+        address = vm.qmp_socket_path
+    elif vm.qmp_port is not None:
+        address = ("localhost", vm.qmp_port)
+    else:
+        raise ValueError("VM does not have a QMP port specified. Is the VM started?")
 
-    def close(self) -> None:
-        self.qmp_client.close()
+    return qmp_manager.get_connection(vm_id=vm.id, address=address, pid=vm.pid)
+
+
+class QemuVmClient:
+    """
+    Sends commands to a VM through its persistent QMP connection.
+    """
+
+    def __init__(self, vm: Vm):
+        self.vm = vm
+        self.qmp_connection = get_qmp_connection(vm)
 
-    def query_sev_info(self) -> VmSevInfo:
-        caps = self.qmp_client.command("query-sev")
+    async def query_sev_info(self) -> VmSevInfo:
+        caps = await self.qmp_connection.execute("query-sev")
         return VmSevInfo(
             enabled=caps["enabled"],
             api_major=caps["api-major"],
@@ -54,11 +100,11 @@ class QemuVmClient:
             policy=caps["policy"],
         )
 
-    def query_launch_measure(self) -> str:
-        measure = self.qmp_client.command("query-sev-launch-measure")
+    async def query_launch_measure(self) -> str:
+        measure = await self.qmp_connection.execute("query-sev-launch-measure")
         return measure["data"]
 
-    def inject_secret(self, packet_header: str, secret: str) -> None:
+    async def inject_secret(self, packet_header: str, secret: str) -> None:
         """
         Injects the secret in the SEV secret area.
 
@@ -66,28 +112,147 @@ class QemuVmClient:
         :param secret: The encoded secret, as a base64 string.
         """
 
-        self.qmp_client.command(
+        await self.qmp_connection.execute(
             "sev-inject-launch-secret",
             **{"packet-header": packet_header, "secret": secret},
         )
 
-    def continue_execution(self) -> None:
+    async def query_vcpu_threads(self) -> List[int]:
+        """
+        Returns the host thread IDs of the vCPUs, ordered by vCPU index.
+        """
+        cpus = await self.qmp_connection.execute("query-cpus-fast")
+        return [
+            cpu["thread-id"] for cpu in sorted(cpus, key=lambda cpu: cpu["cpu-index"])
+        ]
+
+    async def query_status(self) -> str:
+        """
+        Returns the run state of the VM, ex: "prelaunch", "running" or "shutdown".
+        """
+        qemu_status = await self.qmp_connection.execute("query-status")
+        return qemu_status["status"]
+
+    async def continue_execution(self) -> None:
         """
         Resumes the execution of the VM.
         """
-        self.qmp_client.command("cont")
+        await self.qmp_connection.execute("cont")
 
+    async def system_powerdown(self) -> None:
+        """
+        Asks the guest to shut down, like pressing the power button.
+        """
+        await self.qmp_connection.execute("system_powerdown")
 
-def qemu_create_vm(vm: Vm, working_dir: Path, ovmf_path: Path):
+    async def quit(self) -> None:
+        """
+        Stops Qemu immediately, without shutting down the guest.
+        """
+        await self.qmp_connection.execute("quit")
+
+
+@functools.lru_cache(maxsize=None)
+def get_sev_info():
+    """
+    Returns the SEV parameters of the CPU. The CPUID probe is only run once.
+    """
+    # TODO: we should have a generic abstraction to support SEV + TDX. This will do for now.
+    sev_info = secure_encryption_info()
+    if sev_info is None:
+        raise ValueError("Not running on an AMD SEV platform?")
+    return sev_info
+
+
+def get_memory_backend(vm: Vm, placement: VmPlacement) -> str:
+    memory_backend = f"memory-backend-memfd,id=ram0,size={vm.memory}M"
+    if placement.hugepage_size is not None:
+        memory_backend += (
+            f",hugetlb=on,hugetlbsize={placement.hugepage_size},prealloc=on"
+        )
+    if placement.numa_node is not None:
+        memory_backend += f",host-nodes={placement.numa_node},policy=bind"
+    return memory_backend
+
+
+def build_qemu_command(
+    vm: Vm,
+    ovmf_path: Path,
+    disk: VmDisk,
+    placement: VmPlacement,
+    profile: DeviceProfile,
+    sev_info,
+    ssh_port: Optional[int],
+    qmp_address: QmpAddress,
+) -> List[str]:
+    """
+    Returns the command line of the Qemu process of a VM.
+    """
+    return [
+        "qemu-system-x86_64",
+        # Identifies the process of the VM after a restart of the API
+        "-name",
+        f"guest={vm.id}",
+        "-enable-kvm",
+        "-m",
+        f"{vm.memory}",
+        "-smp",
+        f"{vm.number_of_cores}",
+        "-drive",
+        f"if=pflash,format=raw,unit=0,file={ovmf_path},readonly=on",
+        *get_iothread_args(profile),
+        *get_disk_args(profile, disk, vm.number_of_cores),
+        "-nographic",
+        # Read by the API, see toolkit.serial_console
+        "-chardev",
+        f"socket,id=char0,path={CONSOLE_SOCKET_FILENAME},server=on,wait=off",
+        "-serial",
+        "chardev:char0",
+        *get_network_args(profile, vm.id, vm.number_of_cores, ssh_port),
+        "-object",
+        f"sev-guest,id=sev0,policy={vm.sev_policy},cbitpos={sev_info.c_bit_position},"
+        f"reduced-phys-bits={sev_info.phys_addr_reduction},"
+        "dh-cert-file=vm_godh.b64,session-file=vm_session.b64",
+        "-object",
+        get_memory_backend(vm, placement),
+        "-machine",
+        "confidential-guest-support=sev0,memory-backend=ram0",
+        "-qmp",
+        format_qmp_address(qmp_address),
+        "--no-reboot",  # Rebooting from inside the VM shuts down the machine
+        "-S",
+        # Linux kernel 6.9 added a control on the RDRAND function to ensure that the random numbers generation
+        # works well, on Qemu emulation for confidential computing the CPU model us faked and this makes control
+        # raise an error and prevent boot. Passing the argument --cpu host instruct the VM to use the same CPU
+        # model than the host thus the VM's kernel knows which method is used to get random numbers (Intel and
+        # AMD have different methods) and properly boot.
+        "-cpu",
+        "host",
+    ]
+
+
+async def qemu_create_vm(
+    vm: Vm,
+    working_dir: Path,
+    ovmf_path: Path,
+    disk: VmDisk,
+    placement: VmPlacement,
+    profile: DeviceProfile,
+    ssh_port: Optional[int],
+    qmp_address: QmpAddress,
+):
     """
     Starts the Qemu VM process in wait mode. This creates the VM and allocates the resources
     but waits for user interaction with QMP to start the guest.
     :param vm: The VM to start.
     :param working_dir: Working directory for the Qemu process.
     :param ovmf_path: Path to the OVMF binary.
+    :param disk: The disk of the VM.
+    :param placement: NUMA node, host CPUs and hugepages assigned to the VM.
+    :param profile: Device profile of the disk and network of the VM.
+    :param ssh_port: Host port forwarded to the SSH port of the guest, if any.
+    :param qmp_address: Path of the QMP socket, or TCP address of QMP.
     """
-    ssh_port = find_available_port()
-    qmp_port = find_available_port()
 
     godh = Path(working_dir) / "vm_godh.b64"
     launch_blob = Path(working_dir) / "vm_session.b64"
@@ -95,56 +260,77 @@ def qemu_create_vm(vm: Vm, working_dir: Path, ovmf_path: Path):
     if not (godh.is_file() and launch_blob.is_file()):
         raise FileNotFoundError("Missing guest owner certificates, cannot start the VM.")
 
-    # TODO: this should be called only once, and we should have a generic abstraction
-    #       to support SEV + TDX. This will do for now.
-    sev_info = secure_encryption_info()
-    if sev_info is None:
-        raise ValueError("Not running on an AMD SEV platform?")
+    sev_info = get_sev_info()
 
-    p = subprocess.Popen(
-        [
-            "qemu-system-x86_64",
-            "-enable-kvm",
-            "-m",
-            f"{vm.memory}",
-            "-smp",
-            f"{vm.number_of_cores}",
-            "-drive",
-            f"if=pflash,format=raw,unit=0,file={ovmf_path},readonly=on",
-            "-drive",
-            f"format=raw,file={vm.image.filename}",
-            "-nographic",
-            "-chardev",
-            "file,id=char0,path=serial.log",
-            "-serial",
-            "chardev:char0",
-            "-netdev",
-            f"user,id=net0,hostfwd=tcp::{ssh_port}-:22",
-            "-device",
-            "virtio-net-pci,netdev=net0",
-            "-object",
-            f"sev-guest,id=sev0,policy={vm.sev_policy},cbitpos={sev_info.c_bit_position},"
-            f"reduced-phys-bits={sev_info.phys_addr_reduction},"
-            "dh-cert-file=vm_godh.b64,session-file=vm_session.b64",
-            "-machine",
-            "confidential-guest-support=sev0",
-            "-qmp",
-            f"tcp:localhost:{qmp_port},server=on,wait=off",
-            "--no-reboot",  # Rebooting from inside the VM shuts down the machine
-            "-S",
-            # Linux kernel 6.9 added a control on the RDRAND function to ensure that the random numbers generation
-            # works well, on Qemu emulation for confidential computing the CPU model us faked and this makes control
-            # raise an error and prevent boot. Passing the argument --cpu host instruct the VM to use the same CPU
-            # model than the host thus the VM's kernel knows which method is used to get random numbers (Intel and
-            # AMD have different methods) and properly boot.
-            "-cpu",
-            "host",
-
-        ],
+    pid = await qemu_supervisor.spawn(
+        vm.id,
+        build_qemu_command(
+            vm=vm,
+            ovmf_path=ovmf_path,
+            disk=disk,
+            placement=placement,
+            profile=profile,
+            sev_info=sev_info,
+            ssh_port=ssh_port,
+            qmp_address=qmp_address,
+        ),
         cwd=working_dir,
     )
 
     vm.ssh_port = ssh_port
-    vm.qmp_port = qmp_port
-    vm.pid = p.pid
+    if isinstance(qmp_address, str):
+        vm.qmp_socket_path = qmp_address
+        vm.qmp_port = None
+    else:
+        vm.qmp_socket_path = None
+        vm.qmp_port = qmp_address[1]
+    vm.pid = pid
+    vm.start_datetime = dt.datetime.utcnow()
+    vm.stop_datetime = None
+    vm.exit_status = None
+    vm.numa_node = placement.numa_node
+    vm.host_cpus = format_cpu_list(placement.host_cpus) or None
+    vm.hugepage_size = placement.hugepage_size
     vm.state = VmState.STARTED
+
+
+async def pin_vm_threads(
+    vm: Vm, placement: VmPlacement, emulator_cpus: List[int]
+) -> None:
+    """
+    Pins each vCPU thread of a VM to its host CPU, and the other Qemu threads
+    to the CPUs of the NUMA node of the VM.
+    """
+    if emulator_cpus:
+        pin_thread(vm.pid, emulator_cpus)
+
+    if placement.host_cpus:
+        vcpu_threads = await QemuVmClient(vm).query_vcpu_threads()
+        for vcpu_index, thread_id in enumerate(vcpu_threads):
+            host_cpu = placement.host_cpus[vcpu_index % len(placement.host_cpus)]
+            pin_thread(thread_id, [host_cpu])
+
+
+async def wait_for_qmp(
+    vm: Vm, spawn_time: float, timeout: float = QEMU_STARTUP_TIMEOUT
+) -> None:
+    """
+    Waits until the QMP socket of a freshly spawned VM accepts connections.
+    Qemu only opens the socket once the guest memory is allocated, which can take
+    a while for large VMs.
+
+    :param vm: The VM.
+    :param spawn_time: Time at which the Qemu process was spawned (time.perf_counter()).
+    :param timeout: Maximum time to wait since the process was spawned, in seconds.
+    """
+    connection = get_qmp_connection(vm)
+    while True:
+        try:
+            await connection.connect()
+            break
+        except QmpConnectionError:
+            if not is_process_alive(vm.pid) or time.perf_counter() - spawn_time > timeout:
+                raise
+            await asyncio.sleep(QMP_READY_POLL_INTERVAL)
+
+    QEMU_STARTUP_DURATION.observe(time.perf_counter() - spawn_time)
@@ -0,0 +1,392 @@
+"""
+Asyncio implementation of the QEMU Machine Protocol (QMP).
+
+A single long-lived connection is kept for each running VM. A reader task consumes
+the replies and asynchronous events sent by QEMU and routes each reply to its caller
+using the command id, so several commands can be in flight on the same connection.
+
+QEMU serves a single QMP client: when the API runs several workers, only the leader
+connects to QEMU and the other workers relay their commands to it.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from toolkit.leader import LeaderCallError, LeaderUnavailableError, call_leader
+from toolkit.metrics import get_qmp_command_duration
+
+logger = logging.getLogger(__name__)
+
+# Either a (host, port) tuple for TCP or the path of a UNIX socket
+QmpAddress = Union[Tuple[str, int], str]
+QmpEventListener = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+QMP_COMMAND_TIMEOUT = 30.0
+QMP_CONNECT_TIMEOUT = 5.0
+QMP_RECONNECT_ATTEMPTS = 3
+QMP_RECONNECT_DELAY = 0.2
+# Time left to the leader to answer after the timeout of a relayed command
+QMP_RELAY_TIMEOUT_MARGIN = 5.0
+
+
+class QmpError(Exception):
+    """
+    QEMU answered a command with an error.
+    """
+
+    def __init__(self, command: str, error: Dict[str, Any]):
+        self.command = command
+        self.error_class = error.get("class", "GenericError")
+        self.description = error.get("desc", "")
+        super().__init__(f"QMP command '{command}' failed: {self.description}")
+
+
+class QmpConnectionError(ConnectionError):
+    """
+    The QMP connection could not be established or was lost.
+    """
+
+
+def is_process_alive(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+class QmpConnection:
+    """
+    A persistent QMP connection to one QEMU process.
+
+    The connection is established lazily and re-established automatically if it
+    drops while the QEMU process is still alive.
+    """
+
+    def __init__(
+        self,
+        vm_id: str,
+        address: QmpAddress,
+        pid: Optional[int] = None,
+        event_listener: Optional[QmpEventListener] = None,
+    ):
+        self.vm_id = vm_id
+        self.address = address
+        self.pid = pid
+        self.event_listener = event_listener
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._command_ids = itertools.count()
+        self._connect_lock = asyncio.Lock()
+        self._closed = False
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def _open_stream(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if isinstance(self.address, str):
+            return await asyncio.open_unix_connection(self.address)
+
+        host, port = self.address
+        return await asyncio.open_connection(host, port)
+
+    async def _handshake(self) -> None:
+        # QEMU sends a greeting, then waits for capabilities negotiation
+        greeting = await self._read_message()
+        if "QMP" not in greeting:
+            raise QmpConnectionError(f"Unexpected QMP greeting: {greeting}")
+
+        self._writer.write(b'{"execute": "qmp_capabilities"}\n')
+        await self._writer.drain()
+        while True:
+            message = await self._read_message()
+            if "return" in message:
+                return
+            if "error" in message:
+                raise QmpError("qmp_capabilities", message["error"])
+            # Events can be emitted before the negotiation completes
+            await self._dispatch_event(message)
+
+    async def _read_message(self) -> Dict[str, Any]:
+        line = await self._reader.readline()
+        if not line:
+            raise QmpConnectionError("QMP connection closed by QEMU")
+        return json.loads(line)
+
+    async def connect(self) -> None:
+        async with self._connect_lock:
+            if self.connected:
+                return
+            if self._closed:
+                raise QmpConnectionError(f"QMP connection to VM {self.vm_id} is closed")
+
+            last_error: Optional[Exception] = None
+            for attempt in range(QMP_RECONNECT_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(QMP_RECONNECT_DELAY * attempt)
+                if self.pid is not None and not is_process_alive(self.pid):
+                    break
+
+                try:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        self._open_stream(), timeout=QMP_CONNECT_TIMEOUT
+                    )
+                    await asyncio.wait_for(
+                        self._handshake(), timeout=QMP_CONNECT_TIMEOUT
+                    )
+                except (OSError, asyncio.TimeoutError, QmpConnectionError) as e:
+                    last_error = e
+                    await self._close_stream()
+                    continue
+
+                self._reader_task = asyncio.create_task(self._read_loop())
+                return
+
+            raise QmpConnectionError(
+                f"Could not connect to QMP for VM {self.vm_id}: {last_error}"
+            )
+
+    async def _dispatch_event(self, message: Dict[str, Any]) -> None:
+        if self.event_listener is None:
+            return
+
+        try:
+            await self.event_listener(self.vm_id, message)
+        except Exception:
+            logger.exception("QMP event listener failed for VM %s", self.vm_id)
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                message = await self._read_message()
+                if "event" in message:
+                    await self._dispatch_event(message)
+                    continue
+
+                future = self._pending.pop(message.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError, QmpConnectionError) as e:
+            logger.debug("QMP connection to VM %s lost: %s", self.vm_id, e)
+        finally:
+            self._fail_pending(QmpConnectionError("QMP connection lost"))
+            await self._close_stream()
+            if self.pid is not None and not is_process_alive(self.pid):
+                self._closed = True
+
+    def _fail_pending(self, error: Exception) -> None:
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _close_stream(self) -> None:
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def execute(
+        self, command: str, timeout: float = QMP_COMMAND_TIMEOUT, **arguments
+    ) -> Any:
+        """
+        Sends a command to QEMU and waits for its result.
+
+        :param command: Name of the QMP command.
+        :param timeout: Maximum time to wait for the reply, in seconds.
+        :param arguments: Arguments of the command.
+        :return: The "return" value of the reply.
+        """
+        if not self.connected:
+            await self.connect()
+        writer = self._writer
+        if writer is None:
+            raise QmpConnectionError(f"QMP connection to VM {self.vm_id} lost")
+
+        command_id = f"{self.vm_id}-{next(self._command_ids)}"
+        request: Dict[str, Any] = {"execute": command, "id": command_id}
+        if arguments:
+            request["arguments"] = arguments
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[command_id] = future
+        start = time.perf_counter()
+        try:
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            reply = await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self._pending.pop(command_id, None)
+        get_qmp_command_duration(command).observe(time.perf_counter() - start)
+
+        if "error" in reply:
+            raise QmpError(command, reply["error"])
+        return reply["return"]
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self._fail_pending(QmpConnectionError("QMP connection closed"))
+        await self._close_stream()
+
+
+class RelayedQmpConnection:
+    """
+    QMP connection of a worker that is not the leader: the commands are executed
+    by the leader, on its connection to QEMU.
+    """
+
+    closed = False
+    connected = True
+
+    def __init__(self, vm_id: str, address: QmpAddress, pid: Optional[int] = None):
+        self.vm_id = vm_id
+        self.address = address
+        self.pid = pid
+
+    async def connect(self) -> None:
+        pass
+
+    async def execute(
+        self, command: str, timeout: float = QMP_COMMAND_TIMEOUT, **arguments
+    ) -> Any:
+        try:
+            reply = await call_leader(
+                "qmp",
+                timeout=timeout + QMP_RELAY_TIMEOUT_MARGIN,
+                vm_id=self.vm_id,
+                address=self.address,
+                pid=self.pid,
+                command=command,
+                arguments=arguments,
+                command_timeout=timeout,
+            )
+        except LeaderUnavailableError as e:
+            raise QmpConnectionError(str(e)) from e
+        except LeaderCallError as e:
+            if e.error_type == "TimeoutError":
+                raise asyncio.TimeoutError() from e
+            if e.error_type == "QmpConnectionError":
+                raise QmpConnectionError(e.message) from e
+            raise
+
+        if "error" in reply:
+            raise QmpError(command, reply["error"])
+        return reply["return"]
+
+    async def close(self) -> None:
+        pass
+
+
+class QmpManager:
+    """
+    Keeps one persistent QMP connection per running VM.
+    """
+
+    def __init__(self):
+        self._connections: Dict[str, QmpConnection] = {}
+        self._event_listeners: List[QmpEventListener] = []
+        # Set in the workers that are not the leader
+        self.relay_to_leader = False
+
+    def add_event_listener(self, listener: QmpEventListener) -> None:
+        """
+        Registers a coroutine called with (vm_id, event) for each QMP event
+        emitted by any VM.
+        """
+        self._event_listeners.append(listener)
+
+    async def _on_event(self, vm_id: str, event: Dict[str, Any]) -> None:
+        for listener in self._event_listeners:
+            await listener(vm_id, event)
+
+    def get_connection(
+        self, vm_id: str, address: QmpAddress, pid: Optional[int] = None
+    ) -> Union[QmpConnection, RelayedQmpConnection]:
+        if self.relay_to_leader:
+            return RelayedQmpConnection(vm_id=vm_id, address=address, pid=pid)
+
+        connection = self._connections.get(vm_id)
+        if (
+            connection is None
+            or connection.closed
+            or connection.address != address
+            or connection.pid != pid
+        ):
+            if connection is not None and not connection.closed:
+                asyncio.create_task(connection.close())
+            connection = QmpConnection(
+                vm_id=vm_id, address=address, pid=pid, event_listener=self._on_event
+            )
+            self._connections[vm_id] = connection
+
+        return connection
+
+    async def execute_relayed_command(
+        self,
+        vm_id: str,
+        address: QmpAddress,
+        pid: Optional[int],
+        command: str,
+        arguments: Dict[str, Any],
+        command_timeout: float,
+    ) -> Dict[str, Any]:
+        """
+        Executes a command relayed by another worker, in the leader. Returns the
+        reply of QEMU: errors of QEMU are passed on to the worker.
+        """
+        if isinstance(address, list):
+            # Decoded from JSON
+            address = tuple(address)
+        connection = self.get_connection(vm_id=vm_id, address=address, pid=pid)
+        try:
+            result = await connection.execute(
+                command, timeout=command_timeout, **arguments
+            )
+        except QmpError as e:
+            return {"error": {"class": e.error_class, "desc": e.description}}
+        return {"return": result}
+
+    async def close_connection(self, vm_id: str) -> None:
+        """
+        Tears down the connection of a VM, ex: when its QEMU process exits.
+        """
+        connection = self._connections.pop(vm_id, None)
+        if connection is not None:
+            await connection.close()
+
+    async def close(self) -> None:
+        await asyncio.gather(
+            *(self.close_connection(vm_id) for vm_id in list(self._connections))
+        )
+
+
+qmp_manager = QmpManager()
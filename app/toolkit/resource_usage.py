@@ -0,0 +1,473 @@
+"""
+Resources used by the Qemu processes of the VMs.
+
+The leader samples every `resource_sample_interval` seconds, for each running VM,
+the CPU time of the Qemu process and of each vCPU thread, its resident memory and
+swap, and its disk I/O, from /proc. The files of each process are opened once and
+re-read in place, so a sampling pass is a few reads per VM.
+
+Samples are kept in fixed-size ring buffers backed by arrays: the last
+`resource_samples_kept` samples, and averages over 5 minutes and over 1 hour for
+longer periods. The totals of all the VMs are kept the same way for the node.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import resource
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+
+from models.db import async_session
+from models.vm import Vm
+from settings import settings
+from toolkit.leader import call_leader, leader_election
+from toolkit.qemu import QemuVmClient
+from toolkit.qmp_client import QmpConnectionError, QmpError
+
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PROC_READ_SIZE = 4096
+# Fields of /proc/<pid>/stat after the command name, see proc(5)
+STAT_UTIME_INDEX = 11
+STAT_STIME_INDEX = 12
+
+# Fields of the samples of a VM, followed by the CPU usage of each vCPU
+FIELDS = ("cpu", "memory", "swap", "read_rate", "write_rate")
+NODE_FIELDS = ("cpu", "memory", "swap", "read_rate", "write_rate", "vms")
+# Resolutions of the averaged samples, in seconds, and number of samples kept
+ROLLUPS = ((300, 288), (3600, 168))
+RESOLUTIONS = tuple(resolution for resolution, _ in ROLLUPS)
+
+
+class SampleRing:
+    """
+    Last `capacity` samples of `width` values each, oldest first.
+    """
+
+    def __init__(self, width: int, capacity: int):
+        self.width = width
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("f", bytes(4 * capacity * width))
+        self.size = 0
+        self._next = 0
+
+    def append(self, timestamp: float, values: Sequence[float]) -> None:
+        self.times[self._next] = timestamp
+        start = self._next * self.width
+        self.values[start : start + self.width] = array("f", values)
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def __iter__(self) -> Iterator[Tuple[float, array]]:
+        first = (self._next - self.size) % self.capacity
+        for offset in range(self.size):
+            index = (first + offset) % self.capacity
+            start = index * self.width
+            yield self.times[index], self.values[start : start + self.width]
+
+
+class Rollup:
+    """
+    Averages of the samples over periods of `resolution` seconds.
+    """
+
+    def __init__(self, width: int, resolution: int, capacity: int):
+        self.resolution = resolution
+        self.ring = SampleRing(width, capacity)
+        self._sums = array("d", bytes(8 * width))
+        self._count = 0
+        self._period_start = 0.0
+
+    def add(self, timestamp: float, values: Sequence[float]) -> None:
+        period_start = timestamp - timestamp % self.resolution
+        if period_start != self._period_start and self._count:
+            self.ring.append(
+                self._period_start, [total / self._count for total in self._sums]
+            )
+            self._sums = array("d", bytes(8 * self.ring.width))
+            self._count = 0
+        self._period_start = period_start
+        for index, value in enumerate(values):
+            self._sums[index] += value
+        self._count += 1
+
+
+class ResourceSeries:
+    def __init__(self, width: int):
+        self.samples = SampleRing(width, settings.resource_samples_kept)
+        self.rollups = {
+            resolution: Rollup(width, resolution, capacity)
+            for resolution, capacity in ROLLUPS
+        }
+
+    def add(self, timestamp: float, values: Sequence[float]) -> None:
+        self.samples.append(timestamp, values)
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, values)
+
+    def get_ring(self, resolution: Optional[int]) -> SampleRing:
+        if resolution is None:
+            return self.samples
+        return self.rollups[resolution].ring
+
+
+@dataclass
+class ProcessCounters:
+    cpu_time: float
+    memory: int
+    swap: int
+    read_bytes: int
+    write_bytes: int
+    vcpu_times: List[float]
+
+
+def read_proc_file(fd: int) -> bytes:
+    # procfs generates the content again when read from the start
+    return os.pread(fd, PROC_READ_SIZE, 0)
+
+
+def parse_cpu_time(stat: bytes) -> float:
+    # The command name can contain spaces and parentheses
+    fields = stat[stat.rindex(b")") + 2 :].split()
+    return (int(fields[STAT_UTIME_INDEX]) + int(fields[STAT_STIME_INDEX])) / CLOCK_TICKS
+
+
+def parse_field(content: bytes, name: bytes) -> int:
+    start = content.find(name)
+    if start == -1:
+        return 0
+    return int(content[start + len(name) : content.index(b"\n", start)].split()[0])
+
+
+@dataclass
+class TrackedProcess:
+    vm_id: str
+    pid: int
+    stat_fd: int
+    status_fd: int
+    io_fd: Optional[int]
+    vcpu_fds: List[Optional[int]]
+    counters: Optional[ProcessCounters] = None
+    sample_time: float = 0.0
+    series: Optional[ResourceSeries] = field(default=None, repr=False)
+
+    @classmethod
+    def open(cls, vm_id: str, pid: int, vcpu_threads: List[Optional[int]]):
+        proc_dir = f"/proc/{pid}"
+        stat_fd = os.open(f"{proc_dir}/stat", os.O_RDONLY)
+        try:
+            status_fd = os.open(f"{proc_dir}/status", os.O_RDONLY)
+        except OSError:
+            os.close(stat_fd)
+            raise
+
+        fds: List[Optional[int]] = []
+        for path in [f"{proc_dir}/io"] + [
+            f"{proc_dir}/task/{thread_id}/stat" if thread_id else None
+            for thread_id in vcpu_threads
+        ]:
+            try:
+                fds.append(os.open(path, os.O_RDONLY) if path is not None else None)
+            except OSError:
+                # Ex: the I/O counters of processes of other users are not readable
+                fds.append(None)
+        return cls(
+            vm_id=vm_id,
+            pid=pid,
+            stat_fd=stat_fd,
+            status_fd=status_fd,
+            io_fd=fds[0],
+            vcpu_fds=fds[1:],
+        )
+
+    def read(self) -> ProcessCounters:
+        """
+        :raises OSError: The process exited.
+        """
+        status = read_proc_file(self.status_fd)
+        read_bytes = write_bytes = 0
+        if self.io_fd is not None:
+            io = read_proc_file(self.io_fd)
+            read_bytes = parse_field(io, b"read_bytes:")
+            write_bytes = parse_field(io, b"write_bytes:")
+        vcpu_times = []
+        for fd in self.vcpu_fds:
+            try:
+                vcpu_times.append(
+                    parse_cpu_time(read_proc_file(fd)) if fd is not None else math.nan
+                )
+            except OSError:
+                vcpu_times.append(math.nan)
+        return ProcessCounters(
+            cpu_time=parse_cpu_time(read_proc_file(self.stat_fd)),
+            memory=parse_field(status, b"VmRSS:") * 1024,
+            swap=parse_field(status, b"VmSwap:") * 1024,
+            read_bytes=read_bytes,
+            write_bytes=write_bytes,
+            vcpu_times=vcpu_times,
+        )
+
+    def close(self) -> None:
+        for fd in [self.stat_fd, self.status_fd, self.io_fd, *self.vcpu_fds]:
+            if fd is not None:
+                os.close(fd)
+
+
+def raise_open_files_limit() -> None:
+    """
+    Raises the limit of open files to the hard limit, the files of the processes of
+    the VMs are kept open.
+    """
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and (
+        hard_limit == resource.RLIM_INFINITY or soft_limit < hard_limit
+    ):
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+        except (ValueError, OSError) as e:
+            logger.warning("Could not raise the limit of open files: %s", e)
+
+
+def get_usage(
+    previous: ProcessCounters, current: ProcessCounters, elapsed: float
+) -> List[float]:
+    """
+    Returns the values of a sample of a VM: the CPU cores used by Qemu, its
+    memory and swap in bytes, its disk reads and writes in bytes per second and the
+    CPU cores used by each vCPU.
+    """
+    return [
+        (current.cpu_time - previous.cpu_time) / elapsed,
+        current.memory,
+        current.swap,
+        (current.read_bytes - previous.read_bytes) / elapsed,
+        (current.write_bytes - previous.write_bytes) / elapsed,
+        *(
+            (vcpu_time - previous_time) / elapsed
+            for vcpu_time, previous_time in zip(
+                current.vcpu_times, previous.vcpu_times
+            )
+        ),
+    ]
+
+
+def read_processes(
+    processes: List[TrackedProcess],
+) -> Tuple[List[Tuple[TrackedProcess, Optional[ProcessCounters], float]], float]:
+    """
+    :return: The counters of each process and when they were read, and the CPU time
+    spent reading them.
+    """
+    start = time.thread_time()
+    samples = []
+    for process in processes:
+        try:
+            counters = process.read()
+        except (OSError, ValueError):
+            # The process exited since the VMs were listed
+            counters = None
+        samples.append((process, counters, time.monotonic()))
+    return samples, time.thread_time() - start
+
+
+def format_value(value: float) -> Optional[float]:
+    return None if math.isnan(value) else round(value, 3)
+
+
+def format_samples(
+    ring: SampleRing, fields: Sequence[str], since: Optional[float]
+) -> List[Dict[str, Any]]:
+    samples = []
+    for timestamp, values in ring:
+        if since is not None and timestamp <= since:
+            continue
+        sample: Dict[str, Any] = {"timestamp": timestamp}
+        for name, value in zip(fields, values):
+            sample[name] = format_value(value)
+        if len(values) > len(fields):
+            sample["vcpus"] = [format_value(value) for value in values[len(fields) :]]
+        samples.append(sample)
+    return samples
+
+
+class ResourceSampler:
+    def __init__(self):
+        # VM ID -> process of the VM, while it runs
+        self._processes: Dict[str, TrackedProcess] = {}
+        # VM ID -> samples of the VM, kept after it stops
+        self._series: Dict[str, ResourceSeries] = {}
+        self.node_series: Optional[ResourceSeries] = None
+        self.last_pass_duration = 0.0
+
+    async def _track(self, vm: Vm) -> Optional[TrackedProcess]:
+        vcpu_threads: List[Optional[int]] = [None] * vm.number_of_cores
+        try:
+            threads = await QemuVmClient(vm).query_vcpu_threads()
+            vcpu_threads = (threads + vcpu_threads)[: vm.number_of_cores]
+        except (QmpConnectionError, ValueError, asyncio.TimeoutError) as e:
+            # Ex: Qemu is starting, tracked on the next pass
+            logger.debug("Could not find the vCPU threads of VM %s: %s", vm.id, e)
+            return None
+        except QmpError as e:
+            logger.debug("Could not find the vCPU threads of VM %s: %s", vm.id, e)
+
+        try:
+            process = TrackedProcess.open(vm.id, vm.pid, vcpu_threads)
+        except OSError as e:
+            logger.debug("Could not sample the process of VM %s: %s", vm.id, e)
+            return None
+
+        series = self._series.get(vm.id)
+        if series is None or series.samples.width != len(FIELDS) + len(vcpu_threads):
+            series = self._series[vm.id] = ResourceSeries(
+                len(FIELDS) + len(vcpu_threads)
+            )
+        process.series = series
+        return process
+
+    def _untrack(self, vm_id: str) -> None:
+        process = self._processes.pop(vm_id, None)
+        if process is not None:
+            process.close()
+
+    async def _update_processes(self) -> None:
+        async with async_session() as session:
+            running_vms = dict(
+                (
+                    await session.execute(select(Vm.id, Vm.pid).where(Vm.pid.isnot(None)))
+                ).all()
+            )
+            for vm_id, process in list(self._processes.items()):
+                if running_vms.get(vm_id) != process.pid:
+                    self._untrack(vm_id)
+            new_vm_ids = running_vms.keys() - self._processes.keys()
+            new_vms = []
+            if new_vm_ids:
+                new_vms = (
+                    (await session.execute(select(Vm).where(Vm.id.in_(new_vm_ids))))
+                    .scalars()
+                    .all()
+                )
+        for process in await asyncio.gather(*(self._track(vm) for vm in new_vms)):
+            if process is not None:
+                self._processes[process.vm_id] = process
+
+    async def sample(self) -> None:
+        """
+        Samples the processes of the running VMs.
+        """
+        await self._update_processes()
+        start = time.thread_time()
+        samples, read_duration = await asyncio.to_thread(
+            read_processes, list(self._processes.values())
+        )
+
+        timestamp = time.time()
+        totals = [0.0] * len(NODE_FIELDS)
+        for process, counters, sample_time in samples:
+            if counters is None:
+                self._untrack(process.vm_id)
+                continue
+            if process.counters is not None:
+                values = get_usage(
+                    process.counters, counters, sample_time - process.sample_time
+                )
+                process.series.add(timestamp, values)
+                for index in range(len(FIELDS)):
+                    totals[index] += values[index]
+                totals[-1] += 1
+            process.counters = counters
+            process.sample_time = sample_time
+
+        if self.node_series is None:
+            self.node_series = ResourceSeries(len(NODE_FIELDS))
+        self.node_series.add(timestamp, totals)
+        # Without the queries of the database, shared with the requests
+        self.last_pass_duration = time.thread_time() - start + read_duration
+
+    async def run(self, interval: float) -> None:
+        """
+        Samples the VMs every `interval` seconds, in the leader.
+        """
+        raise_open_files_limit()
+        try:
+            while True:
+                try:
+                    await self.sample()
+                except Exception:
+                    logger.exception("Could not sample the resources used by the VMs")
+                await asyncio.sleep(interval)
+        finally:
+            for vm_id in list(self._processes):
+                self._untrack(vm_id)
+
+    def get_vm_stats(
+        self, vm_id: str, resolution: Optional[int] = None, since: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        :param resolution: One of `RESOLUTIONS`, or None for the samples.
+        :param since: Only return the samples taken after this timestamp.
+        """
+        series = self._series.get(vm_id)
+        samples = []
+        if series is not None:
+            samples = format_samples(series.get_ring(resolution), FIELDS, since)
+        return {
+            "vm_id": vm_id,
+            "resolution": resolution or settings.resource_sample_interval,
+            "samples": samples,
+        }
+
+    def get_node_stats(
+        self, resolution: Optional[int] = None, since: Optional[float] = None
+    ) -> Dict[str, Any]:
+        samples = []
+        if self.node_series is not None:
+            samples = format_samples(
+                self.node_series.get_ring(resolution), NODE_FIELDS, since
+            )
+        return {
+            "resolution": resolution or settings.resource_sample_interval,
+            "sampling_duration": self.last_pass_duration,
+            "samples": samples,
+        }
+
+    def remove(self, vm_id: str) -> None:
+        """
+        Forgets the samples of a deleted VM.
+        """
+        self._untrack(vm_id)
+        self._series.pop(vm_id, None)
+
+
+resource_sampler = ResourceSampler()
+
+
+async def get_vm_stats(
+    vm_id: str, resolution: Optional[int], since: Optional[float]
+) -> Dict[str, Any]:
+    """
+    Returns the samples of a VM, kept by the leader.
+    """
+    if leader_election.is_leader:
+        return resource_sampler.get_vm_stats(vm_id, resolution, since)
+    return await call_leader("vm_stats", vm_id=vm_id, resolution=resolution, since=since)
+
+
+async def get_node_stats(
+    resolution: Optional[int], since: Optional[float]
+) -> Dict[str, Any]:
+    """
+    Returns the samples of the totals of the VMs, kept by the leader.
+    """
+    if leader_election.is_leader:
+        return resource_sampler.get_node_stats(resolution, since)
+    return await call_leader("node_stats", resolution=resolution, since=since)
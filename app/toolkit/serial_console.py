@@ -0,0 +1,334 @@
+"""
+Serial console of the VMs.
+
+Qemu serves the serial console of each VM on a UNIX socket in the directory of the
+VM. The leader reads it into a bounded buffer per VM: the last output stays in
+memory, older output is spilled to gzip segments in the `console` directory of the
+VM. Only the last `console_max_segments` segments are kept, so the disk usage of a
+VM is bounded whatever the guest writes.
+
+The output is addressed by its offset since the first start of the VM, so that
+clients can resume reading where they stopped. It is kept after the VM stops, for
+the diagnostics of failed boots. Qemu discards the output while the API is not
+connected, ex: while a worker takes over as leader.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import zlib
+from contextlib import suppress
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from settings import settings
+from toolkit.leader import leader_election, stream_from_leader
+
+logger = logging.getLogger(__name__)
+
+CONSOLE_SOCKET_FILENAME = "console.sock"
+CONSOLE_DIRNAME = "console"
+CONSOLE_READ_SIZE = 4096
+# Maximum size of the chunks yielded to the readers of a console
+CONSOLE_CHUNK_SIZE = 64 * 1024
+# Size of sun_path without the terminating null byte
+MAX_UNIX_SOCKET_PATH_LENGTH = 107
+# Format of gzip members for zlib
+GZIP_WBITS = 31
+
+
+def get_segment_path(console_dir: Path, start_offset: int) -> Path:
+    return console_dir / f"{start_offset:020d}.gz"
+
+
+def read_segment(path: Path) -> bytes:
+    """
+    Returns the content of a segment, made of one gzip member per spill. A member
+    being written is ignored.
+    """
+    data = path.read_bytes()
+    content = bytearray()
+    while data:
+        decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+        try:
+            content += decompressor.decompress(data)
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        data = decompressor.unused_data
+    return bytes(content)
+
+
+def append_to_segment(path: Path, data: bytes) -> None:
+    compressor = zlib.compressobj(wbits=GZIP_WBITS)
+    with path.open("ab") as f:
+        f.write(compressor.compress(data) + compressor.flush())
+
+
+async def open_console_connection(
+    vm_dir: Path,
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    socket_path = vm_dir.absolute() / CONSOLE_SOCKET_FILENAME
+    if len(bytes(socket_path)) <= MAX_UNIX_SOCKET_PATH_LENGTH:
+        return await asyncio.open_unix_connection(socket_path)
+
+    # Qemu binds the socket relatively to the directory of the VM, reach it through
+    # a descriptor of the directory when its absolute path is too long
+    dir_fd = os.open(vm_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        return await asyncio.open_unix_connection(
+            f"/proc/self/fd/{dir_fd}/{CONSOLE_SOCKET_FILENAME}"
+        )
+    finally:
+        os.close(dir_fd)
+
+
+class SerialConsole:
+    """
+    Output of the serial console of a VM: `segments` on disk, then `buffer` in
+    memory from `buffer_offset` to `end_offset`.
+    """
+
+    def __init__(self, vm_id: str, vm_dir: Path):
+        self.vm_id = vm_id
+        self.directory = vm_dir / CONSOLE_DIRNAME
+        # Start offsets of the segments, oldest first
+        self.segments: List[int] = []
+        self.buffer = bytearray()
+        self.buffer_offset = 0
+        self.end_offset = 0
+        self._segment_end = 0
+        self._new_data = asyncio.Event()
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._spill_lock = asyncio.Lock()
+        self._reader_task: Optional[asyncio.Task] = None
+
+    @property
+    def first_offset(self) -> int:
+        """
+        Offset of the oldest output that is kept.
+        """
+        return self.segments[0] if self.segments else self.buffer_offset
+
+    @property
+    def connected(self) -> bool:
+        return self._reader_task is not None and not self._reader_task.done()
+
+    async def load(self) -> None:
+        """
+        Finds the output kept by a previous run of the API.
+        """
+        async with self._load_lock:
+            if self._loaded:
+                return
+            self.segments = sorted(
+                int(path.name.split(".")[0])
+                for path in self.directory.glob("*.gz")
+                if path.name.split(".")[0].isdigit()
+            )
+            if self.segments:
+                last_segment = await asyncio.to_thread(
+                    read_segment, get_segment_path(self.directory, self.segments[-1])
+                )
+                self._segment_end = self.segments[-1] + len(last_segment)
+            self.buffer_offset = self.end_offset = self._segment_end
+            self._loaded = True
+
+    def connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader_task = asyncio.create_task(self._read(reader, writer))
+
+    async def _read(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while data := await reader.read(CONSOLE_READ_SIZE):
+                self.buffer += data
+                self.end_offset += len(data)
+                self._notify()
+                if len(self.buffer) >= settings.console_buffer_size:
+                    # Keeps half of the buffer in memory for the readers of the tail
+                    await self.spill(len(self.buffer) - settings.console_buffer_size // 2)
+        except (ConnectionError, OSError) as e:
+            logger.warning("Console of VM %s interrupted: %s", self.vm_id, e)
+        finally:
+            writer.close()
+            # The VM stopped, its output is only read from the disk now
+            with suppress(OSError):
+                await self.spill(len(self.buffer))
+            self._notify()
+
+    async def spill(self, size: int) -> None:
+        """
+        Moves the oldest `size` bytes of the buffer to the segments.
+        """
+        async with self._spill_lock:
+            size = min(size, len(self.buffer))
+            if size == 0:
+                return
+
+            if (
+                not self.segments
+                or self._segment_end - self.segments[-1] >= settings.console_segment_size
+            ):
+                self.segments.append(self.buffer_offset)
+            # Readers find the data in the buffer until it is written
+            data = bytes(self.buffer[:size])
+            await asyncio.to_thread(self._write_segment, self.segments[-1], data)
+            self._segment_end += size
+            del self.buffer[:size]
+            self.buffer_offset += size
+
+            while len(self.segments) > settings.console_max_segments:
+                oldest_segment = self.segments.pop(0)
+                get_segment_path(self.directory, oldest_segment).unlink(missing_ok=True)
+
+    def _write_segment(self, start_offset: int, data: bytes) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        append_to_segment(get_segment_path(self.directory, start_offset), data)
+
+    def _notify(self) -> None:
+        self._new_data.set()
+        self._new_data = asyncio.Event()
+
+    async def read(self, offset: int) -> Tuple[int, bytes]:
+        """
+        Returns the output from `offset`, or from the oldest output kept if it was
+        deleted, up to `CONSOLE_CHUNK_SIZE` bytes.
+
+        :return: The offset of the output and the output.
+        """
+        offset = max(offset, self.first_offset)
+        if offset >= self.buffer_offset:
+            start = offset - self.buffer_offset
+            return offset, bytes(self.buffer[start : start + CONSOLE_CHUNK_SIZE])
+
+        segment_start = max(start for start in self.segments if start <= offset)
+        try:
+            content = await asyncio.to_thread(
+                read_segment, get_segment_path(self.directory, segment_start)
+            )
+        except FileNotFoundError:
+            # Deleted by a spill meanwhile
+            return await self.read(offset)
+        start = offset - segment_start
+        return offset, content[start : start + CONSOLE_CHUNK_SIZE]
+
+    async def wait(self, offset: int, timeout: float) -> None:
+        """
+        Returns once there is output after `offset`, or after `timeout` seconds.
+        """
+        if self.end_offset > offset:
+            return
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._new_data.wait(), timeout)
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+
+class SerialConsoles:
+    def __init__(self):
+        self._consoles: Dict[str, SerialConsole] = {}
+
+    async def get(self, vm_id: str, vm_dir: Path) -> SerialConsole:
+        console = self._consoles.get(vm_id)
+        if console is None:
+            console = self._consoles[vm_id] = SerialConsole(vm_id, vm_dir)
+        await console.load()
+        return console
+
+    async def attach(self, vm_id: str, vm_dir: Path) -> None:
+        """
+        Reads the console of the Qemu process of a VM until it exits. Qemu creates
+        the socket before it accepts QMP connections.
+        """
+        console = await self.get(vm_id, vm_dir)
+        if console.connected:
+            return
+
+        try:
+            reader, writer = await open_console_connection(vm_dir)
+        except FileNotFoundError:
+            # Ex: a VM started by a version of the API that wrote it to a file
+            logger.warning("VM %s does not serve its console", vm_id)
+            return
+        except OSError as e:
+            logger.warning("Cannot read the console of VM %s: %s", vm_id, e)
+            return
+        console.connect(reader, writer)
+
+    async def stream(
+        self, vm_id: str, vm_dir: Path, offset: Optional[int], follow: bool
+    ) -> AsyncIterator[Tuple[int, bytes]]:
+        """
+        Yields the output of the console of a VM from `offset`, or the last
+        `console_buffer_size` bytes if not set. A negative offset counts from the
+        end of the output. If `follow` is set, waits for new output and yields an
+        empty chunk every `event_stream_keepalive_interval` seconds without output.
+        """
+        console = await self.get(vm_id, vm_dir)
+        if offset is None:
+            offset = console.end_offset - settings.console_buffer_size
+        elif offset < 0:
+            offset = console.end_offset + offset
+        offset = max(offset, 0)
+
+        while True:
+            offset, data = await console.read(offset)
+            if data:
+                yield offset, data
+                offset += len(data)
+            elif not follow:
+                return
+            else:
+                await console.wait(
+                    offset, timeout=settings.event_stream_keepalive_interval
+                )
+                if console.end_offset <= offset:
+                    yield offset, b""
+
+    async def close(self) -> None:
+        """
+        Stops reading the consoles and saves their output. Qemu keeps running.
+        """
+        await asyncio.gather(*(console.close() for console in self._consoles.values()))
+
+    def remove(self, vm_id: str) -> None:
+        self._consoles.pop(vm_id, None)
+
+
+serial_consoles = SerialConsoles()
+
+
+async def stream_console_to_worker(
+    vm_id: str, directory: str, offset: Optional[int], follow: bool
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yields the output of the console of a VM read by the leader, for another worker.
+    """
+    async for chunk_offset, data in serial_consoles.stream(
+        vm_id, Path(directory), offset=offset, follow=follow
+    ):
+        yield {"offset": chunk_offset, "data": base64.b64encode(data).decode()}
+
+
+async def stream_console(
+    vm_id: str, vm_dir: Path, offset: Optional[int], follow: bool
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Yields the output of the console of a VM, read by the leader.
+    """
+    if leader_election.is_leader:
+        async for chunk in serial_consoles.stream(vm_id, vm_dir, offset, follow):
+            yield chunk
+        return
+
+    async for message in stream_from_leader(
+        "console", vm_id=vm_id, directory=str(vm_dir), offset=offset, follow=follow
+    ):
+        yield message["offset"], base64.b64decode(message["data"])
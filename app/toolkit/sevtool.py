@@ -1,3 +1,4 @@
+import os
 import subprocess
 from dataclasses import dataclass
 from pathlib import Path
@@ -63,8 +64,9 @@ class SevClient:
 
         result = subprocess.run(
             ["sevctl", *args],
-            capture_output=False,
+            capture_output=True,
             text=True,
+            check=True,
         )
 
         #check_command_result(result)
@@ -84,4 +86,9 @@ class SevClient:
         return SevPlatformStatus.from_dict(sev_platform_status)
 
     def export_certificates(self):
-        _ = self.sevtool_cmd("export", self.certificates_archive)
+        # Requests serve the archive as soon as it exists, only publish it complete
+        tmp_archive = self.certificates_archive.with_name(
+            f"{self.certificates_archive.name}.{os.getpid()}.tmp"
+        )
+        _ = self.sevtool_cmd("export", tmp_archive)
+        os.replace(tmp_archive, self.certificates_archive)
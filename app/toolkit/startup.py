@@ -0,0 +1,75 @@
+"""
+Readiness of the API.
+
+After a restart, the API must reconcile the VMs in the database with the Qemu
+processes running on the host before it can act on VMs. The API serves requests
+during this phase, but the VM endpoints answer 503 until it completes.
+
+The leader worker reconciles the VMs, the other workers report its status.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, status
+
+
+class StartupStatus:
+    def __init__(self):
+        self.ready = False
+        self.vms_to_reconcile = 0
+        self.vms_reconciled = 0
+        self.error: Optional[str] = None
+        self._start_time = time.monotonic()
+        self._ready_time: Optional[float] = None
+
+    @property
+    def duration(self) -> float:
+        """
+        Time spent starting up, in seconds.
+        """
+        end_time = self._ready_time if self._ready_time is not None else time.monotonic()
+        return end_time - self._start_time
+
+    def set_ready(self) -> None:
+        self.ready = True
+        self._ready_time = time.monotonic()
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "vms_to_reconcile": self.vms_to_reconcile,
+            "vms_reconciled": self.vms_reconciled,
+            "duration": self.duration,
+            "error": self.error,
+        }
+
+    def mirror(self, status: Dict[str, Any]) -> None:
+        """
+        Copies the status of the leader.
+        """
+        self.ready = status["ready"]
+        self.vms_to_reconcile = status["vms_to_reconcile"]
+        self.vms_reconciled = status["vms_reconciled"]
+        self.error = status["error"]
+        now = time.monotonic()
+        self._start_time = now - status["duration"]
+        self._ready_time = now if self.ready else None
+
+
+startup_status = StartupStatus()
+
+
+def require_ready() -> None:
+    """
+    Dependency of the endpoints that cannot run before the end of the startup.
+    """
+    if not startup_status.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The API is starting, retry later",
+            headers={"Retry-After": "1"},
+        )
@@ -0,0 +1,324 @@
+"""
+Supervision of the Qemu processes.
+
+The supervisor spawns the Qemu processes and watches them from the event loop:
+a process exit is detected through a pidfd (Linux 5.3+) without any polling or
+thread per process, the process is reaped so that it does not linger as a zombie,
+and the exit handler is called to update the state of the VM.
+
+The stderr of each Qemu process is kept in a bounded buffer for diagnostics.
+Qemu processes run in their own session: stopping the API does not stop the VMs.
+"""
+
+import asyncio
+import datetime as dt
+import logging
+import os
+import signal
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+STDERR_READ_SIZE = 4096
+# Liveness polling interval of the processes when pidfds are not supported
+PROCESS_POLL_INTERVAL = 1.0
+
+
+@dataclass
+class QemuExit:
+    vm_id: str
+    pid: int
+    # Exit code of the process, negative if it was killed by a signal.
+    # Unknown for processes that were not spawned by the supervisor.
+    returncode: Optional[int]
+    datetime: dt.datetime
+
+
+ExitHandler = Callable[[QemuExit], Awaitable[None]]
+
+
+class StderrBuffer:
+    """
+    Keeps the last `max_size` bytes written by a process.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self._data += data
+        if len(self._data) > self.max_size:
+            del self._data[: len(self._data) - self.max_size]
+
+    def text(self) -> str:
+        return self._data.decode(errors="replace")
+
+
+@dataclass
+class SupervisedProcess:
+    vm_id: str
+    pid: int
+    stderr: StderrBuffer
+    # Only set for processes spawned by the supervisor, adopted processes are not
+    # children of the API and cannot be reaped
+    process: Optional[subprocess.Popen] = None
+    pidfd: Optional[int] = None
+    tasks: Set[asyncio.Task] = field(default_factory=set)
+    # Set once the exit of the process is handled
+    exited: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def is_running(supervised: SupervisedProcess) -> bool:
+    if supervised.process is not None:
+        return supervised.process.poll() is None
+
+    try:
+        os.kill(supervised.pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def pidfd_supported() -> bool:
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+class QemuSupervisor:
+    def __init__(self, stderr_buffer_size: int):
+        self.stderr_buffer_size = stderr_buffer_size
+        self.use_pidfd = pidfd_supported()
+
+        # VM ID -> running process
+        self._processes: Dict[str, SupervisedProcess] = {}
+        # VM ID -> stderr of the last process of the VM, kept after it exits
+        self._stderr: Dict[str, StderrBuffer] = {}
+        self._exit_handler: Optional[ExitHandler] = None
+        self._handler_tasks: Set[asyncio.Task] = set()
+
+    def start(self, exit_handler: ExitHandler) -> None:
+        self._exit_handler = exit_handler
+
+    def is_supervised(self, vm_id: str) -> bool:
+        return vm_id in self._processes
+
+    def get_stderr(self, vm_id: str) -> str:
+        """
+        Returns the last lines written on stderr by the Qemu process of a VM,
+        including after the process exited.
+        """
+        stderr = self._stderr.get(vm_id)
+        return stderr.text() if stderr is not None else ""
+
+    async def spawn(self, vm_id: str, command: List[str], cwd: Path) -> int:
+        """
+        Starts a Qemu process and watches it until it exits.
+
+        :return: The PID of the process.
+        """
+        process = await asyncio.to_thread(
+            subprocess.Popen,
+            command,
+            cwd=cwd,
+            stderr=subprocess.PIPE,
+            # Keep the VM running when the API is interrupted from a terminal.
+            # Qemu ignores SIGPIPE, so losing its stderr on a restart is harmless.
+            start_new_session=True,
+        )
+        supervised = SupervisedProcess(
+            vm_id=vm_id,
+            pid=process.pid,
+            stderr=StderrBuffer(self.stderr_buffer_size),
+            process=process,
+        )
+        os.set_blocking(process.stderr.fileno(), False)
+        asyncio.get_running_loop().add_reader(
+            process.stderr.fileno(), self._read_stderr, supervised
+        )
+        self._watch(supervised)
+        return process.pid
+
+    def adopt(self, vm_id: str, pid: int) -> None:
+        """
+        Watches a Qemu process started by a previous instance of the API.
+        Its stderr and exit code are not available.
+        """
+        self._watch(
+            SupervisedProcess(
+                vm_id=vm_id, pid=pid, stderr=StderrBuffer(self.stderr_buffer_size)
+            )
+        )
+
+    def _watch(self, supervised: SupervisedProcess) -> None:
+        self._processes[supervised.vm_id] = supervised
+        self._stderr[supervised.vm_id] = supervised.stderr
+
+        if self.use_pidfd:
+            try:
+                supervised.pidfd = os.pidfd_open(supervised.pid)
+            except ProcessLookupError:
+                # Already exited
+                self._on_exit(supervised)
+                return
+            asyncio.get_running_loop().add_reader(
+                supervised.pidfd, self._on_exit, supervised
+            )
+        else:
+            task = asyncio.create_task(self._poll_process(supervised))
+            supervised.tasks.add(task)
+            task.add_done_callback(supervised.tasks.discard)
+
+    async def _poll_process(self, supervised: SupervisedProcess) -> None:
+        while is_running(supervised):
+            await asyncio.sleep(PROCESS_POLL_INTERVAL)
+        self._on_exit(supervised)
+
+    def _read_stderr(self, supervised: SupervisedProcess) -> None:
+        stderr = supervised.process.stderr
+        try:
+            data = os.read(stderr.fileno(), STDERR_READ_SIZE)
+        except BlockingIOError:
+            return
+        if data:
+            supervised.stderr.write(data)
+            return
+
+        asyncio.get_running_loop().remove_reader(stderr.fileno())
+        stderr.close()
+
+    def _drain_stderr(self, supervised: SupervisedProcess) -> None:
+        stderr = supervised.process.stderr
+        if stderr.closed:
+            return
+        while True:
+            try:
+                data = os.read(stderr.fileno(), STDERR_READ_SIZE)
+            except BlockingIOError:
+                # Written by a child process of Qemu that still runs
+                break
+            if not data:
+                break
+            supervised.stderr.write(data)
+        asyncio.get_running_loop().remove_reader(stderr.fileno())
+        stderr.close()
+
+    def _on_exit(self, supervised: SupervisedProcess) -> None:
+        if self._processes.get(supervised.vm_id) is not supervised:
+            return
+        del self._processes[supervised.vm_id]
+
+        if supervised.pidfd is not None:
+            asyncio.get_running_loop().remove_reader(supervised.pidfd)
+            os.close(supervised.pidfd)
+
+        returncode = None
+        if supervised.process is not None:
+            # Reaps the process, it exited so this does not block
+            returncode = supervised.process.wait()
+            self._drain_stderr(supervised)
+
+        if returncode:
+            logger.warning(
+                "Qemu process of VM %s exited with code %d: %s",
+                supervised.vm_id,
+                returncode,
+                supervised.stderr.text()[-1000:],
+            )
+        else:
+            logger.info("Qemu process of VM %s exited", supervised.vm_id)
+
+        if self._exit_handler is None:
+            supervised.exited.set()
+            return
+        qemu_exit = QemuExit(
+            vm_id=supervised.vm_id,
+            pid=supervised.pid,
+            returncode=returncode,
+            datetime=dt.datetime.utcnow(),
+        )
+        task = asyncio.create_task(self._call_exit_handler(qemu_exit, supervised))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+
+    async def _call_exit_handler(
+        self, qemu_exit: QemuExit, supervised: SupervisedProcess
+    ) -> None:
+        try:
+            await self._exit_handler(qemu_exit)
+        except Exception:
+            logger.exception("Exit handler failed for VM %s", qemu_exit.vm_id)
+        finally:
+            supervised.exited.set()
+
+    async def wait_for_exit(self, vm_id: str, timeout: float) -> bool:
+        """
+        Waits until the Qemu process of a VM exits and its exit is handled.
+
+        :return: False if the process still runs after `timeout` seconds.
+        """
+        supervised = self._processes.get(vm_id)
+        if supervised is None:
+            return True
+        try:
+            await asyncio.wait_for(supervised.exited.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def forget(self, vm_id: str) -> None:
+        """
+        Drops the stderr kept for a deleted VM.
+        """
+        if vm_id not in self._processes:
+            self._stderr.pop(vm_id, None)
+
+    def send_signal(self, vm_id: str, signum: int) -> bool:
+        """
+        Sends a signal to the Qemu process of a VM.
+
+        :return: False if the VM has no running Qemu process.
+        """
+        supervised = self._processes.get(vm_id)
+        if supervised is None:
+            return False
+
+        try:
+            if supervised.pidfd is not None:
+                # Cannot hit another process if the PID was reused
+                signal.pidfd_send_signal(supervised.pidfd, signum)
+            else:
+                os.kill(supervised.pid, signum)
+        except ProcessLookupError:
+            return False
+        return True
+
+    async def close(self) -> None:
+        """
+        Stops watching the processes. The processes keep running.
+        """
+        loop = asyncio.get_running_loop()
+        for supervised in self._processes.values():
+            if supervised.pidfd is not None:
+                loop.remove_reader(supervised.pidfd)
+                os.close(supervised.pidfd)
+            if supervised.process is not None and not supervised.process.stderr.closed:
+                loop.remove_reader(supervised.process.stderr.fileno())
+            for task in supervised.tasks:
+                task.cancel()
+        self._processes.clear()
+
+        await asyncio.gather(*self._handler_tasks, return_exceptions=True)
+
+
+qemu_supervisor = QemuSupervisor(stderr_buffer_size=settings.qemu_stderr_buffer_size)
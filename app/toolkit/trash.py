@@ -0,0 +1,66 @@
+"""
+Removal of files and directories in the background.
+
+Removing the directory of a VM can take a while, ex: for a disk of tens of GB. The
+directory is moved to the trash, which is a single rename, and removed later by a
+background task, one entry at a time so that removals do not take over the thread
+pool. Entries left in the trash by a stopped worker are removed when the trash is
+emptied again.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+
+class Trash:
+    def __init__(self, directory: Path):
+        # Must be on the filesystem of the paths moved to the trash
+        self.directory = directory
+        self._task: Optional[asyncio.Task] = None
+        self._pending = False
+
+    def discard(self, path: Path) -> None:
+        """
+        Moves a file or directory to the trash and schedules its removal.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(path, self.directory / uuid4().hex)
+        except FileNotFoundError:
+            return
+        self.empty()
+
+    def empty(self) -> None:
+        """
+        Removes the content of the trash in the background.
+        """
+        if self._task is not None and not self._task.done():
+            # Removed once the current pass is done
+            self._pending = True
+            return
+        self._task = asyncio.create_task(self._empty())
+
+    async def _empty(self) -> None:
+        self._pending = True
+        while self._pending:
+            self._pending = False
+            await asyncio.to_thread(self._remove_all)
+
+    def _remove_all(self) -> None:
+        if not self.directory.is_dir():
+            return
+        for path in self.directory.iterdir():
+            try:
+                if path.is_dir() and not path.is_symlink():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            except OSError as e:
+                logger.warning("Could not remove %s: %s", path, e)
@@ -0,0 +1,218 @@
+"""
+Roles of the worker processes of the API.
+
+Every worker serves requests. One of them is elected leader and also runs what must
+run once per host: it spawns and supervises the Qemu processes, keeps their QMP
+connections and serial consoles, runs the launch queue, reconciles the VMs when it
+takes over, refreshes the status of the SEV platform, samples the resources used
+by the VMs and removes the unused images. The other workers relay their QMP
+commands, launch jobs, stops, events, console streams and resource usage queries to
+the leader, and report its readiness.
+If the leader stops, or fails to take over, another worker takes over.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from endpoints.vms.event_endpoints import forward_qmp_event
+from endpoints.vms.stop_endpoints import (
+    forget_vm,
+    run_image_store_gc,
+    stop_vm_process,
+    vm_dir_trash,
+)
+from endpoints.vms.vm_endpoints import (
+    finish_startup,
+    handle_qemu_exit,
+    launch_queue,
+    poll_queued_jobs,
+)
+from settings import settings
+from toolkit.events import Event, event_bus, stream_events_to_worker
+from toolkit.image_store import image_store
+from toolkit.launch_digest import firmware_digest_index
+from toolkit.leader import (
+    LeaderCallError,
+    LeaderUnavailableError,
+    call_leader,
+    leader_election,
+    leader_server,
+    notify_leader,
+    stream_from_leader,
+)
+from toolkit.platform_info import run_platform_refresh_loop
+from toolkit.qmp_client import qmp_manager
+from toolkit.resource_usage import resource_sampler
+from toolkit.serial_console import serial_consoles, stream_console_to_worker
+from toolkit.startup import startup_status
+from toolkit.supervisor import qemu_supervisor
+
+logger = logging.getLogger(__name__)
+
+LEADER_STATUS_TIMEOUT = 5.0
+
+election_task: Optional[asyncio.Task] = None
+follower_task: Optional[asyncio.Task] = None
+platform_refresh_task: Optional[asyncio.Task] = None
+resource_sampler_task: Optional[asyncio.Task] = None
+image_store_gc_task: Optional[asyncio.Task] = None
+
+
+async def get_startup_status() -> Dict[str, Any]:
+    return startup_status.to_dict()
+
+
+async def submit_launch(job_id: str) -> None:
+    launch_queue.submit(job_id)
+
+
+async def get_vm_stats(
+    vm_id: str, resolution: Optional[int], since: Optional[float]
+) -> Dict[str, Any]:
+    return resource_sampler.get_vm_stats(vm_id, resolution, since)
+
+
+async def get_node_stats(
+    resolution: Optional[int], since: Optional[float]
+) -> Dict[str, Any]:
+    return resource_sampler.get_node_stats(resolution, since)
+
+
+async def publish_event(owner: str, event_type: str, data: Dict[str, Any]) -> None:
+    event_bus.publish(owner, event_type, data)
+
+
+def forward_event(owner: str, event_type: str, data: Dict[str, Any]) -> None:
+    notify_leader("publish_event", owner=owner, event_type=event_type, data=data)
+
+
+async def follow_leader_events() -> None:
+    """
+    Delivers the events published through the leader to the clients of this worker.
+    """
+    while True:
+        try:
+            async for message in stream_from_leader("events"):
+                event_bus.deliver(
+                    message["owner"],
+                    Event(id=message["id"], type=message["type"], data=message["data"]),
+                )
+        except (LeaderUnavailableError, OSError) as e:
+            logger.debug("Event stream of the leader interrupted: %s", e)
+
+        # Events may be published until the stream is restored
+        event_bus.invalidate()
+        await asyncio.sleep(settings.leader_election_interval)
+
+
+async def follow() -> None:
+    global follower_task
+
+    if follower_task is None:
+        qmp_manager.relay_to_leader = True
+        event_bus.forwarder = forward_event
+        follower_task = asyncio.create_task(follow_leader_events())
+
+    try:
+        status = await call_leader("status", timeout=LEADER_STATUS_TIMEOUT)
+    except (LeaderUnavailableError, LeaderCallError, asyncio.TimeoutError):
+        # No leader, a worker takes over on its next attempt
+        startup_status.ready = False
+        return
+    startup_status.mirror(status)
+
+
+async def lead() -> None:
+    global follower_task, platform_refresh_task, resource_sampler_task
+    global image_store_gc_task
+
+    if follower_task is not None:
+        follower_task.cancel()
+        await asyncio.gather(follower_task, return_exceptions=True)
+        follower_task = None
+    qmp_manager.relay_to_leader = False
+    event_bus.forwarder = None
+    # The last events of the previous leader may not have been received
+    event_bus.invalidate()
+
+    await leader_server.start()
+    # Directories and images left by the deletions interrupted by a restart
+    vm_dir_trash.empty()
+    image_store.trash.empty()
+    platform_refresh_task = asyncio.create_task(
+        run_platform_refresh_loop(settings.platform_info_refresh_interval)
+    )
+    await finish_startup()
+    resource_sampler_task = asyncio.create_task(
+        resource_sampler.run(settings.resource_sample_interval)
+    )
+    image_store_gc_task = asyncio.create_task(
+        run_image_store_gc(settings.image_store_gc_interval)
+    )
+    await poll_queued_jobs()
+
+
+async def stop_leading() -> None:
+    """
+    Stops what the leader runs. The Qemu processes keep running.
+    """
+    global platform_refresh_task, resource_sampler_task, image_store_gc_task
+
+    for task in (platform_refresh_task, resource_sampler_task, image_store_gc_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    platform_refresh_task = resource_sampler_task = image_store_gc_task = None
+    await leader_server.close()
+    await launch_queue.stop()
+    await qemu_supervisor.close()
+    await serial_consoles.close()
+    await qmp_manager.close()
+
+
+async def index_firmware() -> None:
+    """
+    Hashes the firmware, so that the measure endpoint never waits for it.
+    """
+    try:
+        await firmware_digest_index.add_firmware(settings.ovmf_path)
+    except OSError as e:
+        logger.warning("Could not hash the firmware %s: %s", settings.ovmf_path, e)
+
+
+async def start_worker() -> None:
+    global election_task
+
+    leader_server.register("status", get_startup_status)
+    leader_server.register("qmp", qmp_manager.execute_relayed_command)
+    leader_server.register("submit_launch", submit_launch)
+    leader_server.register("publish_event", publish_event)
+    leader_server.register("vm_stats", get_vm_stats)
+    leader_server.register("node_stats", get_node_stats)
+    leader_server.register("stop_vm", stop_vm_process)
+    leader_server.register("forget_vm", forget_vm)
+    leader_server.register_stream("events", stream_events_to_worker)
+    leader_server.register_stream("console", stream_console_to_worker)
+
+    qemu_supervisor.start(handle_qemu_exit)
+    qmp_manager.add_event_listener(forward_qmp_event)
+    await index_firmware()
+    # Serve requests while electing the leader, the VM endpoints wait for readiness
+    election_task = asyncio.create_task(
+        leader_election.run(
+            on_elected=lead,
+            on_follow=follow,
+            on_resign=stop_leading,
+            interval=settings.leader_election_interval,
+        )
+    )
+
+
+async def stop_worker() -> None:
+    for task in (election_task, follower_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await stop_leading()
+    leader_election.release()
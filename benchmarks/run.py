@@ -0,0 +1,293 @@
+"""
+Load tests the API with simulated Qemu and sevctl processes.
+
+Starts the API in a scratch directory (see server.py), runs each scenario at
+increasing concurrency levels and reports the p50/p99 latency and throughput of
+each operation. Results are appended to a JSON lines file with the current commit,
+and compared with the results of the previous commit.
+
+Usage: python benchmarks/run.py [--scenarios lifecycle,get] [--concurrency 1,8,32]
+"""
+
+import argparse
+import asyncio
+import datetime as dt
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from scenarios import SCENARIOS, Recorder, ScenarioContext, make_image_tarball
+from server import BENCHMARK_USER, BENCHMARKS_DIR, ROOT_DIR
+
+# Outside the repository: the results are specific to the machine
+DEFAULT_RESULTS_FILE = Path.home() / ".local/share/scrn-benchmarks/results.jsonl"
+SERVER_STARTUP_TIMEOUT = 30.0
+READY_ANSWERS_PER_WORKER = 4
+
+
+def cli_parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the API.")
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help=f"Comma-separated scenarios, among: {', '.join(SCENARIOS)}.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default="1,4,16,64",
+        help="Comma-separated numbers of concurrent clients.",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=200,
+        help="Number of scenario iterations per concurrency level.",
+    )
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        default=1024 * 1024,
+        help="Size of the uploaded VM image, in bytes.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes of the API.",
+    )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        default=DEFAULT_RESULTS_FILE,
+        help="JSON lines file where the results are appended.",
+    )
+    parser.add_argument(
+        "--no-save", action="store_true", help="Do not save the results."
+    )
+    return parser.parse_args()
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_commit() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args], cwd=ROOT_DIR, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD") or None,
+        "subject": git("log", "-1", "--format=%s") or None,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+class ApiServer:
+    def __init__(self, work_dir: Path, workers: int):
+        self.work_dir = work_dir
+        self.workers = workers
+        self.port = get_free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process: Optional[subprocess.Popen] = None
+
+    async def start(self) -> None:
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                str(BENCHMARKS_DIR / "server.py"),
+                str(self.work_dir),
+                str(self.port),
+                str(self.workers),
+            ],
+        )
+        deadline = time.perf_counter() + SERVER_STARTUP_TIMEOUT
+        # Each worker reports its readiness, new connections reach them in turn
+        ready_answers = 0
+        async with httpx.AsyncClient(base_url=self.url) as client:
+            while True:
+                if self.process.poll() is not None:
+                    raise RuntimeError("The API server exited during startup")
+                try:
+                    response = await client.get(
+                        "/health/ready", headers={"Connection": "close"}
+                    )
+                    if response.status_code == 200:
+                        ready_answers += 1
+                        if ready_answers >= READY_ANSWERS_PER_WORKER * self.workers:
+                            return
+                        continue
+                    ready_answers = 0
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() > deadline:
+                    raise TimeoutError("The API server did not become ready")
+                await asyncio.sleep(0.1)
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        self.process.terminate()
+        self.process.wait()
+
+
+def percentile(values: List[float], percent: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    scenario_name: str,
+    concurrency: int,
+    iterations: int,
+    image_tarball: bytes,
+) -> List[Dict[str, Any]]:
+    scenario = SCENARIOS[scenario_name]
+    context = ScenarioContext(
+        client=client, recorder=Recorder(), image_tarball=image_tarball
+    )
+    if scenario.setup is not None:
+        await scenario.setup(context, scenario.setup_vms)
+        context.recorder = Recorder()
+
+    remaining = iterations
+
+    async def worker() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            try:
+                await scenario.iteration(context)
+            except (httpx.HTTPError, RuntimeError, TimeoutError) as e:
+                # Some connection errors have no message
+                error = (str(e) or repr(e)).splitlines()[0]
+                print(f"  {scenario_name}: {error}", file=sys.stderr)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+
+    results = []
+    recorder = context.recorder
+    for operation in sorted(recorder.latencies.keys() | recorder.errors.keys()):
+        latencies = recorder.latencies.get(operation, [])
+        results.append(
+            {
+                "scenario": scenario_name,
+                "concurrency": concurrency,
+                "operation": operation,
+                "count": len(latencies),
+                "errors": recorder.errors.get(operation, 0),
+                "p50": percentile(latencies, 50) if latencies else None,
+                "p99": percentile(latencies, 99) if latencies else None,
+                "rps": len(latencies) / duration,
+            }
+        )
+    return results
+
+
+def load_previous_results(results_file: Path, commit: Optional[str]) -> Dict[tuple, Dict]:
+    """
+    Returns the latest results of the last commit benchmarked before `commit`.
+    """
+    if not results_file.is_file():
+        return {}
+
+    runs = [json.loads(line) for line in results_file.read_text().splitlines() if line]
+    previous_runs = [run for run in runs if run["commit"] != commit]
+    if not previous_runs:
+        return {}
+
+    previous_commit = previous_runs[-1]["commit"]
+    return {
+        (result["scenario"], result["concurrency"], result["operation"]): result
+        for run in previous_runs
+        if run["commit"] == previous_commit
+        for result in run["results"]
+    }
+
+
+def format_delta(value: Optional[float], previous: Optional[float]) -> str:
+    if value is None or not previous:
+        return ""
+    return f"{(value - previous) / previous * 100:+.0f}%"
+
+
+def print_results(results: List[Dict[str, Any]], previous: Dict[tuple, Dict]) -> None:
+    print(
+        f"{'scenario':<10} {'conc':>5} {'operation':<20} {'count':>6} {'err':>4} "
+        f"{'p50 ms':>9} {'p99 ms':>9} {'rps':>9} {'Δp50':>6} {'Δp99':>6} {'Δrps':>6}"
+    )
+    for result in results:
+        key = (result["scenario"], result["concurrency"], result["operation"])
+        before = previous.get(key, {})
+        p50 = result["p50"] * 1000 if result["p50"] is not None else float("nan")
+        p99 = result["p99"] * 1000 if result["p99"] is not None else float("nan")
+        print(
+            f"{result['scenario']:<10} {result['concurrency']:>5} "
+            f"{result['operation']:<20} {result['count']:>6} {result['errors']:>4} "
+            f"{p50:>9.2f} {p99:>9.2f} {result['rps']:>9.1f} "
+            f"{format_delta(result['p50'], before.get('p50')):>6} "
+            f"{format_delta(result['p99'], before.get('p99')):>6} "
+            f"{format_delta(result['rps'], before.get('rps')):>6}"
+        )
+
+
+async def main(args: argparse.Namespace) -> None:
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            sys.exit(f"Unknown scenario '{scenario}'")
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    image_tarball = make_image_tarball(args.image_size)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="scrn-bench-") as work_dir:
+        server = ApiServer(Path(work_dir), args.workers)
+        await server.start()
+        try:
+            limits = httpx.Limits(max_connections=max(concurrency_levels))
+            async with httpx.AsyncClient(
+                base_url=server.url, auth=BENCHMARK_USER, limits=limits, timeout=120
+            ) as client:
+                for scenario in scenarios:
+                    for concurrency in concurrency_levels:
+                        print(f"Running {scenario} with {concurrency} clients...")
+                        results += await run_level(
+                            client, scenario, concurrency, args.iterations, image_tarball
+                        )
+        finally:
+            server.stop()
+
+    commit = get_commit()
+    print()
+    print_results(results, load_previous_results(args.results, commit["commit"]))
+
+    if not args.no_save:
+        run = {
+            **commit,
+            "date": dt.datetime.utcnow().isoformat(),
+            "iterations": args.iterations,
+            "workers": args.workers,
+            "results": results,
+        }
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        with args.results.open("a") as f:
+            f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(cli_parse()))
@@ -0,0 +1,300 @@
+"""
+Benchmark scenarios.
+
+A scenario has an optional setup, run once per concurrency level, and an iteration
+run concurrently by the workers. Iterations time each API call with the recorder,
+under an operation name.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+IMAGE_NAME = "disk.img"
+JOB_POLL_INTERVAL = 0.01
+JOB_TIMEOUT = 60.0
+# Number of VMs launched by each iteration of the fleet scenario
+FLEET_SIZE = 10
+
+
+class Recorder:
+    """
+    Collects the latency of each operation, in seconds.
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    @asynccontextmanager
+    async def measure(self, operation: str):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[operation] += 1
+            raise
+        self.latencies[operation].append(time.perf_counter() - start)
+
+
+def make_image_tarball(size: int) -> bytes:
+    image = os.urandom(size)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo(IMAGE_NAME)
+        info.size = len(image)
+        tar.addfile(info, io.BytesIO(image))
+    return buffer.getvalue()
+
+
+def make_certificates_archive() -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("vm_godh.b64", os.urandom(2048))
+        archive.writestr("vm_session.b64", os.urandom(512))
+    return buffer.getvalue()
+
+
+@dataclass
+class ScenarioContext:
+    client: httpx.AsyncClient
+    recorder: Recorder
+    image_tarball: bytes
+    certificates: bytes = field(default_factory=make_certificates_archive)
+    # VMs prepared by the setup of the scenario
+    vm_ids: List[str] = field(default_factory=list)
+    iteration: int = 0
+
+    def next_vm_id(self) -> str:
+        vm_id = self.vm_ids[self.iteration % len(self.vm_ids)]
+        self.iteration += 1
+        return vm_id
+
+
+async def call(
+    context: ScenarioContext, operation: str, method: str, url: str, **kwargs
+) -> Any:
+    async with context.recorder.measure(operation):
+        response = await context.client.request(method, url, **kwargs)
+        response.raise_for_status()
+    return response.json()
+
+
+async def create_vm(context: ScenarioContext) -> str:
+    vm = await call(context, "create", "POST", "/vm/vm", params={"memory": 256})
+    return vm["id"]
+
+
+async def upload_image(context: ScenarioContext, vm_id: str) -> None:
+    await call(
+        context,
+        "upload_image",
+        "POST",
+        f"/vm/vm/{vm_id}/upload-image",
+        params={"image_name": IMAGE_NAME},
+        files={"vm_image_tarball": ("image.tar.gz", context.image_tarball)},
+    )
+
+
+async def upload_certificates(context: ScenarioContext, vm_id: str) -> None:
+    await call(
+        context,
+        "upload_certificates",
+        "POST",
+        f"/vm/vm/{vm_id}/upload-guest-owner-certificates",
+        files={"guest_owner_certificates": ("certs.zip", context.certificates)},
+    )
+
+
+async def start_vm(context: ScenarioContext, vm_id: str) -> None:
+    """
+    Starts the VM and waits for its launch job. The time until the job completes
+    is recorded as the "launch" operation.
+    """
+    async with context.recorder.measure("launch"):
+        job = await call(
+            context, "start", "POST", f"/vm/vm/{vm_id}/start", params={"sev_policy": "1"}
+        )
+        await wait_for_job(context, job)
+
+
+async def wait_for_job(context: ScenarioContext, job: Dict[str, Any]) -> None:
+    deadline = time.perf_counter() + JOB_TIMEOUT
+    while job["status"] not in ("succeeded", "failed"):
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"Launch of VM {job['vm_id']} timed out")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        response = await context.client.get(f"/vm/jobs/{job['id']}")
+        response.raise_for_status()
+        job = response.json()
+
+    if job["status"] == "failed":
+        raise RuntimeError(f"Launch of VM {job['vm_id']} failed: {job['error']}")
+
+
+async def measure_vm(context: ScenarioContext, vm_id: str) -> None:
+    await call(context, "measure", "GET", f"/vm/vm/{vm_id}/sev/measure")
+
+
+async def inject_secret(context: ScenarioContext, vm_id: str) -> None:
+    await call(
+        context,
+        "inject_secret",
+        "POST",
+        f"/vm/vm/{vm_id}/sev/inject-secret",
+        params={
+            "packet_header": base64.b64encode(os.urandom(52)).decode(),
+            "secret": base64.b64encode(os.urandom(64)).decode(),
+        },
+    )
+
+
+async def prepare_vm(context: ScenarioContext) -> str:
+    vm_id = await create_vm(context)
+    await upload_image(context, vm_id)
+    await upload_certificates(context, vm_id)
+    return vm_id
+
+
+async def setup_stopped_vms(context: ScenarioContext, count: int) -> None:
+    context.vm_ids = [await create_vm(context) for _ in range(count)]
+
+
+async def setup_template_vms(context: ScenarioContext, count: int) -> None:
+    context.vm_ids = [await prepare_vm(context) for _ in range(count)]
+
+
+async def setup_started_vms(context: ScenarioContext, count: int) -> None:
+    for _ in range(count):
+        vm_id = await prepare_vm(context)
+        await start_vm(context, vm_id)
+        context.vm_ids.append(vm_id)
+
+
+async def lifecycle(context: ScenarioContext) -> None:
+    vm_id = await prepare_vm(context)
+    await start_vm(context, vm_id)
+    await measure_vm(context, vm_id)
+    await inject_secret(context, vm_id)
+
+
+async def fleet(context: ScenarioContext) -> None:
+    """
+    Creates and starts a fleet of VMs from a template VM with a single request,
+    then waits for all the launches. The whole is recorded as "fleet_launch".
+    """
+    async with context.recorder.measure("fleet_launch"):
+        response = await call(
+            context,
+            "bulk_create",
+            "POST",
+            "/vm/bulk",
+            json={
+                "number_of_vms": FLEET_SIZE,
+                "memory": 256,
+                "template_vm_id": context.next_vm_id(),
+                "share_certificates": True,
+                "sev_policy": "1",
+            },
+        )
+        for result in response["results"]:
+            if result["error"] is not None:
+                raise RuntimeError(f"VM {result['vm']['id']}: {result['error']}")
+        await asyncio.gather(
+            *(wait_for_job(context, result["job"]) for result in response["results"])
+        )
+
+
+async def launch_bundle(context: ScenarioContext) -> None:
+    """
+    Creates and starts a VM with a single request that returns its measure, then
+    injects the secret.
+    """
+    spec = {"memory": 256, "sev_policy": "1", "image_name": IMAGE_NAME}
+    response = await call(
+        context,
+        "launch_bundle",
+        "POST",
+        "/vm/launch",
+        files=[
+            ("spec", (None, json.dumps(spec), "application/json")),
+            ("guest_owner_certificates", ("certs.zip", context.certificates)),
+            ("vm_image_tarball", ("image.tar.gz", context.image_tarball)),
+        ],
+    )
+    if response["launch_measure"] is None:
+        job = response["job"]
+        raise RuntimeError(f"Launch of VM {job['vm_id']} failed: {job['error']}")
+    await inject_secret(context, response["vm"]["id"])
+
+
+async def create(context: ScenarioContext) -> None:
+    await create_vm(context)
+
+
+async def get(context: ScenarioContext) -> None:
+    await call(context, "get", "GET", f"/vm/vm/{context.next_vm_id()}")
+
+
+async def measure(context: ScenarioContext) -> None:
+    await measure_vm(context, context.next_vm_id())
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    iteration: Callable[[ScenarioContext], Awaitable[None]]
+    setup: Optional[Callable[[ScenarioContext, int], Awaitable[None]]] = None
+    # Number of VMs created by the setup
+    setup_vms: int = 0
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario(
+            name="lifecycle",
+            description="Create, upload image and certificates, start, measure, inject",
+            iteration=lifecycle,
+        ),
+        Scenario(
+            name="launch_bundle",
+            description="Create, upload and start in one request, then inject",
+            iteration=launch_bundle,
+        ),
+        Scenario(
+            name="fleet",
+            description=f"Create and start {FLEET_SIZE} VMs from a template in bulk",
+            iteration=fleet,
+            setup=setup_template_vms,
+            setup_vms=1,
+        ),
+        Scenario(name="create", description="Create VMs", iteration=create),
+        Scenario(
+            name="get",
+            description="Read VMs, exercises authentication and the DB",
+            iteration=get,
+            setup=setup_stopped_vms,
+            setup_vms=16,
+        ),
+        Scenario(
+            name="measure",
+            description="Query the launch measurement of started VMs over QMP",
+            iteration=measure,
+            setup=setup_started_vms,
+            setup_vms=8,
+        ),
+    )
+}
@@ -0,0 +1,116 @@
+"""
+Runs the API in a scratch directory, with the fake Qemu, qemu-img and sevctl.
+
+The database, image store and VM directories are created in the scratch directory,
+so benchmarks never touch the state of a real node.
+
+Usage: python benchmarks/server.py WORK_DIR PORT [WORKERS]
+"""
+
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+BENCHMARKS_DIR = Path(__file__).absolute().parent
+ROOT_DIR = BENCHMARKS_DIR.parent
+
+BENCHMARK_USER = ("bench", "bench")
+
+# Typical values of an EPYC CPU, used when the host does not support SEV
+FAKE_SEV_INFO = SimpleNamespace(c_bit_position=51, phys_addr_reduction=1)
+
+CONFIG = """\
+default_image_path: "{work_dir}/default.img"
+ovmf_path: "{work_dir}/OVMF.fd"
+"""
+
+# VMs are not backed by real memory, do not let the host capacity limit the benchmarks
+SETTINGS_ENV = {
+    "aleph_scrn_memory_overcommit_ratio": "1000",
+    "aleph_scrn_cpu_overcommit_ratio": "1000",
+    "aleph_scrn_vm_pin_vcpus": "false",
+}
+
+
+def prepare_work_dir(work_dir: Path) -> None:
+    work_dir.mkdir(parents=True, exist_ok=True)
+    (work_dir / "config.yml").write_text(CONFIG.format(work_dir=work_dir))
+    (work_dir / "OVMF.fd").write_bytes(b"\0" * 4096)
+    (work_dir / "default.img").write_bytes(b"\0" * 4096)
+
+
+def create_database() -> None:
+    from passlib.context import CryptContext
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from models.db import Base
+    from models.users import User
+
+    if Path("confidential_vms.db").exists():
+        # Restart of the API in an existing work directory
+        return
+
+    engine = create_engine("sqlite:///./confidential_vms.db")
+    Base.metadata.create_all(engine)
+
+    username, password = BENCHMARK_USER
+    with Session(engine) as session:
+        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        session.add(User(username=username, hashed_password=pwd_context.hash(password)))
+        session.commit()
+
+
+def create_app():
+    """
+    Replaces the SEV parameters of the CPU if needed and returns the API, in each
+    worker of the API.
+    """
+    from cpuid.features import secure_encryption_info
+
+    import api
+    from endpoints.vms import stop_endpoints, vm_endpoints
+    from toolkit import qemu
+
+    if secure_encryption_info() is None:
+        qemu.get_sev_info = lambda: FAKE_SEV_INFO
+    vm_endpoints.DOWNLOAD_DIR = Path.cwd() / "vms"
+    stop_endpoints.vm_dir_trash.directory = vm_endpoints.DOWNLOAD_DIR / ".trash"
+    return api.app
+
+
+def main(work_dir: Path, port: int, workers: int) -> None:
+    prepare_work_dir(work_dir)
+    os.chdir(work_dir)
+    os.environ["PATH"] = f"{BENCHMARKS_DIR / 'fakes'}{os.pathsep}{os.environ['PATH']}"
+    os.environ.update(SETTINGS_ENV)
+    # Qemu processes outlive the API, the fake ones must not outlive the benchmarks
+    # unless restarts of the API are tested
+    os.environ.setdefault("FAKE_QEMU_EXIT_WITH_PARENT", "1")
+    sys.path[:0] = [str(ROOT_DIR), str(ROOT_DIR / "app")]
+
+    import uvicorn
+    from toolkit.host_lock import get_runtime_dir
+    from toolkit.metrics import prepare_multiprocess_metrics
+
+    create_database()
+    if workers > 1:
+        prepare_multiprocess_metrics(get_runtime_dir() / "metrics")
+
+    uvicorn.run(
+        "server:create_app",
+        factory=True,
+        host="127.0.0.1",
+        port=port,
+        log_level="warning",
+        workers=workers,
+    )
+
+
+if __name__ == "__main__":
+    main(
+        Path(sys.argv[1]).absolute(),
+        int(sys.argv[2]),
+        int(sys.argv[3]) if len(sys.argv) > 3 else 1,
+    )
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules of the API import each other relative to app/, as when running app/api.py
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
@@ -0,0 +1,143 @@
+from pathlib import Path
+
+import pytest
+
+from settings import settings
+from toolkit.device_profiles import (
+    BUILTIN_DEVICE_PROFILES,
+    DeviceProfile,
+    DiskBus,
+    NetworkBackend,
+    get_disk_args,
+    get_iothread_args,
+    get_network_args,
+    load_device_profiles,
+)
+from toolkit.image_store import VmDisk
+
+VM_ID = "0123456789abcdef0123456789abcdef"
+DISK = VmDisk(path=Path("/vms/vm/disk.qcow2"), format="qcow2")
+
+
+def test_compat_disk():
+    profile = BUILTIN_DEVICE_PROFILES["compat"]
+    assert get_iothread_args(profile) == []
+    assert get_disk_args(profile, DISK, number_of_cores=4) == [
+        "-drive",
+        "format=qcow2,file=/vms/vm/disk.qcow2",
+    ]
+
+
+def test_compat_network():
+    profile = BUILTIN_DEVICE_PROFILES["compat"]
+    assert get_network_args(profile, VM_ID, number_of_cores=4, ssh_port=2222) == [
+        "-netdev",
+        "user,id=net0,hostfwd=tcp::2222-:22",
+        "-device",
+        "virtio-net-pci,netdev=net0",
+    ]
+
+
+def test_virtio_blk_disk():
+    profile = BUILTIN_DEVICE_PROFILES["balanced"]
+    assert get_iothread_args(profile) == ["-object", "iothread,id=iothread0"]
+    assert get_disk_args(profile, DISK, number_of_cores=4) == [
+        "-drive",
+        "if=none,id=disk0,format=qcow2,file=/vms/vm/disk.qcow2,cache=none,aio=native",
+        "-device",
+        "virtio-blk-pci,drive=disk0,num-queues=4,iothread=iothread0",
+    ]
+
+
+def test_virtio_scsi_disk():
+    profile = BUILTIN_DEVICE_PROFILES["performance-scsi"]
+    assert get_disk_args(profile, DISK, number_of_cores=2) == [
+        "-drive",
+        "if=none,id=disk0,format=qcow2,file=/vms/vm/disk.qcow2,cache=none,aio=io_uring",
+        "-device",
+        "virtio-scsi-pci,id=scsi0,num_queues=2,iothread=iothread0",
+        "-device",
+        "scsi-hd,drive=disk0,bus=scsi0.0",
+    ]
+
+
+def test_virtio_blk_without_iothread():
+    profile = DeviceProfile(name="test", disk_bus=DiskBus.VIRTIO_BLK)
+    assert get_disk_args(profile, DISK, number_of_cores=1)[-1] == (
+        "virtio-blk-pci,drive=disk0,num-queues=1"
+    )
+
+
+def test_tap_multiqueue():
+    profile = DeviceProfile(
+        name="test",
+        network_backend=NetworkBackend.TAP,
+        network_queues=4,
+        vhost=True,
+        tap_script="/etc/scrn/ifup",
+    )
+    assert get_network_args(profile, VM_ID, number_of_cores=8, ssh_port=None) == [
+        "-netdev",
+        "tap,id=net0,ifname=scrn0123456789a,script=/etc/scrn/ifup,vhost=on,queues=4",
+        "-device",
+        "virtio-net-pci,netdev=net0,mq=on,vectors=10",
+    ]
+
+
+def test_tap_one_queue_per_vcpu():
+    profile = BUILTIN_DEVICE_PROFILES["performance"]
+    assert profile.network_queues == 0
+    args = get_network_args(profile, VM_ID, number_of_cores=6, ssh_port=None)
+    netdev, device = args[1], args[3]
+    assert netdev.endswith(",queues=6")
+    assert device == "virtio-net-pci,netdev=net0,mq=on,vectors=14"
+
+
+def test_tap_single_queue():
+    profile = DeviceProfile(name="test", network_backend=NetworkBackend.TAP)
+    args = get_network_args(profile, VM_ID, number_of_cores=4, ssh_port=None)
+    netdev, device = args[1], args[3]
+    assert "queues" not in netdev
+    assert device == "virtio-net-pci,netdev=net0"
+
+
+def test_user_network_ignores_queues():
+    profile = DeviceProfile(name="test", network_queues=0)
+    device = get_network_args(profile, VM_ID, number_of_cores=4, ssh_port=2222)[-1]
+    assert device == "virtio-net-pci,netdev=net0"
+
+
+def test_load_device_profiles_base(monkeypatch):
+    monkeypatch.setattr(
+        settings,
+        "device_profiles",
+        {
+            "fast-blk": {"base": "balanced", "disk_aio": "io_uring", "iothreads": 2},
+            "legacy": {"disk_cache": "writeback"},
+        },
+    )
+    profiles = load_device_profiles()
+
+    assert set(BUILTIN_DEVICE_PROFILES) < set(profiles)
+    assert profiles["fast-blk"] == DeviceProfile(
+        name="fast-blk",
+        disk_bus=DiskBus.VIRTIO_BLK,
+        iothreads=2,
+        disk_cache="none",
+        disk_aio="io_uring",
+    )
+    # Profiles are based on "compat" by default
+    assert profiles["legacy"] == DeviceProfile(name="legacy", disk_cache="writeback")
+
+
+def test_load_device_profiles_override_builtin(monkeypatch):
+    monkeypatch.setattr(
+        settings, "device_profiles", {"balanced": {"base": "balanced", "iothreads": 4}}
+    )
+    assert load_device_profiles()["balanced"].iothreads == 4
+
+
+def test_load_device_profiles_unknown_option(monkeypatch):
+    monkeypatch.setattr(settings, "device_profiles", {"bad": {"disk_queues": 4}})
+    with pytest.raises(ValueError, match="Invalid device profile 'bad'"):
+        load_device_profiles()
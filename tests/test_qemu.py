@@ -0,0 +1,66 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+from models.vm import Vm
+from toolkit.device_profiles import BUILTIN_DEVICE_PROFILES
+from toolkit.image_store import VmDisk
+from toolkit.placement import VmPlacement
+from toolkit.qemu import build_qemu_command
+
+SEV_INFO = SimpleNamespace(c_bit_position=51, phys_addr_reduction=1)
+
+
+def make_vm(number_of_cores: int = 2) -> Vm:
+    return Vm(
+        id="0123456789abcdef0123456789abcdef",
+        memory=2048,
+        number_of_cores=number_of_cores,
+        sev_policy="1",
+    )
+
+
+def build_command(profile_name: str, number_of_cores: int = 2, ssh_port=2222):
+    return build_qemu_command(
+        vm=make_vm(number_of_cores),
+        ovmf_path=Path("/opt/ovmf/OVMF.fd"),
+        disk=VmDisk(path=Path("disk.img"), format="raw"),
+        placement=VmPlacement(numa_node=None),
+        profile=BUILTIN_DEVICE_PROFILES[profile_name],
+        sev_info=SEV_INFO,
+        ssh_port=ssh_port,
+        qmp_address="qmp.sock",
+    )
+
+
+def get_options(command, flag):
+    return [command[i + 1] for i, arg in enumerate(command) if arg == flag]
+
+
+def test_compat_profile_devices():
+    command = build_command("compat")
+
+    # Same disk and network devices as before device profiles were introduced
+    assert get_options(command, "-drive") == [
+        "if=pflash,format=raw,unit=0,file=/opt/ovmf/OVMF.fd,readonly=on",
+        "format=raw,file=disk.img",
+    ]
+    assert get_options(command, "-netdev") == ["user,id=net0,hostfwd=tcp::2222-:22"]
+    assert get_options(command, "-device") == ["virtio-net-pci,netdev=net0"]
+    assert not any(
+        option.startswith("iothread") for option in get_options(command, "-object")
+    )
+
+
+def test_performance_profile_devices():
+    command = build_command("performance", number_of_cores=4, ssh_port=None)
+
+    assert "iothread,id=iothread0" in get_options(command, "-object")
+    assert get_options(command, "-device") == [
+        "virtio-blk-pci,drive=disk0,num-queues=4,iothread=iothread0",
+        "virtio-net-pci,netdev=net0,mq=on,vectors=10",
+    ]
+    assert get_options(command, "-netdev") == [
+        "tap,id=net0,ifname=scrn0123456789a,vhost=on,queues=4"
+    ]
+    # The I/O thread is created before the device that uses it
+    assert command.index("iothread,id=iothread0") < command.index("-device")
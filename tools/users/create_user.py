@@ -1,9 +1,9 @@
 import argparse
+import asyncio
 
 from passlib.context import CryptContext
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
+from app.models.db import async_session, engine
 from app.models.users import User
 
 
@@ -28,16 +28,19 @@ def cli_parse() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def main(args: argparse.Namespace):
-    engine = create_engine("sqlite:///./confidential_vms.db")
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
+async def create_user(username: str, password: str) -> None:
+    # Uses the database configured for the API
     pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-    password = pwd_context.hash(args.password)
-    user = User(username=args.username, hashed_password=password)
-    session.add(user)
-    session.commit()
+    async with async_session() as session:
+        async with session.begin():
+            session.add(
+                User(username=username, hashed_password=pwd_context.hash(password))
+            )
+    await engine.dispose()
+
+
+def main(args: argparse.Namespace):
+    asyncio.run(create_user(args.username, args.password))
 
 
 if __name__ == "__main__":